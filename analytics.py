@@ -0,0 +1,212 @@
+import heapq
+from datetime import datetime, timedelta
+from sqlalchemy import distinct, func, select
+from models import db, User, Room, Subject, Timetable, RecurringLesson, Period, WeeklyUsage, UsageWeek, user_timetable
+from recurring import expand_matching_lessons
+from generator import DAYS_PER_WEEK, DEFAULT_PERIODS
+
+# Room, teacher and subject usage reports over any range of weeks.
+#
+# Lessons and teaching minutes are kept per week in WeeklyUsage, so a
+# term-wide report sums a few rows per week instead of reading every
+# Timetable row and expanding every recurring lesson. A week is recomputed
+# from its lessons whenever a write touches it (see invalidate_weeks in
+# app.py). Writes that can touch any week, like recurring lesson series and
+# imports, only forget which weeks are current; those weeks are recomputed
+# in one pass the next time a report covers them. rebuild_usage() recomputes
+# everything in a single pass over the timetable.
+
+REPORTS = ('rooms', 'teachers', 'subjects')
+
+
+def week_start_of(day):
+    return day - timedelta(days=day.weekday())
+
+
+def lesson_minutes(start_time, end_time):
+    return (end_time.hour * 60 + end_time.minute) - (start_time.hour * 60 + start_time.minute)
+
+
+def iter_lessons(start_date, end_date):
+    """Yield (date, minutes, room_id, teacher_id, subject_id, student year groups) for every lesson
+    in the range, in date order: dated entries streamed from the database merged with recurring occurrences."""
+    year_groups = select(func.group_concat(distinct(User.year_group))).select_from(user_timetable).join(
+        User, User.id == user_timetable.c.user_id
+    ).where(
+        user_timetable.c.timetable_id == Timetable.id, User.role == 'student'
+    ).scalar_subquery()
+    entries = db.session.query(
+        Timetable.date, Timetable.start_time, Timetable.end_time, Timetable.room_id, Timetable.teacher_id,
+        Timetable.subject_id, year_groups
+    ).filter(
+        Timetable.date.between(start_date, end_date),
+        Timetable.is_free_day == False,
+        Timetable.users.any()  # An override without users is a cancelled occurrence
+    ).order_by(Timetable.date, Timetable.start_time).yield_per(1000)
+    dated = ((day, lesson_minutes(start, end), room_id, teacher_id, subject_id, groups.split(',') if groups else [])
+             for day, start, end, room_id, teacher_id, subject_id, groups in entries)
+
+    occurrences = sorted(expand_matching_lessons([], start_date, end_date), key=lambda occurrence: occurrence.date)
+    recurring = ((occurrence.date, lesson_minutes(occurrence.start_time, occurrence.end_time), occurrence.room_id,
+                  occurrence.teacher_id, occurrence.subject_id,
+                  sorted({user.year_group for user in occurrence.users if user.role == 'student' and user.year_group}))
+                 for occurrence in occurrences)
+    return heapq.merge(dated, recurring, key=lambda lesson: lesson[0])
+
+
+def add_lesson(totals, minutes, room_id, teacher_id, subject_id, year_groups):
+    keys = []
+    if room_id is not None:
+        keys.append(('room', room_id, ''))
+    if teacher_id is not None:
+        keys.append(('teacher', teacher_id, ''))
+    if subject_id is not None:
+        keys += [('subject', subject_id, year_group) for year_group in year_groups or ['']]
+    for key in keys:
+        counts = totals.setdefault(key, [0, 0])
+        counts[0] += 1
+        counts[1] += minutes
+
+
+def write_week(week_start, totals):
+    db.session.query(WeeklyUsage).filter(WeeklyUsage.week_start == week_start).delete(synchronize_session=False)
+    if totals:
+        db.session.execute(WeeklyUsage.__table__.insert(), [
+            {'week_start': week_start, 'kind': kind, 'key_id': key_id, 'year_group': year_group,
+             'lessons': lessons, 'minutes': minutes}
+            for (kind, key_id, year_group), (lessons, minutes) in totals.items()
+        ])
+    db.session.merge(UsageWeek(week_start=week_start, refreshed_at=datetime.utcnow()))
+
+
+def refresh_range(first_week, last_week):
+    """Recompute the weeks from first_week to last_week (Mondays) in one pass over their lessons."""
+    week, totals = first_week, {}
+    for day, minutes, room_id, teacher_id, subject_id, year_groups in iter_lessons(first_week, last_week + timedelta(days=6)):
+        while day >= week + timedelta(days=7):
+            write_week(week, totals)
+            week, totals = week + timedelta(days=7), {}
+        add_lesson(totals, minutes, room_id, teacher_id, subject_id, year_groups)
+    while week <= last_week:
+        write_week(week, totals)
+        week, totals = week + timedelta(days=7), {}
+    db.session.commit()
+
+
+def refresh_weeks(week_starts):
+    """Recompute the given weeks, each run of consecutive weeks in one pass."""
+    weeks = sorted(set(week_starts))
+    while weeks:
+        run_end = 1
+        while run_end < len(weeks) and weeks[run_end] - weeks[run_end - 1] == timedelta(days=7):
+            run_end += 1
+        refresh_range(weeks[0], weeks[run_end - 1])
+        weeks = weeks[run_end:]
+
+
+def forget_usage():
+    """Mark every week as out of date, for writes that could have touched any of them."""
+    db.session.query(UsageWeek).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def ensure_usage(first_week, last_week):
+    current = {week for week, in db.session.query(UsageWeek.week_start).filter(UsageWeek.week_start.between(first_week, last_week))}
+    weeks = [first_week + timedelta(weeks=index) for index in range((last_week - first_week).days // 7 + 1)]
+    refresh_weeks([week for week in weeks if week not in current])
+
+
+def timetable_span():
+    """The first and last Monday with any dated entry or recurring lesson, or None for an empty timetable."""
+    first = [value for value in (db.session.query(func.min(Timetable.date)).scalar(),
+                                 db.session.query(func.min(RecurringLesson.term_start)).scalar()) if value]
+    last = [value for value in (db.session.query(func.max(Timetable.date)).scalar(),
+                                db.session.query(func.max(RecurringLesson.term_end)).scalar()) if value]
+    if not first:
+        return None
+    return week_start_of(min(first)), week_start_of(max(last))
+
+
+def rebuild_usage():
+    """Recompute all usage from scratch; returns the number of weeks written."""
+    db.session.query(UsageWeek).delete(synchronize_session=False)
+    db.session.query(WeeklyUsage).delete(synchronize_session=False)
+    db.session.commit()
+    span = timetable_span()
+    if span is None:
+        return 0
+    refresh_range(*span)
+    return (span[1] - span[0]).days // 7 + 1
+
+
+def teaching_minutes_per_week():
+    # What one room could host in a week: every period of every school day
+    periods = [(period.start_time, period.end_time) for period in Period.query.all()] or DEFAULT_PERIODS
+    return DAYS_PER_WEEK * sum(lesson_minutes(start, end) for start, end in periods)
+
+
+def usage_totals(kind, first_week, last_week):
+    return db.session.query(
+        WeeklyUsage.key_id, WeeklyUsage.year_group, func.sum(WeeklyUsage.lessons), func.sum(WeeklyUsage.minutes)
+    ).filter(
+        WeeklyUsage.week_start.between(first_week, last_week), WeeklyUsage.kind == kind
+    ).group_by(WeeklyUsage.key_id, WeeklyUsage.year_group).all()
+
+
+class UsageReport:
+    """Room, teacher and subject usage between two dates, rounded out to whole weeks."""
+
+    def __init__(self, start_date, end_date):
+        self.first_week = week_start_of(start_date)
+        self.last_week = week_start_of(end_date)
+        self.end_date = self.last_week + timedelta(days=6)
+        self.weeks = (self.last_week - self.first_week).days // 7 + 1
+        ensure_usage(self.first_week, self.last_week)
+        self.rooms = self.room_rows()
+        self.teachers = self.teacher_rows()
+        self.year_groups, self.subjects = self.subject_rows()
+
+    def room_rows(self):
+        available = teaching_minutes_per_week() * self.weeks
+        used = {key_id: (lessons, minutes) for key_id, _, lessons, minutes in usage_totals('room', self.first_week, self.last_week)}
+        rows = []
+        for room in Room.query.order_by(Room.name):
+            lessons, minutes = used.get(room.id, (0, 0))
+            rows.append({'id': room.id, 'name': room.name, 'lessons': lessons, 'hours': round(minutes / 60, 1),
+                         'utilization': round(100 * minutes / available, 1) if available else 0.0})
+        # Busiest first, so over-used rooms lead and under-used ones trail
+        return sorted(rows, key=lambda row: (-row['utilization'], row['name']))
+
+    def teacher_rows(self):
+        taught = {key_id: (lessons, minutes) for key_id, _, lessons, minutes in usage_totals('teacher', self.first_week, self.last_week)}
+        rows = []
+        for teacher in User.query.filter_by(role='staff').order_by(User.username):
+            lessons, minutes = taught.get(teacher.id, (0, 0))
+            rows.append({'id': teacher.id, 'name': teacher.username, 'lessons': lessons, 'hours': round(minutes / 60, 1),
+                         'hours_per_week': round(minutes / 60 / self.weeks, 1)})
+        return sorted(rows, key=lambda row: (-row['hours'], row['name']))
+
+    def subject_rows(self):
+        counts = {}
+        year_groups = set()
+        for key_id, year_group, lessons, minutes in usage_totals('subject', self.first_week, self.last_week):
+            counts[(key_id, year_group)] = (lessons, minutes)
+            year_groups.add(year_group)
+        year_groups = sorted(year_groups, key=lambda year_group: (year_group == '', len(year_group), year_group))
+        rows = []
+        for subject in Subject.query.order_by(Subject.name):
+            lessons = {year_group: counts.get((subject.id, year_group), (0, 0))[0] for year_group in year_groups}
+            rows.append({'id': subject.id, 'name': subject.name, 'lessons': lessons, 'total': sum(lessons.values())})
+        return year_groups, rows
+
+    def csv_rows(self, report):
+        """Header and rows of one report ('rooms', 'teachers' or 'subjects') for CSV export."""
+        if report == 'rooms':
+            return ['room', 'lessons', 'hours', 'utilization_percent'], [
+                [row['name'], row['lessons'], row['hours'], row['utilization']] for row in self.rooms]
+        if report == 'teachers':
+            return ['teacher', 'lessons', 'hours', 'hours_per_week'], [
+                [row['name'], row['lessons'], row['hours'], row['hours_per_week']] for row in self.teachers]
+        return ['subject', 'year_group', 'lessons'], [
+            [row['name'], year_group or 'none', count]
+            for row in self.subjects for year_group, count in row['lessons'].items() if count]
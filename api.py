@@ -0,0 +1,361 @@
+import base64
+import hashlib
+import heapq
+import hmac
+import json
+from datetime import date as dt_date, datetime, time as dt_time, timedelta
+from flask import Blueprint, Response, current_app, request, session
+from sqlalchemy import exists, tuple_
+from werkzeug.http import is_resource_modified
+from models import db, User, Timetable, Subject, Room, AssignedSubject, RecurringLesson, user_timetable
+from recurring import expand_matching_lessons
+from feeds import timetable_version
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Read-only JSON API for the MIS and other integrations, under /api/v1.
+#
+# Every list is paged with an opaque keyset cursor: the next page starts after
+# the sort key of the last row sent, so each request reads at most one page
+# from the database however far into the list the client is. Entries are
+# ordered by (date, start time) with dated rows before recurring occurrences
+# at the same time; occurrences are expanded a week at a time from the cursor
+# onwards. ?fields= trims rows to the named fields, and responses carry an
+# ETag so a client polling for changes gets 304 Not Modified.
+#
+# Access is for admin sessions, or an "Authorization: Bearer <key>" header
+# with one of the keys in the API_KEYS setting.
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+DEFAULT_PAGE_SIZE = 100
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def json_response(payload, status=200, etag=None):
+    response = Response(dumps(payload), status=status, mimetype='application/json')
+    if etag:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def error(message, status):
+    return json_response({'error': message}, status)
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def body_etag_response(payload):
+    # For the small lookup lists: the ETag is a hash of the body
+    body = dumps(payload)
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def has_api_key():
+    """Whether the request carries one of the API_KEYS as a bearer token."""
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not key:
+        return False
+    return any(hmac.compare_digest(key.strip(), allowed) for allowed in current_app.config['API_KEYS'])
+
+
+@api.before_request
+def require_api_access():
+    if session.get('role') == 'admin' or has_api_key():
+        return None
+    return error('Unauthorized', 401)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def page_size():
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+def selected_fields(available, default):
+    names = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+    if not names:
+        return default
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(available)}")
+    return names
+
+
+def date_arg(name, required=False):
+    value = request.args.get(name)
+    if not value:
+        if required:
+            raise ValueError(f"{name} (YYYY-MM-DD) is required")
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f"{name} must be a date (YYYY-MM-DD)")
+
+
+def format_date(value):
+    return value.strftime('%Y-%m-%d') if value else None
+
+
+def format_time(value):
+    return value.strftime('%H:%M') if value else None
+
+
+USER_FIELDS = {
+    'id': lambda user: user.id,
+    'username': lambda user: user.username,
+    'role': lambda user: user.role,
+    'year_group': lambda user: user.year_group,
+}
+NAMED_FIELDS = {
+    'id': lambda row: row.id,
+    'name': lambda row: row.name,
+}
+ASSIGNMENT_FIELDS = {
+    'id': lambda assignment: assignment.id,
+    'user_id': lambda assignment: assignment.user_id,
+    'subject_id': lambda assignment: assignment.subject_id,
+}
+ENTRY_FIELDS = {
+    'id': lambda entry: entry.id,
+    'date': lambda entry: format_date(entry.date),
+    'start_time': lambda entry: format_time(entry.start_time),
+    'end_time': lambda entry: format_time(entry.end_time),
+    'subject': lambda entry: entry.subject,
+    'subject_id': lambda entry: entry.subject_id,
+    'teacher': lambda entry: entry.teacher,
+    'teacher_id': lambda entry: entry.teacher_id,
+    'room': lambda entry: entry.room,
+    'room_id': lambda entry: entry.room_id,
+    'is_substitute': lambda entry: bool(entry.is_substitute),
+    'is_free_day': lambda entry: bool(entry.is_free_day),
+    'is_recurring': lambda entry: entry.is_recurring,
+    'recurring_lesson_id': lambda entry: entry.lesson_id if entry.is_recurring else entry.recurring_lesson_id,
+    'occurrence_date': lambda entry: format_date(entry.date if entry.is_recurring else entry.occurrence_date),
+    'user_ids': None,  # Filled per page from one query; only sent when asked for
+}
+DEFAULT_ENTRY_FIELDS = [name for name in ENTRY_FIELDS if name != 'user_ids']
+LESSON_FIELDS = {
+    'id': lambda lesson: lesson.id,
+    'weekday': lambda lesson: lesson.weekday,
+    'week_parity': lambda lesson: lesson.week_parity,
+    'term_start': lambda lesson: format_date(lesson.term_start),
+    'term_end': lambda lesson: format_date(lesson.term_end),
+    'start_time': lambda lesson: format_time(lesson.start_time),
+    'end_time': lambda lesson: format_time(lesson.end_time),
+    'subject': lambda lesson: lesson.subject,
+    'subject_id': lambda lesson: lesson.subject_id,
+    'teacher': lambda lesson: lesson.teacher,
+    'teacher_id': lambda lesson: lesson.teacher_id,
+    'room': lambda lesson: lesson.room,
+    'room_id': lambda lesson: lesson.room_id,
+    'is_substitute': lambda lesson: bool(lesson.is_substitute),
+}
+
+
+def id_page(query, model, available, filters=()):
+    """One page of query ordered by id, with the rows trimmed to the selected fields."""
+    try:
+        fields = selected_fields(available, list(available))
+        cursor = request.args.get('cursor')
+        if cursor:
+            last_id, = decode_cursor(cursor)
+            query = query.filter(model.id > int(last_id))
+    except ValueError as e:
+        return error(str(e), 400)
+    for column, value in filters:
+        if value is not None:
+            query = query.filter(column == value)
+
+    limit = page_size()
+    rows = query.order_by(model.id).limit(limit + 1).all()
+    payload = {
+        'data': [{name: available[name](row) for name in fields} for row in rows[:limit]],
+        'next_cursor': encode_cursor([rows[limit - 1].id]) if len(rows) > limit else None
+    }
+    return body_etag_response(payload)
+
+
+@api.route('/users')
+def users():
+    query = db.session.query(User.id, User.username, User.role, User.year_group)
+    return id_page(query, User, USER_FIELDS, [
+        (User.role, request.args.get('role')),
+        (User.year_group, request.args.get('year_group')),
+    ])
+
+
+@api.route('/subjects')
+def subjects():
+    return id_page(db.session.query(Subject.id, Subject.name), Subject, NAMED_FIELDS)
+
+
+@api.route('/rooms')
+def rooms():
+    return id_page(db.session.query(Room.id, Room.name), Room, NAMED_FIELDS)
+
+
+@api.route('/assignments')
+def assignments():
+    query = db.session.query(AssignedSubject.id, AssignedSubject.user_id, AssignedSubject.subject_id)
+    return id_page(query, AssignedSubject, ASSIGNMENT_FIELDS, [
+        (AssignedSubject.user_id, request.args.get('user_id', type=int)),
+        (AssignedSubject.subject_id, request.args.get('subject_id', type=int)),
+    ])
+
+
+def entry_sort_key(entry):
+    # Dated rows (0) sort before recurring occurrences (1) that start at the same time
+    if entry.is_recurring:
+        return (entry.date, entry.start_time, 1, entry.lesson_id)
+    return (entry.date, entry.start_time, 0, entry.id)
+
+
+def entry_cursor(entry):
+    entry_date, start_time, kind, key = entry_sort_key(entry)
+    return encode_cursor([entry_date.isoformat(), start_time.isoformat(), kind, key])
+
+
+def parse_entry_cursor(cursor):
+    try:
+        entry_date, start_time, kind, key = decode_cursor(cursor)
+        return (dt_date.fromisoformat(entry_date), dt_time.fromisoformat(start_time), int(kind), int(key))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def entry_filters(args):
+    """Criteria for dated entries and for recurring lessons, and the user ids to hide free days for."""
+    entry_criteria, lesson_criteria, user_ids = [], [], None
+    user_id = args.get('user_id', type=int)
+    if user_id is not None:
+        entry_criteria.append(Timetable.users.any(User.id == user_id))
+        lesson_criteria.append(RecurringLesson.users.any(User.id == user_id))
+        user_ids = {user_id}
+    for name in ('teacher_id', 'room_id', 'subject_id'):
+        value = args.get(name, type=int)
+        if value is not None:
+            entry_criteria.append(getattr(Timetable, name) == value)
+            lesson_criteria.append(getattr(RecurringLesson, name) == value)
+    return entry_criteria, lesson_criteria, user_ids
+
+
+def entries_after(after, start_date, end_date, entry_criteria, lesson_criteria, user_ids, count):
+    """Up to count entries and occurrences sorting after the cursor key, read a week at a time."""
+    found = []
+    window_start = max(start_date, after[0]) if after else start_date
+    while window_start <= end_date and len(found) < count:
+        window_end = min(end_date, window_start + timedelta(days=6))
+        # Cancelled recurring occurrences are rows without users, so they are not entries
+        booked = exists().where(user_timetable.c.timetable_id == Timetable.id)
+        query = Timetable.query.filter(*entry_criteria, Timetable.date.between(window_start, window_end), booked)
+        if after:
+            after_date, after_time, kind, key = after
+            if kind == 0:
+                query = query.filter(tuple_(Timetable.date, Timetable.start_time, Timetable.id) > tuple_(after_date, after_time, key))
+            else:
+                query = query.filter(tuple_(Timetable.date, Timetable.start_time) > tuple_(after_date, after_time))
+        dated = query.order_by(Timetable.date, Timetable.start_time, Timetable.id).limit(count - len(found)).all()
+
+        occurrences = expand_matching_lessons(lesson_criteria, window_start, window_end, user_ids)
+        if after:
+            occurrences = [occurrence for occurrence in occurrences if entry_sort_key(occurrence) > after]
+        occurrences.sort(key=entry_sort_key)
+
+        for entry in heapq.merge(dated, occurrences, key=entry_sort_key):
+            found.append(entry)
+            if len(found) == count:
+                break
+        window_start = window_end + timedelta(days=1)
+    return found
+
+
+def entry_user_ids(entries):
+    dated_ids = [entry.id for entry in entries if not entry.is_recurring]
+    members = {}
+    if dated_ids:
+        rows = db.session.query(user_timetable.c.timetable_id, user_timetable.c.user_id).filter(
+            user_timetable.c.timetable_id.in_(dated_ids)
+        ).order_by(user_timetable.c.user_id)
+        for timetable_id, user_id in rows:
+            members.setdefault(timetable_id, []).append(user_id)
+    return {
+        entry.id: sorted(user.id for user in entry.users) if entry.is_recurring else members.get(entry.id, [])
+        for entry in entries
+    }
+
+
+@api.route('/entries')
+def entries():
+    """Timetable entries and recurring occurrences between start and end, optionally for one
+    user, teacher, room or subject."""
+    try:
+        start_date = date_arg('start', required=True)
+        end_date = date_arg('end', required=True)
+        if end_date < start_date:
+            raise ValueError('end must be on or after start')
+        fields = selected_fields(ENTRY_FIELDS, DEFAULT_ENTRY_FIELDS)
+        cursor = request.args.get('cursor')
+        after = parse_entry_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return error(str(e), 400)
+
+    # Any change to any timetable moves the version, so a poll that finds nothing
+    # new is answered without reading the entries at all
+    version = json.dumps([str(value) for value in timetable_version()] + [request.query_string.decode()])
+    etag = hashlib.sha256(version.encode()).hexdigest()[:32]
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+
+    limit = page_size()
+    entry_criteria, lesson_criteria, user_ids = entry_filters(request.args)
+    found = entries_after(after, start_date, end_date, entry_criteria, lesson_criteria, user_ids, limit + 1)
+    page = found[:limit]
+    members = entry_user_ids(page) if 'user_ids' in fields else {}
+    data = []
+    for entry in page:
+        row = {name: ENTRY_FIELDS[name](entry) for name in fields if name != 'user_ids'}
+        if 'user_ids' in fields:
+            row['user_ids'] = members[entry.id]
+        data.append(row)
+    return json_response({
+        'data': data,
+        'next_cursor': entry_cursor(page[-1]) if len(found) > limit else None
+    }, etag=etag)
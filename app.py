@@ -1,21 +1,115 @@
+import csv
+import hashlib
+import io
+import json
 import os
+import time
+import uuid
+import click
 from datetime import datetime, timedelta
-from flask import Flask, jsonify, render_template, request, redirect, url_for, session, flash
+from flask import Flask, Response, jsonify, render_template, request, redirect, url_for, session, flash, stream_with_context, stream_template
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Timetable, SchoolSettings, Room, Subject, AssignedSubject, user_timetable, Note
+from werkzeug.http import is_resource_modified
+from werkzeug.security import generate_password_hash
+from models import db, User, Timetable, SchoolSettings, Room, Subject, AssignedSubject, user_timetable, Note, RecurringLesson, SubjectRequirement, TeacherUnavailability, Job, SchoolTerm, SchoolHoliday
+from recurring import expand_lessons, merge_entries, iter_user_entries, lesson_dates, materialize_occurrence, is_occurrence_key, parse_occurrence_key, delete_lesson_series
+from school_calendar import school_calendar, calendar_changed, WEEK_LABELS, MAX_CYCLE_WEEKS
+from migrations import run_migrations
+from bulk import assign_users_bulk, subject_user_ids, year_group_user_ids, all_user_ids
+from sqlite_tuning import enable_sqlite_profile
+from week_cache import create_week_cache, week_key
+from generator import generate_timetable, resolve_generated_term, generated_terms
+from clashes import find_clashes, scan_for_clashes
+from importer import import_file, KINDS as IMPORT_KINDS
+from feeds import feed_token_for, reset_feed_token, mark_timetables_changed, feed_range, feed_version, timetable_version, ics_feed, json_feed
+from reference_data import build_reference_data
+from entry_names import rename_references, detach_references
+from week_grid import week_days, weeks_in_range, week_number
+from substitutes import find_substitutes, plan_cover, apply_cover
+from api import api, has_api_key, ENTRY_FIELDS, DEFAULT_ENTRY_FIELDS, LESSON_FIELDS
+from passwords import create_password_verifier, PasswordCheckBusy
+from request_metrics import enable_request_metrics
+from synthetic_school import SIZES, SchoolSize, generate_school
+from server_sessions import configure_sessions
+from live_updates import create_live_updates
+from jobs import create_job_queue, job_dict, is_lock_error
+from changelog import change_key, log_changes, latest_seq, changes_since, resolve_changes, compact_changes
+from analytics import REPORTS as ANALYTICS_REPORTS, UsageReport, refresh_weeks, forget_usage, timetable_span, rebuild_usage
 
 app = Flask(__name__)
 
 os.makedirs("instance", exist_ok=True)
 
-# Configure SQLite database (inside instance/)
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{app.instance_path}/timetable.db"
+# Configure SQLite database (inside instance/); DATABASE_URL points the app at another one, e.g. a synthetic school
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', f"sqlite:///{app.instance_path}/timetable.db")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'default_secret_key')
+# Sessions live in the signed cookie ('cookie'), or server side in instance/ ('sqlite' or 'filesystem', or SESSION_PATH)
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'cookie')
+app.config['SESSION_PATH'] = os.environ.get('SESSION_PATH')
+# Set SQLITE_PERFORMANCE_PROFILE=1 to enable WAL, mmap and a larger page cache
+app.config['SQLITE_PERFORMANCE_PROFILE'] = os.environ.get('SQLITE_PERFORMANCE_PROFILE') == '1'
+# Rendered week cache: 'memory' (per process), 'sqlite' (shared file in instance/) or 'none'
+app.config['WEEK_CACHE_BACKEND'] = os.environ.get('WEEK_CACHE_BACKEND', 'memory')
+app.config['WEEK_CACHE_TTL'] = int(os.environ.get('WEEK_CACHE_TTL', 300))
+# Double bookings of teachers, rooms or users: 'reject' the write, or save it and 'warn'
+app.config['CLASH_POLICY'] = os.environ.get('CLASH_POLICY', 'reject')
+# Calendar feeds cover this many weeks before and after the current week
+app.config['FEED_WEEKS_BEFORE'] = int(os.environ.get('FEED_WEEKS_BEFORE', 2))
+app.config['FEED_WEEKS_AFTER'] = int(os.environ.get('FEED_WEEKS_AFTER', 12))
+# Longest range /timetable/range will show at once
+app.config['RANGE_MAX_WEEKS'] = int(os.environ.get('RANGE_MAX_WEEKS', 53))
+# Bearer keys accepted by the read-only /api/v1 (comma separated); admin sessions can use it too
+app.config['API_KEYS'] = [key.strip() for key in os.environ.get('API_KEYS', '').split(',') if key.strip()]
+app.config['API_MAX_PAGE_SIZE'] = int(os.environ.get('API_MAX_PAGE_SIZE', 1000))
+# The change log behind /changes is compacted every this many rows; changes older than the retention are dropped
+app.config['CHANGE_LOG_COMPACT_EVERY'] = int(os.environ.get('CHANGE_LOG_COMPACT_EVERY', 10000))
+app.config['CHANGE_LOG_RETENTION_DAYS'] = int(os.environ.get('CHANGE_LOG_RETENTION_DAYS', 30))
+# Live updates on /timetable: each open stream or long poll holds a server thread, so at most this many per process
+# (raise it with an async worker); other writers' changes are picked up every LIVE_POLL_SECONDS, streams send a
+# keep-alive every LIVE_HEARTBEAT_SECONDS and end after LIVE_STREAM_SECONDS, when the browser reconnects
+app.config['LIVE_MAX_CONNECTIONS'] = int(os.environ.get('LIVE_MAX_CONNECTIONS', 8))
+app.config['LIVE_POLL_SECONDS'] = float(os.environ.get('LIVE_POLL_SECONDS', 2))
+app.config['LIVE_HEARTBEAT_SECONDS'] = int(os.environ.get('LIVE_HEARTBEAT_SECONDS', 15))
+app.config['LIVE_STREAM_SECONDS'] = int(os.environ.get('LIVE_STREAM_SECONDS', 300))
+app.config['LIVE_MAX_WAIT_SECONDS'] = int(os.environ.get('LIVE_MAX_WAIT_SECONDS', 25))
+# Background jobs: worker processes the app starts when it first queues one (0 = run `flask run-jobs` beside the
+# server instead), how often idle workers look for work, tries for jobs that find the database locked, and how long
+# a running job may go without a heartbeat before it is given to another worker
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 1))
+app.config['JOB_POLL_SECONDS'] = float(os.environ.get('JOB_POLL_SECONDS', 1))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_STALE_SECONDS'] = int(os.environ.get('JOB_STALE_SECONDS', 300))
+app.config['UPLOAD_DIR'] = os.environ.get('UPLOAD_DIR', os.path.join(app.instance_path, 'uploads'))
+# Login password checks run in a pool of this many threads; logins beyond the queue limit get a 503
+app.config['PASSWORD_CHECK_WORKERS'] = int(os.environ.get('PASSWORD_CHECK_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_CHECK_QUEUE'] = int(os.environ.get('PASSWORD_CHECK_QUEUE', 64))
+# Set METRICS_ENABLED=1 to time requests, SQL and templates per endpoint and serve them at /metrics
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1'
+# Statements slower than this are logged with their parameters, to SLOW_QUERY_LOG if set
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG')
 
 # Initialize database
 db.init_app(app)
+app.register_blueprint(api)
+configure_sessions(app)
+
+if app.config['SQLITE_PERFORMANCE_PROFILE']:
+    with app.app_context():
+        enable_sqlite_profile(db.engine)
+
+request_metrics = None
+if app.config['METRICS_ENABLED']:
+    with app.app_context():
+        request_metrics = enable_request_metrics(app, db.engine)
+
+week_cache = create_week_cache(app)
+password_verifier = create_password_verifier(app)
+# Pages cached in this process's memory are dropped when the change log shows another process (a job worker,
+# another server process) changed them
+live_updates = create_live_updates(app, week_cache.invalidate if app.config['WEEK_CACHE_BACKEND'] == 'memory' else None)
+job_queue = create_job_queue(app, 'app:job_queue')
 
 def initialize_school_settings():
     settings = SchoolSettings.query.first()
@@ -33,6 +127,190 @@ def create_default_admin():
         db.session.commit()
         print("Default admin account created! (Username: admin, Password: admin123)")
 
+def init_database():
+    db.create_all()
+    run_migrations(db)
+    create_default_admin()
+    initialize_school_settings()
+
+def week_start_of(day):
+    return day - timedelta(days=day.weekday())
+
+def invalidate_weeks(user_ids, *dates, changed=()):
+    # Drop cached weeks containing the given dates (every week if none given); user_ids=None means all users.
+    # Also moves the users' change stamp, which the calendar feeds use for ETag and Last-Modified,
+    # brings the analytics for those weeks up to date and logs the changed entry keys for /changes
+    # and the live updates on open timetable pages (user_ids=None logs a resync for everyone).
+    # Only for writes that change lessons: with no dates the analytics of every week are recomputed.
+    mark_timetables_changed(user_ids)
+    log_changes(user_ids, changed, app.config['CHANGE_LOG_COMPACT_EVERY'], app.config['CHANGE_LOG_RETENTION_DAYS'])
+    live_updates.notify()
+    if not dates:
+        week_cache.invalidate(user_ids)
+        forget_usage()
+    for day in dates:
+        week_cache.invalidate(user_ids, week_start_of(day))
+    refresh_weeks(week_start_of(day) for day in dates)
+
+def entry_dates(entry):
+    # Recurring lessons appear in every week of their term
+    return () if isinstance(entry, RecurringLesson) else (entry.date,)
+
+def entry_user_ids(entry):
+    return [user.id for user in entry.users]
+
+def new_lesson_entry(date, subject, teacher, start_time, end_time, room, is_substitute, repeat_until=None, week_parity=None):
+    # A "repeat until" date (YYYY-MM-DD) turns the lesson into a weekly recurring lesson instead of a single entry
+    references = dict(
+        subject=subject.name, subject_id=subject.id,
+        teacher=teacher.username, teacher_id=teacher.id,
+        room=room.name, room_id=room.id
+    )
+    if repeat_until:
+        return RecurringLesson(
+            term_start=date,
+            term_end=datetime.strptime(repeat_until, '%Y-%m-%d').date(),
+            start_time=start_time,
+            end_time=end_time,
+            is_substitute=is_substitute,
+            week_parity=week_parity,
+            **references
+        )
+    return Timetable(
+        date=date,
+        start_time=start_time,
+        end_time=end_time,
+        is_substitute=is_substitute,
+        **references
+    )
+
+def lesson_clashes(date, start_time, end_time, teacher_id, room_id, user_ids, repeat_until=None, week_parity=None,
+                   allow_clash=False, exclude_entry_id=None):
+    # The double bookings a lesson would make, and whether the write should be refused because of them
+    clashes = find_clashes(
+        date, start_time, end_time, teacher_id=teacher_id, room_id=room_id, user_ids=user_ids,
+        repeat_until=datetime.strptime(repeat_until, '%Y-%m-%d').date() if repeat_until else None,
+        week_parity=week_parity,
+        exclude_entry_id=exclude_entry_id
+    )
+    return clashes, bool(clashes) and app.config['CLASH_POLICY'] == 'reject' and not allow_clash
+
+def clashes_block_write(date, start_time, end_time, teacher_id, room_id, user_ids, exclude_entry_id=None):
+    # Flash any double bookings; returns True when the write should not go ahead
+    clashes, reject = lesson_clashes(date, start_time, end_time, teacher_id, room_id, user_ids,
+                                     request.form.get("repeat_until"), request.form.get("week_parity"),
+                                     'allow_clash' in request.form, exclude_entry_id)
+    if not clashes:
+        return False
+    for clash in clashes:
+        flash(str(clash), "danger" if reject else "warning")
+    if reject:
+        flash("Entry not saved. Tick 'Allow double booking' to save it anyway.", "danger")
+    return reject
+
+def add_free_day(date, message, scope, user_id=None, subject_id=None, year_group=None):
+    # A special timetable entry for the free day, for one user, a subject's users, a year group or everyone
+    free_day_entry = Timetable(
+        date=date,
+        subject=message,  # Use subject field to store the message
+        teacher="N/A",
+        start_time=datetime.strptime('00:00', '%H:%M').time(),
+        end_time=datetime.strptime('23:59', '%H:%M').time(),
+        room="N/A",
+        is_substitute=False
+    )
+    free_day_entry.is_free_day = True
+    db.session.add(free_day_entry)
+
+    if scope == "user":
+        free_day_entry.users.append(User.query.get(user_id))
+        affected_user_ids = [user_id]
+    elif scope == "subject":
+        assign_users_bulk(free_day_entry, subject_user_ids(subject_id))
+        affected_user_ids = db.session.execute(subject_user_ids(subject_id)).scalars().all()
+    elif scope == "year_group":
+        assign_users_bulk(free_day_entry, year_group_user_ids(year_group))
+        affected_user_ids = db.session.execute(year_group_user_ids(year_group)).scalars().all()
+    else:
+        assign_users_bulk(free_day_entry, all_user_ids())
+        affected_user_ids = None
+
+    db.session.commit()
+    invalidate_weeks(affected_user_ids, date, changed=[change_key(free_day_entry)])
+    return free_day_entry
+
+# Background jobs (jobs.py) for the admin operations that write for many users at once
+
+@job_queue.kind('set_free_day')
+def set_free_day_job(context, date, message, scope, **target):
+    date = datetime.strptime(date, '%Y-%m-%d').date()
+    context.progress(0, 1, f"Setting a free day on {date.strftime('%Y-%m-%d')}")
+    add_free_day(date, message, scope, **target)
+    return {'message': f"Free day set for {date.strftime('%Y-%m-%d')}"}
+
+@job_queue.kind('add_group_lesson')
+def add_group_lesson_job(context, date, start_time, end_time, subject_id, teacher_id, room_id, is_substitute,
+                         repeat_until, week_parity, allow_clash, original_subject_id=None, year_group=None):
+    # One lesson for everyone assigned to a subject (original_subject_id) or in a year group
+    if year_group is None:
+        original_subject = Subject.query.get(original_subject_id)
+        user_ids = subject_user_ids(original_subject_id)
+        description = f"all assigned users of '{original_subject.name if original_subject else original_subject_id}'"
+    else:
+        user_ids, description = year_group_user_ids(year_group), f"all users in year group '{year_group}'"
+    subject, teacher, room = Subject.query.get(subject_id), User.query.get(teacher_id), Room.query.get(room_id)
+    if not subject or not teacher or not room:
+        raise ValueError("The subject, teacher or room no longer exists.")
+    date = datetime.strptime(date, '%Y-%m-%d').date()
+    start_time = datetime.strptime(start_time, '%H:%M').time()
+    end_time = datetime.strptime(end_time, '%H:%M').time()
+
+    context.progress(0, 2, "Checking for double bookings")
+    clashes, reject = lesson_clashes(date, start_time, end_time, teacher.id, room.id, user_ids,
+                                     repeat_until, week_parity, allow_clash)
+    if reject:
+        raise ValueError("Entry not saved, it would double-book: " + "; ".join(str(clash) for clash in clashes[:10]))
+    context.progress(1, 2, "Adding the lesson")
+    new_entry = new_lesson_entry(date, subject, teacher, start_time, end_time, room, is_substitute, repeat_until, week_parity)
+    db.session.add(new_entry)
+    assign_users_bulk(new_entry, user_ids)
+    db.session.commit()
+    invalidate_weeks(db.session.execute(user_ids).scalars().all(), *entry_dates(new_entry), changed=[change_key(new_entry)])
+    return {'message': f"Timetable entry added for {description}.", 'warnings': [str(clash) for clash in clashes]}
+
+@job_queue.kind('import_file')
+def import_file_job(context, path, filename, kind, allow_clashes, workers=None):
+    # path is the upload saved under UPLOAD_DIR; it is removed once the import has finished.
+    # workers: password hashing threads (default: one per CPU)
+    def progress(report):
+        context.progress(report.rows, message=f"{report.kind}: {report.rows} rows processed, {report.created} created")
+
+    try:
+        with open(path, 'rb') as stream:
+            reports = import_file(stream, filename, kind, workers=workers, allow_clashes=allow_clashes, progress=progress)
+    except Exception as e:
+        if not is_lock_error(e):  # Kept for the retry
+            os.remove(path)
+        raise
+    finally:
+        invalidate_weeks(None)
+    os.remove(path)
+    return {
+        'message': " ".join(report.summary() for report in reports),
+        'reports': [{'summary': report.summary(), 'errors': report.errors, 'error_count': report.error_count}
+                    for report in reports],
+    }
+
+@job_queue.kind('generate_timetable')
+def generate_timetable_job(context, term_start, term_end, cycle_weeks, max_class_size, time_limit, seed):
+    context.progress(0, 1, "Generating the timetable")
+    report = generate_timetable(datetime.strptime(term_start, '%Y-%m-%d').date(),
+                                datetime.strptime(term_end, '%Y-%m-%d').date(),
+                                cycle_weeks, max_class_size, time_limit, seed,
+                                reject_clashes=app.config['CLASH_POLICY'] == 'reject')
+    invalidate_weeks(None)
+    return {'message': f"Wrote {report.lessons_written} recurring lessons.", 'warnings': report.problems}
+
 # Route for home page
 @app.route('/')
 def home():
@@ -47,7 +325,13 @@ def login():
 
         user = User.query.filter_by(username=username).first()
 
-        if user and check_password_hash(user.password, password):
+        try:
+            valid = bool(user) and password_verifier.verify(user.password, password)
+        except PasswordCheckBusy:
+            return render_template('login.html', error="Too many people are logging in right now. Please try again in a moment."), 503, {'Retry-After': '5'}
+
+        if valid:
+            session.clear()  # Start a fresh session, so nothing from before login carries over
             session['user_id'] = user.id
             session['role'] = user.role  # Store role in session
             flash("Login successful!", "success")
@@ -74,49 +358,93 @@ def dashboard():
         return redirect(url_for('login'))  
     return render_template('dashboard.html', role=session['role'])
 
-def display_timetable(user, week=None, permission_level=None):
-    if not week:
-        today = datetime.today()
-        # Fix: Adjust the week start calculation to include Mondays
-        week_start = (today - timedelta(days=today.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
-    else:
-        week_start = week
+def week_entries(user_filter, week_start, week_end, with_users=False):
+    # Notes (and assignees for admin views) are loaded with the entries so rendering
+    # a week costs a fixed number of queries rather than one per entry
+    options = [db.joinedload(Timetable.note)]
+    if with_users:
+        options.append(db.selectinload(Timetable.users))
+    return Timetable.query.options(*options).filter(
+        user_filter,
+        Timetable.date.between(week_start.date(), week_end.date())
+    ).order_by(Timetable.date, Timetable.start_time).all()
 
-    # Fix: Adjust week end to be inclusive
-    week_end = (week_start + timedelta(days=6)).replace(hour=23, minute=59, second=59, microsecond=999999)
-    week_range = f"{week_start.strftime('%a %d/%m')} - {week_end.strftime('%a %d/%m')}"
+def requested_week_start():
+    # ?week=YYYY-MM-DD (any day of that week) picks the week, so week pages can be bookmarked; default is this week
+    try:
+        day = datetime.strptime(request.args['week'], '%Y-%m-%d')
+    except (KeyError, ValueError):
+        day = datetime.today()
+    return (day - timedelta(days=day.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+
+SELECTION_ARGS = ('user_id', 'subject_id', 'year_group')
+
+def admin_selection(**overrides):
+    # The admin timetable's week and selected user, subject or year group live in its URL, so every tab keeps its own
+    selection = {name: request.args.get(name) for name in ('week',) + SELECTION_ARGS if request.args.get(name)}
+    selection.update(overrides)
+    return selection
 
-    # If user is staff, allow them to view other students' timetables
+def admin_timetable_url(**overrides):
+    # Back to the view the admin was on (forms post to the page URL, which carries the selection and ?week=)
+    return url_for('admin_timetable', **admin_selection(**overrides))
+
+def viewed_user(user, permission_level):
+    # Staff can view a student's timetable with ?student_id=
     if permission_level == 'staff':
         student_id = request.args.get('student_id')
         if student_id:
             selected_user = User.query.get(student_id)
             if selected_user and selected_user.role == 'student':
-                user = selected_user
+                return selected_user
+    return user
+
+def display_timetable(user, week=None, permission_level=None):
+    week_start = week or requested_week_start()
+
+    # Fix: Adjust week end to be inclusive
+    week_end = (week_start + timedelta(days=6)).replace(hour=23, minute=59, second=59, microsecond=999999)
+    week_range = f"{week_start.strftime('%a %d/%m')} - {week_end.strftime('%a %d/%m')}"
+
+    user = viewed_user(user, permission_level)
+
+    cache_key = week_key(user.id, week_start.date(), permission_level)
+    cached_page = week_cache.get(cache_key)
+    if cached_page is not None:
+        return cached_page
 
     # Fix: Use between for inclusive date range
-    timetable_entries = Timetable.query.filter(
-        Timetable.users.any(id=user.id),
-        Timetable.date.between(week_start.date(), week_end.date())
-    ).order_by(Timetable.date, Timetable.start_time).all()
+    calendar = school_calendar()
+    timetable_entries = week_entries(Timetable.users.any(id=user.id), week_start, week_end)
+    timetable_entries = merge_entries(timetable_entries, expand_lessons([user.id], week_start.date(), week_end.date(), calendar))
 
     # Get list of students for staff members
     students = []
     if permission_level == 'staff':
         students = User.query.filter_by(role='student').all()
 
-    return render_template(
+    page = render_template(
         'timetable.html', 
         timetable=timetable_entries, 
+        days=week_days(timetable_entries, week_start, calendar),
+        calendar=calendar,
         week_range=week_range, 
         permission_level=permission_level,
         week_start=week_start,
-        timedelta=timedelta,
+        previous_week=(week_start - timedelta(weeks=1)).strftime('%Y-%m-%d'),
+        next_week=(week_start + timedelta(weeks=1)).strftime('%Y-%m-%d'),
         students=students,
-        current_user=user
+        current_user=user,
+        change_seq=latest_seq(),  # Live updates pick up from here
+        # Only the user's own page shows their secret feed links
+        feed_token=feed_token_for(user) if user.id == session.get('user_id') else None
     )
+    if live_updates.on_change:
+        live_updates.start()
+    week_cache.set(cache_key, page)
+    return page
 
-@app.route('/timetable', methods=['GET', 'POST'])
+@app.route('/timetable')
 def timetable():
     if 'user_id' not in session:
         flash("Please log in to view your timetable.", "warning")
@@ -124,20 +452,106 @@ def timetable():
 
     user_id = session['user_id']
     user = User.query.get(user_id)
+    week_start = requested_week_start()
+
+    # The page is fully described by its URL, the viewer and the timetable version, so browsers can revalidate it
+    etag = hashlib.sha256(repr((
+        timetable_version(), user_id, session['role'], request.args.get('student_id'), week_start
+    )).encode()).hexdigest()[:32]
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    else:
+        response = app.make_response(display_timetable(user, week_start, session['role']))
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def requested_range():
+    # ?start= and ?end= (YYYY-MM-DD), or ?start= and ?weeks=N; start defaults to this week
+    try:
+        start_date = requested_week_start().date()
+        if request.args.get('start'):
+            start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else None
+        weeks = int(request.args.get('weeks') or 4)
+    except ValueError:
+        raise ValueError("Dates must be YYYY-MM-DD and weeks a whole number.")
+    if end_date is None:
+        if weeks < 1:
+            raise ValueError("Show at least one week.")
+        end_date = start_date - timedelta(days=start_date.weekday()) + timedelta(weeks=weeks, days=-1)
+    if end_date < start_date:
+        raise ValueError("The end date must not be before the start date.")
+    if (end_date - start_date).days >= app.config['RANGE_MAX_WEEKS'] * 7:
+        raise ValueError(f"Show at most {app.config['RANGE_MAX_WEEKS']} weeks at once.")
+    return start_date, end_date
+
+@app.route('/timetable/range')
+def timetable_range():
+    if 'user_id' not in session:
+        flash("Please log in to view your timetable.", "warning")
+        return redirect(url_for('login'))
 
-    # Ensure week_offset exists in session
-    if "week_offset" not in session:
-        session["week_offset"] = 0
-
-    # Handle week navigation
-    if request.method == "POST" and "week_change" in request.form:
-        session["week_offset"] += int(request.form["week_change"])
+    user = viewed_user(User.query.get(session['user_id']), session['role'])
+    context = dict(terms=generated_terms(), permission_level=session['role'], current_user=user)
+    try:
+        start_date, end_date = requested_range()
+    except ValueError as e:
+        return render_template('timetable_range.html', error=str(e), weeks=[], **context), 400
+
+    # One query for the whole range; each week is rendered and sent as the entries are read
+    calendar = school_calendar()
+    entries = iter_user_entries(user.id, start_date, end_date, calendar)
+    return stream_template(
+        'timetable_range.html',
+        weeks=weeks_in_range(entries, start_date, end_date, calendar),
+        calendar=calendar,
+        start_date=start_date,
+        end_date=end_date,
+        **context
+    )
 
-    today = datetime.today()
-    # Fix: Adjust week start calculation
-    week_start = (today - timedelta(days=today.weekday())).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(weeks=session["week_offset"])
+@app.route('/feed/reset', methods=['POST'])
+def reset_feed():
+    if 'user_id' not in session:
+        flash("Please log in to view your timetable.", "warning")
+        return redirect(url_for('login'))
 
-    return display_timetable(user, week_start, session['role'])
+    user = User.query.get(session['user_id'])
+    reset_feed_token(user)
+    # No lesson changed: only the feed's ETag and the cached pages showing the old links
+    mark_timetables_changed([user.id])
+    week_cache.invalidate([user.id])
+    flash("Calendar feed links reset. Update any calendar apps using the old link.", "info")
+    return redirect(url_for('timetable'))
+
+def timetable_feed(token, feed_format):
+    user = User.query.filter_by(feed_token=token).first_or_404()
+    start_date, end_date = feed_range(app.config['FEED_WEEKS_BEFORE'], app.config['FEED_WEEKS_AFTER'])
+    etag, last_modified = feed_version(user, start_date, end_date, feed_format)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    elif feed_format == 'ics':
+        response = Response(stream_with_context(ics_feed(user, start_date, end_date, last_modified)),
+                            mimetype='text/calendar')
+    else:
+        response = Response(stream_with_context(json_feed(user, start_date, end_date, last_modified)),
+                            mimetype='application/json')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/feed/<token>.ics')
+def calendar_feed(token):
+    return timetable_feed(token, 'ics')
+
+@app.route('/feed/<token>.json')
+def calendar_feed_json(token):
+    return timetable_feed(token, 'json')
 
 @app.route('/delete_timetable/<int:id>', methods=['POST'])
 def delete_timetable(id):
@@ -149,13 +563,15 @@ def delete_timetable(id):
 
     # Allow deletion if the user is an admin
     if session['role'] == "admin":
+        affected_user_ids, date = entry_user_ids(entry), entry.date
         db.session.delete(entry)
         db.session.commit()
+        invalidate_weeks(affected_user_ids, date, changed=[str(id)])
         flash("Timetable entry deleted.", "info")
     else:
         flash("You do not have permission to delete this entry.", "danger")
 
-    return redirect(url_for('admin_timetable'))
+    return redirect(admin_timetable_url())
 
 @app.route('/admin', methods=['GET', 'POST'])
 def admin():
@@ -180,6 +596,7 @@ def admin():
                 new_user = User(username=username, password=hashed_password, role=role, year_group=year_group)
                 db.session.add(new_user)
                 db.session.commit()
+                week_cache.clear()  # Staff pages list every student
                 flash(f"User '{username}' created successfully!", "success")
 
         elif action == "change_password":
@@ -199,14 +616,35 @@ def admin():
 
             user = User.query.get(user_id)
             if user:
+                detach_references('teacher', user.id)
                 db.session.delete(user)
                 db.session.commit()
+                week_cache.clear()
                 flash(f"User '{user.username}' deleted!", "info")
             else:
                 flash("User not found!", "danger")
 
+        elif action == "import_file":
+            # Saved for a background job to import; its report shows in the jobs panel
+            upload = request.files.get('file')
+            extension = os.path.splitext(upload.filename)[1].lower() if upload and upload.filename else None
+            if not extension:
+                flash("Choose a file to import.", "danger")
+            elif extension not in ('.csv', '.xlsx', '.xlsm'):
+                flash("Only .csv and .xlsx files can be imported.", "danger")
+            else:
+                os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
+                path = os.path.join(app.config['UPLOAD_DIR'], f"{uuid.uuid4().hex}{extension}")
+                upload.save(path)
+                job = job_queue.submit('import_file', dict(
+                    path=path, filename=upload.filename, kind=request.form['kind'],
+                    allow_clashes='allow_clash' in request.form
+                ), session['user_id'], f"Importing {upload.filename}")
+                flash(f"Importing {upload.filename} in the background (job {job.id}).", "info")
+            return redirect(url_for('admin'))
+
     users = User.query.filter(User.role != "admin").all()  # Exclude admin from list
-    return render_template('admin.html', users=users)
+    return render_template('admin.html', users=users, import_kinds=IMPORT_KINDS)
 
 @app.route('/admin_timetable', methods=['GET', 'POST'])
 def admin_timetable():
@@ -217,7 +655,9 @@ def admin_timetable():
     users = User.query.filter(User.role != "admin").all()
     staff_users = User.query.filter_by(role="staff").all()
     rooms = Room.query.all()
-    subjects = Subject.query.all()
+    subjects = Subject.query.options(
+        db.selectinload(Subject.assigned_users).joinedload(AssignedSubject.user)
+    ).all()
     year_groups = db.session.query(User.year_group).distinct().all()
     year_groups = [yg[0] for yg in year_groups if yg[0] is not None]
     selected_user = None
@@ -228,65 +668,52 @@ def admin_timetable():
     subject_assignees = []
     year_group_users = []
 
-    # Ensure the week_offset exists in session
-    if "week_offset" not in session:
-        session["week_offset"] = 0
-
-    # Handle week navigation without losing the selected user, subject, or year group
-    if request.method == "POST":
-        if "week_change" in request.form:
-            session["week_offset"] += int(request.form["week_change"])
-        elif "user_id" in request.form:
-            session["selected_user_id"] = request.form["user_id"]
-            session.pop("selected_subject_id", None)  # Clear selected subject
-            session.pop("selected_year_group", None)  # Clear selected year group
-        elif "subject_id" in request.form:
-            session["selected_subject_id"] = request.form["subject_id"]
-            session.pop("selected_user_id", None)  # Clear selected user
-            session.pop("selected_year_group", None)  # Clear selected year group
-        elif "year_group" in request.form:
-            session["selected_year_group"] = request.form["year_group"]
-            session.pop("selected_user_id", None)  # Clear selected user
-            session.pop("selected_subject_id", None)  # Clear selected subject
-
-    # Ensure selected user, subject, or year group is persisted across week changes
-    if "selected_user_id" in session:
-        selected_user = User.query.get(session["selected_user_id"])
+    # A selection posted without an action (older links and forms) becomes the equivalent URL
+    if request.method == "POST" and "action" not in request.form:
+        for name in SELECTION_ARGS:
+            if request.form.get(name):
+                return redirect(url_for('admin_timetable', week=request.args.get('week'), **{name: request.form[name]}))
+
+    # The selected user, subject or year group comes from ?user_id=, ?subject_id= or ?year_group=; the week from ?week=
+    if request.args.get("user_id"):
+        user_id = request.args.get("user_id", type=int)
+        selected_user = User.query.get(user_id) if user_id else None
         if selected_user:
-            assigned_subjects = AssignedSubject.query.filter_by(user_id=selected_user.id).all()
-    elif "selected_subject_id" in session:
-        selected_subject = Subject.query.get(session["selected_subject_id"])
+            assigned_subjects = AssignedSubject.query.options(
+                db.joinedload(AssignedSubject.subject)
+            ).filter_by(user_id=selected_user.id).all()
+    elif request.args.get("subject_id"):
+        subject_id = request.args.get("subject_id", type=int)
+        selected_subject = Subject.query.get(subject_id) if subject_id else None
         if selected_subject:
             subject_assignees = AssignedSubject.query.filter_by(subject_id=selected_subject.id).all()
-    elif "selected_year_group" in session:
-        selected_year_group = session["selected_year_group"]
+    elif request.args.get("year_group"):
+        selected_year_group = request.args["year_group"]
         year_group_users = User.query.filter_by(year_group=selected_year_group).all()
 
     # Calculate the start and end of the selected week
-    today = datetime.today()
-    # Adjust the week start calculation to include Mondays
-    week_start = (today - timedelta(days=today.weekday())).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(weeks=session["week_offset"])
+    week_start = requested_week_start()
     week_end = (week_start + timedelta(days=6)).replace(hour=23, minute=59, second=59, microsecond=999999)
     week_range = f"{week_start.strftime('%a %d/%m')} - {week_end.strftime('%a %d/%m')}"
 
     # Modify the timetable queries to use inclusive datetime comparison
     if selected_user:
-        timetable_entries = Timetable.query.filter(
-            Timetable.users.any(id=selected_user.id),
-            Timetable.date.between(week_start.date(), week_end.date())
-        ).order_by(Timetable.date, Timetable.start_time).all()
+        timetable_entries = week_entries(Timetable.users.any(id=selected_user.id), week_start, week_end, with_users=True)
     elif selected_subject:
         assignee_ids = [assignment.user_id for assignment in subject_assignees]
-        timetable_entries = Timetable.query.filter(
-            Timetable.users.any(User.id.in_(assignee_ids)),
-            Timetable.date.between(week_start.date(), week_end.date())
-        ).order_by(Timetable.date, Timetable.start_time).all()
+        timetable_entries = week_entries(Timetable.users.any(User.id.in_(assignee_ids)), week_start, week_end, with_users=True)
+    elif selected_year_group:
+        year_group_member_ids = [user.id for user in year_group_users]
+        timetable_entries = week_entries(Timetable.users.any(User.id.in_(year_group_member_ids)), week_start, week_end, with_users=True)
+
+    # Add this week's occurrences of recurring lessons
+    calendar = school_calendar()
+    if selected_user:
+        timetable_entries = merge_entries(timetable_entries, expand_lessons([selected_user.id], week_start.date(), week_end.date(), calendar))
+    elif selected_subject:
+        timetable_entries = merge_entries(timetable_entries, expand_lessons(assignee_ids, week_start.date(), week_end.date(), calendar))
     elif selected_year_group:
-        year_group_user_ids = [user.id for user in year_group_users]
-        timetable_entries = Timetable.query.filter(
-            Timetable.users.any(User.id.in_(year_group_user_ids)),
-            Timetable.date.between(week_start.date(), week_end.date())
-        ).order_by(Timetable.date, Timetable.start_time).all()
+        timetable_entries = merge_entries(timetable_entries, expand_lessons(year_group_member_ids, week_start.date(), week_end.date(), calendar))
 
     # Handle adding a timetable entry
     if request.method == 'POST' and "action" in request.form:
@@ -309,25 +736,21 @@ def admin_timetable():
                 room = Room.query.get(room_id)
 
                 if subject and teacher and room:
+                    if clashes_block_write(date, start_time, end_time, teacher.id, room.id, [selected_user.id]):
+                        return redirect(admin_timetable_url())
                     is_substitute = 'is_substitute' in request.form
-                    new_entry = Timetable(
-                        date=date,
-                        subject=subject.name,
-                        teacher=teacher.username,
-                        start_time=start_time,
-                        end_time=end_time,
-                        room=room.name,
-                        is_substitute=is_substitute
-                    )
+                    new_entry = new_lesson_entry(date, subject, teacher, start_time, end_time, room, is_substitute,
+                                                 request.form.get("repeat_until"), request.form.get("week_parity"))
                     new_entry.users.append(selected_user)
                     # Also add the teacher to the users list
                     new_entry.users.append(teacher)
                     db.session.add(new_entry)
                     db.session.commit()
+                    invalidate_weeks(entry_user_ids(new_entry), *entry_dates(new_entry), changed=[change_key(new_entry)])
                     flash("Timetable entry added!", "success")
 
                     # Redirect to prevent form resubmission on refresh
-                    return redirect(url_for('admin_timetable'))
+                    return redirect(admin_timetable_url())
 
                 else:
                     flash("Invalid data. Please ensure all fields are selected.", "danger")
@@ -336,100 +759,42 @@ def admin_timetable():
             entry_id = request.form["entry_id"]
             entry = Timetable.query.get(entry_id)
             if entry:
+                affected_user_ids, date = entry_user_ids(entry), entry.date
                 db.session.delete(entry)
                 db.session.commit()
+                invalidate_weeks(affected_user_ids, date, changed=[entry_id])
                 flash("Timetable entry deleted.", "info")
 
             # Redirect after deletion to prevent duplicate deletions on reload
-            return redirect(url_for('admin_timetable'))
+            return redirect(admin_timetable_url())
 
-        elif action == "assign_by_subject":
-            subject_id = request.form["subject_id"]
-            date = datetime.strptime(request.form["date"], '%Y-%m-%d').date()
-            start_time = datetime.strptime(request.form["start_time"], '%H:%M').time()
-            end_time = datetime.strptime(request.form["end_time"], '%H:%M').time()
-            room_id = request.form["room_id"]
-            room = Room.query.get(room_id)
-            subject = Subject.query.get(subject_id)
-
-            if not subject or not room:
-                flash("Invalid subject or room selection.", "danger")
-                return redirect(url_for('admin_timetable'))
-            
-            # Get the original subject ID to find assigned users
-            original_subject_id = request.form["original_subject_id"]
-            
-            # Retrieve users assigned to the selected subject
-            assigned_users = AssignedSubject.query.filter_by(subject_id=original_subject_id).all()
-            assigned_user_ids = {assignment.user_id for assignment in assigned_users}
-
-            # Create a single timetable entry with the NEW selected subject
+        elif action in ("assign_by_subject", "assign_by_year_group"):
+            # Checking and writing a lesson for a whole subject or year group, perhaps across a term, runs as a job
+            subject = Subject.query.get(request.form["subject_id"])
+            room = Room.query.get(request.form["room_id"])
             teacher = User.query.get(request.form["teacher_id"])
-            is_substitute = 'is_substitute' in request.form
-            new_entry = Timetable(
-                date=date,
-                subject=subject.name,
-                teacher=teacher.username,
-                start_time=start_time,
-                end_time=end_time,
-                room=room.name,
-                is_substitute=is_substitute
-            )
-            db.session.add(new_entry)
-
-            # Assign timetable entry to all users assigned to the selected subject
-            for user_id in assigned_user_ids:
-                user = User.query.get(user_id)
-                new_entry.users.append(user)
-
-            db.session.commit()
-            
-            # Store the original subject ID in session to maintain context
-            session["selected_subject_id"] = original_subject_id
-    
-            flash(f"Timetable entry added for all assigned users of '{subject.name}'!", "success")
-            return redirect(url_for('admin_timetable'))
-        
-        elif action == "assign_by_year_group":
-            year_group = request.form["year_group"]
-            date = datetime.strptime(request.form["date"], '%Y-%m-%d').date()
-            start_time = datetime.strptime(request.form["start_time"], '%H:%M').time()
-            end_time = datetime.strptime(request.form["end_time"], '%H:%M').time()
-            room_id = request.form["room_id"]
-            room = Room.query.get(room_id)
-            subject_id = request.form["subject_id"]
-            subject = Subject.query.get(subject_id)
-
-            if not subject or not room:
-                flash("Invalid subject or room selection.", "danger")
-                return redirect(url_for('admin_timetable'))
-
-            # Retrieve users in the year group
-            year_group_users = User.query.filter_by(year_group=year_group).all()
-            year_group_user_ids = {user.id for user in year_group_users}
-
-            # Create a single timetable entry
-            teacher = User.query.get(request.form["teacher_id"])
-            is_substitute = 'is_substitute' in request.form
-            new_entry = Timetable(
-                date=date,
-                subject=subject.name,
-                teacher=teacher.username,
-                start_time=start_time,
-                end_time=end_time,
-                room=room.name,
-                is_substitute=is_substitute
-            )
-            db.session.add(new_entry)
-
-            # Assign timetable entry to all users in the year group
-            for user_id in year_group_user_ids:
-                user = User.query.get(user_id)
-                new_entry.users.append(user)
-
-            db.session.commit()
-            flash(f"Timetable entry added for all users in year group '{year_group}'!", "success")
-            return redirect(url_for('admin_timetable'))
+            if not subject or not room or not teacher:
+                flash("Invalid subject, teacher or room selection.", "danger")
+                return redirect(admin_timetable_url())
+
+            if action == "assign_by_subject":
+                # Assigned to everyone assigned to the original subject; back to that subject's view afterwards
+                group = {'original_subject_id': int(request.form["original_subject_id"])}
+                redirect_url = admin_timetable_url(subject_id=group['original_subject_id'])
+                description = f"all assigned users of '{subject.name}'"
+            else:
+                group = {'year_group': request.form["year_group"]}
+                redirect_url = admin_timetable_url()
+                description = f"all users in year group '{group['year_group']}'"
+            job = job_queue.submit('add_group_lesson', dict(
+                date=request.form["date"], start_time=request.form["start_time"], end_time=request.form["end_time"],
+                subject_id=subject.id, teacher_id=teacher.id, room_id=room.id,
+                is_substitute='is_substitute' in request.form, repeat_until=request.form.get("repeat_until") or None,
+                week_parity=request.form.get("week_parity") or None, allow_clash='allow_clash' in request.form,
+                **group
+            ), session['user_id'], f"Adding a {subject.name} lesson for {description}")
+            flash(f"Adding the timetable entry for {description} in the background (job {job.id}).", "info")
+            return redirect(redirect_url)
 
         elif action == "delete_entry_for_user":
             entry_id = request.form["entry_id"]
@@ -446,13 +811,15 @@ def admin_timetable():
                 entry.users.remove(user)
                 
                 # If no users left, delete the entry
+                date = entry.date
                 if not entry.users:
                     db.session.delete(entry)
                 
                 db.session.commit()
+                invalidate_weeks([user.id], date, changed=[entry_id])
                 flash(f"Entry removed for user {user.username}.", "info")
             
-            return redirect(url_for('admin_timetable'))
+            return redirect(admin_timetable_url())
 
         elif action == "delete_entry_for_all":
             entry_id = request.form["entry_id"]
@@ -464,59 +831,85 @@ def admin_timetable():
                     db.session.delete(entry.note)
                     
                 # Then delete the entry
+                affected_user_ids, date = entry_user_ids(entry), entry.date
                 db.session.delete(entry)
                 db.session.commit()
+                invalidate_weeks(affected_user_ids, date, changed=[entry_id])
                 flash("Entry deleted for all users.", "info")
             
-            return redirect(url_for('admin_timetable'))
+            return redirect(admin_timetable_url())
+
+        elif action == "materialize_lesson":
+            # Turn one occurrence of a recurring lesson into a concrete entry that can be edited on its own
+            entry = materialize_occurrence(request.form["occurrence"])
+            if entry:
+                db.session.commit()
+                invalidate_weeks(entry_user_ids(entry), entry.date, changed=[request.form["occurrence"], change_key(entry)])
+                flash("This week's lesson can now be edited separately.", "success")
+            else:
+                flash("Lesson occurrence not found.", "danger")
+            return redirect(admin_timetable_url())
+
+        elif action == "cancel_occurrence":
+            # A replacement entry with no users hides the occurrence for everyone
+            entry = materialize_occurrence(request.form["occurrence"])
+            if entry:
+                affected_user_ids = entry_user_ids(entry)
+                entry.users = []
+                db.session.commit()
+                invalidate_weeks(affected_user_ids, entry.date, changed=[request.form["occurrence"], change_key(entry)])
+                flash("Lesson cancelled for this week.", "info")
+            else:
+                flash("Lesson occurrence not found.", "danger")
+            return redirect(admin_timetable_url())
+
+        elif action == "delete_lesson_series":
+            lesson_id, _ = parse_occurrence_key(request.form["occurrence"])
+            lesson = RecurringLesson.query.get(lesson_id) if lesson_id else None
+            if lesson:
+                affected_user_ids, key = entry_user_ids(lesson), change_key(lesson)
+                delete_lesson_series(lesson)
+                db.session.commit()
+                invalidate_weeks(affected_user_ids, changed=[key])
+                flash("Recurring lesson deleted.", "info")
+            return redirect(admin_timetable_url())
 
         elif action == "set_free_day":
             date = datetime.strptime(request.form["date"], '%Y-%m-%d').date()
             message = request.form["message"]
             scope = request.form["scope"]
-
-            # Create a special timetable entry for the free day
-            free_day_entry = Timetable(
-                date=date,
-                subject=message,  # Use subject field to store the message
-                teacher="N/A",
-                start_time=datetime.strptime('00:00', '%H:%M').time(),
-                end_time=datetime.strptime('23:59', '%H:%M').time(),
-                room="N/A",
-                is_substitute=False
-            )
-            free_day_entry.is_free_day = True  # Add this field to your Timetable model
-            db.session.add(free_day_entry)
-
-            # Add users based on scope
-            if scope == "user" and selected_user:
-                free_day_entry.users.append(selected_user)
-            elif scope == "subject" and selected_subject:
-                for assignee in subject_assignees:
-                    user = User.query.get(assignee.user_id)
-                    if user:
-                        free_day_entry.users.append(user)
-            elif scope == "year_group" and selected_year_group:
-                for user in year_group_users:
-                    free_day_entry.users.append(user)
-            elif scope == "all":
-                all_users = User.query.filter(User.role != "admin").all()
-                for user in all_users:
-                    free_day_entry.users.append(user)
-
-            db.session.commit()
-            flash(f"Free day set for {date.strftime('%Y-%m-%d')}", "success")
-            return redirect(url_for('admin_timetable'))
+            targets = {
+                'user': {'user_id': selected_user.id} if selected_user else None,
+                'subject': {'subject_id': selected_subject.id} if selected_subject else None,
+                'year_group': {'year_group': selected_year_group} if selected_year_group else None,
+                'all': {},
+            }
+            target = targets.get(scope)
+            if target is None:
+                flash("Choose who the free day is for.", "danger")
+            elif scope == "user":
+                add_free_day(date, message, scope, **target)
+                flash(f"Free day set for {date.strftime('%Y-%m-%d')}", "success")
+            else:
+                # A free day for many users is written in the background
+                job = job_queue.submit('set_free_day', dict(date=date.isoformat(), message=message, scope=scope, **target),
+                                       session['user_id'], f"Setting a free day on {date.strftime('%Y-%m-%d')}")
+                flash(f"Setting the free day for {date.strftime('%Y-%m-%d')} in the background (job {job.id}).", "info")
+            return redirect(admin_timetable_url())
 
     return render_template(
         "admin_timetable.html",
         users=users, staff_users=staff_users, rooms=rooms,
         subjects=subjects, selected_user=selected_user,
         selected_subject=selected_subject, selected_year_group=selected_year_group,
-        timetable=timetable_entries, assigned_subjects=assigned_subjects,
+        timetable=timetable_entries, days=week_days(timetable_entries, week_start, calendar),
+        assigned_subjects=assigned_subjects,
         subject_assignees=subject_assignees, year_groups=year_groups,
         year_group_users=year_group_users,
-        week_range=week_range, week_start=week_start, timedelta=timedelta
+        week_range=week_range, week_start=week_start,
+        previous_week=(week_start - timedelta(weeks=1)).strftime('%Y-%m-%d'),
+        next_week=(week_start + timedelta(weeks=1)).strftime('%Y-%m-%d'),
+        selection=admin_selection(), week_labels=calendar.week_labels
     )
 
 @app.route('/admin_subjects', methods=['GET', 'POST'])
@@ -528,6 +921,9 @@ def admin_subjects():
     subjects = Subject.query.all()
     rooms = Room.query.all()
     users = User.query.filter(User.role.in_(["student", "staff"])).all()
+    requirements = SubjectRequirement.query.options(db.joinedload(SubjectRequirement.subject)).order_by(
+        SubjectRequirement.year_group
+    ).all()
 
     if request.method == 'POST':
         action = request.form.get("action")
@@ -544,10 +940,25 @@ def admin_subjects():
         elif action == "delete_subject":
             subject_id = request.form["subject_id"]
             subject = Subject.query.get(subject_id)
+            detach_references('subject', subject.id)
             db.session.delete(subject)
             db.session.commit()
             flash("Subject deleted!", "info")
 
+        elif action == "rename_subject":
+            subject = Subject.query.get(request.form["subject_id"])
+            subject_name = request.form["subject_name"].strip()
+            if not subject or not subject_name:
+                flash("Subject not found!", "danger")
+            elif Subject.query.filter(Subject.name == subject_name, Subject.id != subject.id).first():
+                flash(f"Subject '{subject_name}' already exists!", "danger")
+            else:
+                subject.name = subject_name
+                rename_references('subject', subject.id, subject_name)
+                db.session.commit()
+                invalidate_weeks(None)
+                flash(f"Subject renamed to '{subject_name}'!", "success")
+
         elif action == "add_room":
             room_name = request.form["room_name"]
             existing_room = Room.query.filter_by(name=room_name).first()
@@ -560,10 +971,25 @@ def admin_subjects():
         elif action == "delete_room":
             room_id = request.form["room_id"]
             room = Room.query.get(room_id)
+            detach_references('room', room.id)
             db.session.delete(room)
             db.session.commit()
             flash("Room deleted!", "info")
 
+        elif action == "rename_room":
+            room = Room.query.get(request.form["room_id"])
+            room_name = request.form["room_name"].strip()
+            if not room or not room_name:
+                flash("Room not found!", "danger")
+            elif Room.query.filter(Room.name == room_name, Room.id != room.id).first():
+                flash(f"Room '{room_name}' already exists!", "danger")
+            else:
+                room.name = room_name
+                rename_references('room', room.id, room_name)
+                db.session.commit()
+                invalidate_weeks(None)
+                flash(f"Room renamed to '{room_name}'!", "success")
+
         elif action == "assign_subject":
             user_id = request.form["user_id"]
             subject_id = request.form["subject_id"]
@@ -575,23 +1001,127 @@ def admin_subjects():
                 db.session.commit()
                 flash("Subject assigned to user!", "success")
 
-    return render_template("admin_subjects.html", subjects=subjects, rooms=rooms, users=users)
+        elif action == "set_requirement":
+            # Weekly lessons per subject and year group, used by the timetable generator
+            subject_id = request.form["subject_id"]
+            year_group = request.form["year_group"]
+            periods_per_week = int(request.form["periods_per_week"])
+            requirement = SubjectRequirement.query.filter_by(subject_id=subject_id, year_group=year_group).first()
+
+            if periods_per_week <= 0:
+                if requirement:
+                    db.session.delete(requirement)
+            elif requirement:
+                requirement.periods_per_week = periods_per_week
+            else:
+                db.session.add(SubjectRequirement(subject_id=subject_id, year_group=year_group, periods_per_week=periods_per_week))
+            db.session.commit()
+            flash("Weekly lessons updated!", "success")
+            return redirect(url_for('admin_subjects'))
+
+        elif action == "generate_timetable":
+            # Solving can take a while, so it runs as a job like `flask generate-timetable`
+            term_start, term_end = request.form["term_start"], request.form["term_end"]
+            cycle_weeks = int(request.form.get("cycle_weeks", 1))
+            if term_end < term_start:
+                flash("The term must end after it starts.", "danger")
+            elif cycle_weeks == 2 and school_calendar().cycle_weeks != 2:
+                flash("Set the school calendar to a Week A/B rotation before generating a fortnightly timetable.", "danger")
+            else:
+                job = job_queue.submit('generate_timetable', dict(
+                    term_start=term_start, term_end=term_end, cycle_weeks=cycle_weeks,
+                    max_class_size=int(request.form.get("max_class_size", 30)),
+                    time_limit=float(request.form.get("time_limit", 10)), seed=0
+                ), session['user_id'], f"Generating the timetable for {term_start} to {term_end}")
+                flash(f"Generating the timetable in the background (job {job.id}).", "info")
+            return redirect(url_for('admin_subjects'))
+
+    return render_template("admin_subjects.html", subjects=subjects, rooms=rooms, users=users, requirements=requirements)
+
+@app.route('/admin_calendar', methods=['GET', 'POST'])
+def admin_calendar():
+    if 'user_id' not in session or session['role'] != 'admin':
+        flash("Access denied. Admins only.", "danger")
+        return redirect(url_for('dashboard'))
+
+    if request.method == 'POST':
+        action = request.form.get('action')
+        try:
+            if action == "set_rotation":
+                settings = SchoolSettings.query.first()
+                settings.use_week_ab = 'use_week_ab' in request.form
+                settings.cycle_weeks = int(request.form.get('cycle_weeks', 2))
+                if not 2 <= settings.cycle_weeks <= MAX_CYCLE_WEEKS:
+                    raise ValueError(f"A rotation has 2 to {MAX_CYCLE_WEEKS} weeks.")
+            elif action in ("add_term", "add_holiday"):
+                name = request.form['name'].strip()
+                start_date = datetime.strptime(request.form['start_date'], '%Y-%m-%d').date()
+                end_date = datetime.strptime(request.form['end_date'], '%Y-%m-%d').date()
+                if not name or end_date < start_date:
+                    raise ValueError("Give a name and an end date on or after the start date.")
+                if action == "add_term":
+                    db.session.add(SchoolTerm(name=name, start_date=start_date, end_date=end_date,
+                                              first_week=request.form.get('first_week') or None))
+                else:
+                    db.session.add(SchoolHoliday(name=name, start_date=start_date, end_date=end_date))
+            elif action == "delete_term":
+                db.session.delete(SchoolTerm.query.get_or_404(request.form['term_id']))
+            elif action == "delete_holiday":
+                db.session.delete(SchoolHoliday.query.get_or_404(request.form['holiday_id']))
+            else:
+                raise ValueError("Unknown action.")
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), "danger")
+            return redirect(url_for('admin_calendar'))
+
+        # Lessons move between weeks of the rotation and holidays, so every page and feed is out of date
+        calendar_changed()
+        db.session.commit()
+        invalidate_weeks(None)
+        flash("School calendar updated.", "success")
+        return redirect(url_for('admin_calendar'))
+
+    calendar = school_calendar()
+    terms = SchoolTerm.query.order_by(SchoolTerm.start_date).all()
+    # Each term's weeks, labelled as lessons will see them
+    term_weeks = []
+    for term in terms:
+        first_monday = week_start_of(term.start_date)
+        week_starts = [first_monday + timedelta(weeks=week) for week in range((term.end_date - first_monday).days // 7 + 1)]
+        term_weeks.append((term, [(week_start, calendar.day(max(week_start, term.start_date))) for week_start in week_starts]))
+    return render_template(
+        'admin_calendar.html', calendar=calendar, settings=SchoolSettings.query.first(),
+        term_weeks=term_weeks, holidays=SchoolHoliday.query.order_by(SchoolHoliday.start_date).all(),
+        week_labels=WEEK_LABELS, max_cycle_weeks=MAX_CYCLE_WEEKS
+    )
 
 @app.route('/get_assigned_subjects/<int:user_id>')
 def get_assigned_subjects(user_id):
-    assigned_subjects = AssignedSubject.query.filter_by(user_id=user_id).all()
-    subjects = [Subject.query.get(a.subject_id) for a in assigned_subjects]
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    subjects = db.session.query(Subject.id, Subject.name).join(
+        AssignedSubject, AssignedSubject.subject_id == Subject.id
+    ).filter(AssignedSubject.user_id == user_id).order_by(Subject.name)
     return jsonify([{"id": s.id, "name": s.name} for s in subjects])
 
 @app.route('/get_assigned_users/<int:subject_id>')
 def get_assigned_users(subject_id):
-    assigned_users = AssignedSubject.query.filter_by(subject_id=subject_id).all()
-    users = [User.query.get(a.user_id) for a in assigned_users if User.query.get(a.user_id).role == 'student']
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    users = db.session.query(User.id, User.username).join(
+        AssignedSubject, AssignedSubject.user_id == User.id
+    ).filter(AssignedSubject.subject_id == subject_id, User.role == 'student').order_by(User.username)
     return jsonify([{"id": u.id, "username": u.username} for u in users])
 
 @app.route('/get_students_by_year_group/<year_group>')
 def get_students_by_year_group(year_group):
-    students = User.query.filter_by(year_group=year_group, role='student').all()
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    students = db.session.query(User.id, User.username).filter_by(year_group=year_group, role='student').order_by(User.username)
     return jsonify([{"id": u.id, "username": u.username} for u in students])
 
 @app.route('/get_entry_details/<int:entry_id>')
@@ -600,26 +1130,236 @@ def get_entry_details(entry_id):
         return jsonify({'error': 'Unauthorized'}), 403
 
     entry = Timetable.query.get_or_404(entry_id)
-    subject = Subject.query.filter_by(name=entry.subject).first()
-    teacher = User.query.filter_by(username=entry.teacher).first()
-    room = Room.query.filter_by(name=entry.room).first()
 
     return jsonify({
         'date': entry.date.strftime('%Y-%m-%d'),
         'start_time': entry.start_time.strftime('%H:%M'),
         'end_time': entry.end_time.strftime('%H:%M'),
-        'subject_id': subject.id if subject else None,
-        'teacher_id': teacher.id if teacher else None,
-        'room_id': room.id if room else None
+        'subject_id': entry.subject_id,
+        'teacher_id': entry.teacher_id,
+        'room_id': entry.room_id,
+        'is_substitute': bool(entry.is_substitute),
+        'assignees': entry_assignees(entry_id)
     })
 
+@app.route('/admin_reference_data')
+def admin_reference_data():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    payload, etag = build_reference_data()
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(payload)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/clash_report')
+def clash_report():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'start and end dates (YYYY-MM-DD) are required'}), 400
+    clashes = scan_for_clashes(start_date, end_date)
+    return jsonify({'count': len(clashes), 'clashes': clashes})
+
+def requested_report_range():
+    # ?start= and ?end= (YYYY-MM-DD); by default the whole timetable, or this week if it is empty
+    try:
+        start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else None
+        end_date = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else None
+    except ValueError:
+        raise ValueError("Dates must be YYYY-MM-DD.")
+    span = timetable_span() or (requested_week_start().date(),) * 2
+    start_date = start_date or span[0]
+    end_date = end_date or span[1] + timedelta(days=6)
+    if end_date < start_date:
+        raise ValueError("The end date must not be before the start date.")
+    return start_date, end_date
+
+@app.route('/analytics')
+def analytics():
+    if 'user_id' not in session or session['role'] != 'admin':
+        flash("Access denied. Admins only.", "danger")
+        return redirect(url_for('dashboard'))
+
+    try:
+        start_date, end_date = requested_report_range()
+    except ValueError as e:
+        return render_template('analytics.html', error=str(e), terms=generated_terms()), 400
+    return render_template('analytics.html', report=UsageReport(start_date, end_date), terms=generated_terms(),
+                           reports=ANALYTICS_REPORTS)
+
+@app.route('/analytics/<report>.csv')
+def analytics_csv(report):
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    if report not in ANALYTICS_REPORTS:
+        return jsonify({'error': f"report must be one of {', '.join(ANALYTICS_REPORTS)}"}), 404
+
+    try:
+        start_date, end_date = requested_report_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    usage = UsageReport(start_date, end_date)
+    header, rows = usage.csv_rows(report)
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(header)
+    writer.writerows(rows)
+    filename = f"{report}-{usage.first_week}-{usage.end_date}.csv"
+    return Response(output.getvalue(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+def entry_key(entry_id):
+    # Entry ids from requests: ints for entries, "lesson@date" strings for recurring occurrences
+    if entry_id in (None, ''):
+        return None
+    entry_id = str(entry_id)
+    return int(entry_id) if entry_id.isdigit() else entry_id
+
+def substitute_slot(args):
+    # The lesson to cover: an entry or occurrence key, or a date and times (plus an optional subject)
+    entry_id = args.get('entry_id')
+    if entry_id:
+        entry = None
+        if is_occurrence_key(entry_id):
+            lesson_id, day = parse_occurrence_key(entry_id)
+            entry = RecurringLesson.query.get(lesson_id) if lesson_id else None
+            if entry and day not in lesson_dates(entry, day, day, school_calendar()):
+                entry = None
+            key = entry_id
+        elif entry_id.isdigit():
+            key = int(entry_id)
+            entry = Timetable.query.get(key)
+            day = entry.date if entry else None
+        if entry is None or getattr(entry, 'is_free_day', False):
+            raise LookupError(f"No timetable entry {entry_id}")
+        return dict(day=day, start_time=entry.start_time, end_time=entry.end_time, subject_id=entry.subject_id,
+                    absent_ids=[entry.teacher_id] if entry.teacher_id else [], exclude_key=key)
+    try:
+        return dict(
+            day=datetime.strptime(args['date'], '%Y-%m-%d').date(),
+            start_time=datetime.strptime(args['start_time'], '%H:%M').time(),
+            end_time=datetime.strptime(args['end_time'], '%H:%M').time(),
+            subject_id=args.get('subject_id', type=int),
+            absent_ids=args.getlist('absent_id', type=int),
+            exclude_key=entry_key(args.get('exclude_entry_id'))
+        )
+    except (KeyError, ValueError):
+        raise ValueError("entry_id, or date (YYYY-MM-DD) with start_time and end_time (HH:MM), is required")
+
+@app.route('/substitutes')
+def substitutes():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        slot = substitute_slot(request.args)
+    except LookupError as error:
+        return jsonify({'error': str(error)}), 404
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    candidates = find_substitutes(limit=request.args.get('limit', type=int), **slot)
+    return jsonify({
+        'date': slot['day'].strftime('%Y-%m-%d'),
+        'start_time': slot['start_time'].strftime('%H:%M'),
+        'end_time': slot['end_time'].strftime('%H:%M'),
+        'subject_id': slot['subject_id'],
+        'candidates': candidates
+    })
+
+@app.route('/substitutes/day')
+def substitutes_for_day():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        day = datetime.strptime(request.args['date'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'date (YYYY-MM-DD) is required'}), 400
+    teacher_ids = request.args.getlist('teacher_id', type=int)
+    if not teacher_ids:
+        return jsonify({'error': 'at least one teacher_id is required'}), 400
+    plan = plan_cover(teacher_ids, day, day, limit=request.args.get('limit', 5, type=int))
+    return jsonify({
+        'date': day.strftime('%Y-%m-%d'),
+        'lessons': plan,
+        'uncovered': sum(1 for item in plan if item['suggested'] is None)
+    })
+
+@app.route('/cover_absence', methods=['POST'])
+def cover_absence():
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        teacher = User.query.get(int(data['teacher_id']))
+        start_date = datetime.strptime(data['start'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(data.get('end') or data['start'], '%Y-%m-%d').date()
+        chosen = {entry_key(key): int(value) if value not in (None, '') else None
+                  for key, value in (data.get('substitutes') or {}).items()}
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return jsonify({'error': 'teacher_id and start (YYYY-MM-DD) are required; substitutes maps entry ids to user ids'}), 400
+    if not teacher or teacher.role != 'staff':
+        return jsonify({'error': 'No such member of staff'}), 404
+    if end_date < start_date or (end_date - start_date).days >= app.config['RANGE_MAX_WEEKS'] * 7:
+        return jsonify({'error': f"end must be on or after start and at most {app.config['RANGE_MAX_WEEKS']} weeks later"}), 400
+
+    plan = plan_cover([teacher.id], start_date, end_date, chosen)
+    unknown = set(chosen) - {item['lesson']['id'] for item in plan}
+    if unknown:
+        return jsonify({'error': f"Not lessons of {teacher.username} in the range: {', '.join(sorted(map(str, unknown)))}"}), 400
+
+    dry_run = bool(data.get('dry_run'))
+    errors = sum(1 for item in plan if item.get('error'))
+    result = {
+        'teacher': teacher.username,
+        'start': start_date.strftime('%Y-%m-%d'),
+        'end': end_date.strftime('%Y-%m-%d'),
+        'dry_run': dry_run,
+        'lessons': plan,
+        'covered': sum(1 for item in plan if item['suggested']),
+        'uncovered': sum(1 for item in plan if not item['suggested']),
+        'errors': errors
+    }
+    if dry_run:
+        return jsonify(result)
+    if errors:
+        return jsonify(result), 409
+
+    # Every lesson changes in one transaction, or none do
+    try:
+        affected_user_ids, dates, changed = apply_cover(plan)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f"Error covering lessons: {str(e)}"}), 500
+    if dates:
+        invalidate_weeks(affected_user_ids, *dates, changed=changed)
+    return jsonify(result)
+
 @app.route('/get_entry_assignees/<int:entry_id>')
 def get_entry_assignees(entry_id):
     if 'user_id' not in session or session['role'] != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
 
-    entry = Timetable.query.get_or_404(entry_id)
-    return jsonify([{'id': user.id, 'username': user.username} for user in entry.users])
+    Timetable.query.get_or_404(entry_id)
+    return jsonify(entry_assignees(entry_id))
+
+def entry_assignees(entry_id):
+    users = db.session.query(User.id, User.username).join(
+        user_timetable, user_timetable.c.user_id == User.id
+    ).filter(user_timetable.c.timetable_id == entry_id).order_by(User.username)
+    return [{'id': user.id, 'username': user.username} for user in users]
 
 @app.route('/update_entry_assignees', methods=['POST'])
 def update_entry_assignees():
@@ -631,6 +1371,7 @@ def update_entry_assignees():
     user_ids = data.get('user_ids', [])
 
     entry = Timetable.query.get_or_404(entry_id)
+    affected_user_ids = set(entry_user_ids(entry))
     
     # Clear existing assignees
     entry.users = []
@@ -642,6 +1383,7 @@ def update_entry_assignees():
             entry.users.append(user)
     
     db.session.commit()
+    invalidate_weeks(affected_user_ids | set(entry_user_ids(entry)), entry.date, changed=[change_key(entry)])
     return jsonify({'success': True})
 
 @app.route('/edit_entry', methods=['POST'])
@@ -652,6 +1394,7 @@ def edit_entry():
     try:
         entry_id = request.form.get('entry_id')
         entry = Timetable.query.get_or_404(entry_id)
+        affected_user_ids, old_date = set(entry_user_ids(entry)), entry.date
 
         # Update entry details
         entry.date = datetime.strptime(request.form['date'], '%Y-%m-%d').date()
@@ -664,48 +1407,57 @@ def edit_entry():
 
         if not all([subject, teacher, room]):
             flash("Invalid data. Please ensure all fields are selected.", "danger")
-            return redirect(url_for('admin_timetable'))
+            return redirect(admin_timetable_url())
+
+        old_teacher_id = entry.teacher_id
+        attendee_ids = [user.id for user in entry.users if user.id not in (old_teacher_id, teacher.id)]
+        with db.session.no_autoflush:
+            blocked = clashes_block_write(entry.date, entry.start_time, entry.end_time, teacher.id, room.id,
+                                          attendee_ids, exclude_entry_id=entry.id)
+        if blocked:
+            db.session.rollback()
+            return redirect(admin_timetable_url())
 
         # Update entry
-        entry.subject = subject.name
-        entry.teacher = teacher.username
-        entry.room = room.name
+        entry.subject, entry.subject_id = subject.name, subject.id
+        entry.teacher, entry.teacher_id = teacher.username, teacher.id
+        entry.room, entry.room_id = room.name, room.id
         
         entry.is_substitute = 'is_substitute' in request.form
         
         # Update the teacher in the users list
-        old_teacher = User.query.filter_by(username=entry.teacher).first()
-        if old_teacher in entry.users:
-            entry.users.remove(old_teacher)
-        entry.users.append(teacher)
+        entry.users = [user for user in entry.users if user.id != old_teacher_id]
+        if teacher not in entry.users:
+            entry.users.append(teacher)
         
         # Update week and day_of_week
-        entry.week = entry.date.isocalendar()[1]
-        if entry.date.weekday() == 0:  # If it's Monday
-            previous_sunday = entry.date - timedelta(days=1)
-            entry.week = previous_sunday.isocalendar()[1] + 1
+        entry.week = week_number(entry.date)
         entry.day_of_week = entry.date.strftime('%A')
         
         db.session.commit()
     except Exception as e:
         db.session.rollback()
         flash(f"Error updating entry: {str(e)}", "danger")
+    else:
+        # The edit is saved, so a cache failure must not be reported as a failed update
+        invalidate_weeks(affected_user_ids | set(entry_user_ids(entry)), old_date, entry.date, changed=[change_key(entry)])
 
-    return redirect(url_for('admin_timetable'))
+    return redirect(admin_timetable_url())
 
 @app.route('/get_subject_users/<int:subject_id>')
 def get_subject_users(subject_id):
     if 'user_id' not in session or session['role'] != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
 
-    assigned_users = AssignedSubject.query.filter_by(subject_id=subject_id).all()
-    users = [User.query.get(a.user_id) for a in assigned_users]
+    users = db.session.query(User.id, User.username, User.role, User.year_group).join(
+        AssignedSubject, AssignedSubject.user_id == User.id
+    ).filter(AssignedSubject.subject_id == subject_id).order_by(User.username)
     return jsonify([{
         'id': user.id, 
         'username': user.username,
         'role': user.role,
         'year_group': user.year_group
-    } for user in users if user])
+    } for user in users])
 
 @app.route('/get_subject_teachers/<int:subject_id>')
 def get_subject_teachers(subject_id):
@@ -713,22 +1465,28 @@ def get_subject_teachers(subject_id):
         return jsonify({'error': 'Unauthorized'}), 403
 
     is_substitute = request.args.get('is_substitute') == 'true'
-    
-    if is_substitute:
-        # Get all staff members
-        teachers = User.query.filter_by(role='staff').all()
-    else:
-        # Get only teachers assigned to this subject
-        assigned_teachers = AssignedSubject.query.join(User).filter(
-            AssignedSubject.subject_id == subject_id,
-            User.role == 'staff'
-        ).all()
-        teachers = [User.query.get(a.user_id) for a in assigned_teachers]
+    if is_substitute and (request.args.get('entry_id') or request.args.get('date')):
+        # With a lesson or time slot given, only staff free then, best suited first
+        try:
+            slot = substitute_slot(request.args)
+        except LookupError as error:
+            return jsonify({'error': str(error)}), 404
+        except ValueError as error:
+            return jsonify({'error': str(error)}), 400
+        slot['subject_id'] = subject_id
+        return jsonify([{'id': teacher['id'], 'username': teacher['username']} for teacher in find_substitutes(**slot)])
+
+    teachers = db.session.query(User.id, User.username).filter(User.role == 'staff')
+    if not is_substitute:
+        # Only teachers assigned to this subject
+        teachers = teachers.join(AssignedSubject, AssignedSubject.user_id == User.id).filter(
+            AssignedSubject.subject_id == subject_id
+        )
 
     return jsonify([{
         'id': teacher.id,
         'username': teacher.username
-    } for teacher in teachers if teacher])
+    } for teacher in teachers.order_by(User.username)])
 
 @app.route('/add_note', methods=['POST'])
 def add_note():
@@ -740,7 +1498,13 @@ def add_note():
         entry_id = data.get('entry_id')
         content = data.get('content')
         
-        entry = Timetable.query.get_or_404(entry_id)
+        if is_occurrence_key(entry_id):
+            # Notes on a recurring lesson are stored on a concrete entry for that week
+            entry = materialize_occurrence(entry_id)
+            if entry is None:
+                return jsonify({'error': 'Lesson occurrence not found'}), 404
+        else:
+            entry = Timetable.query.get_or_404(entry_id)
         
         if entry.note:
             # Update existing note
@@ -748,15 +1512,17 @@ def add_note():
             entry.note.updated_at = datetime.utcnow()
         else:
             # Create new note
-            note = Note(timetable_id=entry_id, content=content)
+            note = Note(timetable_id=entry.id, content=content)
             db.session.add(note)
         
         db.session.commit()
-        return jsonify({'success': True, 'message': 'Note saved successfully'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+    invalidate_weeks(entry_user_ids(entry), entry.date, changed=[str(entry_id), change_key(entry)])
+    return jsonify({'success': True, 'message': 'Note saved successfully'})
+
 @app.route('/get_note/<int:entry_id>')
 def get_note(entry_id):
     entry = Timetable.query.get_or_404(entry_id)
@@ -778,33 +1544,328 @@ def edit_free_day():
 
         if not entry.is_free_day:
             flash("Invalid operation: This entry is not a free day.", "danger")
-            return redirect(url_for('admin_timetable'))
+            return redirect(admin_timetable_url())
+        old_date = entry.date
 
         # Update free day details
         entry.date = datetime.strptime(request.form['date'], '%Y-%m-%d').date()
         entry.subject = request.form['message']  # Update description
         
         # Update week and day_of_week
-        entry.week = entry.date.isocalendar()[1]
-        if entry.date.weekday() == 0:  # If it's Monday
-            previous_sunday = entry.date - timedelta(days=1)
-            entry.week = previous_sunday.isocalendar()[1] + 1
+        entry.week = week_number(entry.date)
         entry.day_of_week = entry.date.strftime('%A')
         
         db.session.commit()
-        flash("Free day updated successfully!", "success")
     except Exception as e:
         db.session.rollback()
         flash(f"Error updating free day: {str(e)}", "danger")
+    else:
+        invalidate_weeks(entry_user_ids(entry), old_date, entry.date, changed=[change_key(entry)])
+        flash("Free day updated successfully!", "success")
 
-    return redirect(url_for('admin_timetable'))
+    return redirect(admin_timetable_url())
+
+def change_payload(key, entry):
+    if isinstance(entry, RecurringLesson):
+        return {name: field(entry) for name, field in LESSON_FIELDS.items()}
+    payload = {name: ENTRY_FIELDS[name](entry) for name in DEFAULT_ENTRY_FIELDS}
+    payload['note'] = entry.note.content if entry.note else None
+    return payload
+
+def change_feed(user_id, since, limit=500):
+    """The /changes answer for user_id after since; since None answers resync."""
+    through = latest_seq()
+    if since is None:
+        resync, rows, has_more = True, [], False
+    else:
+        resync, rows, has_more = changes_since(user_id, since, through, limit)
+
+    entries = resolve_changes(user_id, [key for key, _ in rows])
+    deltas = []
+    for key, seq in rows:
+        if entries[key] is None:
+            deltas.append({'key': key, 'seq': seq, 'op': 'delete'})
+        else:
+            deltas.append({'key': key, 'seq': seq, 'op': 'upsert', 'entry': change_payload(key, entries[key])})
+    return {
+        'since': since,
+        'next': rows[-1][1] if has_more else through,
+        'more': has_more,
+        'resync': resync,
+        'changes': deltas
+    }
+
+def may_follow(user_id):
+    # Users can follow their own timetable, staff a student's (as on /timetable), admins and API keys anyone's
+    if user_id == session.get('user_id') or session.get('role') == 'admin' or has_api_key():
+        return True
+    if session.get('role') == 'staff':
+        followed = User.query.get(user_id)
+        return followed is not None and followed.role == 'student'
+    return False
+
+@app.route('/changes')
+def changes():
+    """What changed in a user's timetable since a change log seq, for clients keeping a copy in sync.
+
+    Without since, or when the log no longer goes back that far, the answer is resync: download
+    the timetable again, then ask for changes since next. With wait=N (seconds) an answer with no
+    changes is held until one arrives or N seconds pass, as a long-poll alternative to /timetable/events.
+    """
+    if 'user_id' not in session and not has_api_key():
+        return jsonify({'error': 'Unauthorized'}), 403
+    user_id = request.args.get('user', session.get('user_id'), type=int)
+    if user_id is None:
+        return jsonify({'error': 'user is required'}), 400
+    if not may_follow(user_id):
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    since = request.args.get('since', type=int)
+    limit = max(1, min(request.args.get('limit', 500, type=int), app.config['API_MAX_PAGE_SIZE']))
+    wait = min(request.args.get('wait', 0, type=int), app.config['LIVE_MAX_WAIT_SECONDS'])
+    # Subscribe before reading, so a change committed in between still wakes the wait
+    subscriber = live_updates.subscribe(user_id) if wait > 0 and since is not None else None
+    try:
+        payload = change_feed(user_id, since, limit)
+        if subscriber and not payload['changes'] and not payload['resync']:
+            db.session.remove()  # Don't hold a database connection while waiting
+            if subscriber.wait(wait):
+                payload = change_feed(user_id, since, limit)
+    finally:
+        if subscriber:
+            live_updates.unsubscribe(subscriber)
+    return jsonify(payload)
+
+@app.route('/timetable/events')
+def timetable_events():
+    """Server-Sent Events stream of the /changes answers for the viewed user's timetable.
+
+    Each event's id is the seq to resume from, which browsers send back as Last-Event-ID when they
+    reconnect. When too many streams are open the answer is 503, and the page polls /changes instead.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 403
+    user_id = viewed_user(User.query.get(session['user_id']), session['role']).id
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    subscriber = live_updates.subscribe(user_id)
+    if subscriber is None:
+        response = jsonify({'error': 'Too many live connections; poll /changes instead'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '60'
+        return response
+
+    heartbeat = app.config['LIVE_HEARTBEAT_SECONDS']
+    closes_at = time.monotonic() + app.config['LIVE_STREAM_SECONDS']
+
+    def events(since):
+        try:
+            yield f"retry: {heartbeat * 1000}\n\n"
+            woken = True  # Send anything missed since the page was rendered straight away
+            while time.monotonic() < closes_at:
+                if woken:
+                    payload = change_feed(user_id, since)
+                    db.session.remove()  # Don't hold a database connection while waiting
+                    since = payload['next']
+                    if payload['changes'] or payload['resync']:
+                        yield f"id: {since}\nevent: changes\ndata: {json.dumps(payload)}\n\n"
+                    if payload['more']:
+                        continue
+                else:
+                    # Keeps proxies from closing an idle stream and notices clients that went away; the id
+                    # moves the browser's Last-Event-ID on, so a reconnect does not replay changes already seen
+                    yield f": keep-alive\nid: {since}\n\n"
+                woken = subscriber.wait(min(heartbeat, max(0, closes_at - time.monotonic())))
+        finally:
+            live_updates.unsubscribe(subscriber)
+
+    response = Response(stream_with_context(events(since)), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+@app.route('/jobs')
+def jobs():
+    # The most recent background jobs, for the admin pages' jobs panel
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    return jsonify([job_dict(job) for job in Job.query.order_by(Job.id.desc()).limit(limit)])
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_dict(job))
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if 'user_id' not in session or session['role'] != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if not job_queue.cancel(job):
+        return jsonify({'error': f"Job {job_id} has already finished."}), 409
+    return jsonify(job_dict(job))
+
+@app.route('/metrics')
+def metrics():
+    if request_metrics is None:
+        return jsonify({'error': 'Metrics are not enabled'}), 404
+    if session.get('role') != 'admin' and not has_api_key():
+        return jsonify({'error': 'Unauthorized'}), 403
+    return Response(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def print_generator_report(report):
+    if report.result:
+        result = report.result
+        click.echo(f"Placed {len(result.events) - len(result.unplaced)} of {len(result.events)} lessons "
+                   f"in {result.seconds:.2f}s ({result.iterations} repair iterations).")
+    for problem in report.problems:
+        click.echo(f"Warning: {problem}")
+
+@app.cli.command('generate-timetable')
+@click.option('--term-start', required=True, type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--term-end', required=True, type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--cycle-weeks', default=1, type=click.IntRange(1, 2), help="2 for a Week A/B fortnightly timetable.")
+@click.option('--max-class-size', default=30, type=click.IntRange(1))
+@click.option('--time-limit', default=10.0, help="Seconds allowed for the search.")
+@click.option('--seed', default=0)
+@click.option('--dry-run', is_flag=True, help="Solve and report without writing lessons.")
+def generate_timetable_command(term_start, term_end, cycle_weeks, max_class_size, time_limit, seed, dry_run):
+    """Generate a clash-free timetable from subject requirements and assignments."""
+    init_database()
+    if cycle_weeks == 2 and school_calendar().cycle_weeks != 2:
+        raise click.ClickException("Set the school calendar to a Week A/B rotation before generating a fortnightly timetable.")
+    report = generate_timetable(term_start.date(), term_end.date(), cycle_weeks, max_class_size, time_limit, seed, dry_run,
+                                reject_clashes=app.config['CLASH_POLICY'] == 'reject')
+    print_generator_report(report)
+    if not dry_run:
+        invalidate_weeks(None)
+        click.echo(f"Wrote {report.lessons_written} recurring lessons.")
+
+@app.cli.command('teacher-unavailable')
+@click.argument('username')
+@click.option('--day', type=click.IntRange(0, 6), help="0 = Monday. Omit for every day.")
+@click.option('--period', type=int, help="Period number. Omit for the whole day.")
+@click.option('--time-limit', default=10.0)
+def teacher_unavailable_command(username, day, period, time_limit):
+    """Record that a teacher cannot teach and re-solve the generated timetable around it."""
+    init_database()
+    teacher = User.query.filter_by(username=username, role='staff').first()
+    if not teacher:
+        raise click.ClickException(f"No staff member called '{username}'.")
+    for weekday in ([day] if day is not None else range(7)):
+        db.session.add(TeacherUnavailability(user_id=teacher.id, weekday=weekday, period=period))
+    db.session.commit()
+
+    for term_start, term_end in generated_terms():
+        if term_end < datetime.today().date():
+            continue
+        click.echo(f"Re-solving term {term_start} to {term_end}...")
+        report = resolve_generated_term(term_start, term_end, time_limit=time_limit,
+                                        reject_clashes=app.config['CLASH_POLICY'] == 'reject')
+        print_generator_report(report)
+        click.echo(f"Changed {report.lessons_changed} lessons.")
+    invalidate_weeks(None)
+
+@app.cli.command('scan-clashes')
+@click.option('--start', 'start_date', required=True, type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--end', 'end_date', required=True, type=click.DateTime(formats=['%Y-%m-%d']))
+def scan_clashes_command(start_date, end_date):
+    """Report every teacher, room and user double booking between two dates."""
+    init_database()
+    clashes = scan_for_clashes(start_date.date(), end_date.date())
+    for clash in clashes:
+        click.echo(f"{clash['date']} {clash['kind']} {clash['name']}: {clash['first']} overlaps {clash['second']}")
+    click.echo(f"{len(clashes)} clashes found.")
+
+@app.cli.command('import-data')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--kind', required=True, type=click.Choice(IMPORT_KINDS + ['all']),
+              help="What the rows are; 'all' imports each sheet of a workbook named after a kind.")
+@click.option('--sheet', help="Worksheet to read from an .xlsx file (default: the active one).")
+@click.option('--workers', type=click.IntRange(1), help="Password hashing processes (default: one per CPU).")
+@click.option('--allow-clashes', is_flag=True, help="Import lessons even if they double-book someone.")
+def import_data_command(path, kind, sheet, workers, allow_clashes):
+    """Import users, subjects, rooms, subject assignments or lessons from a CSV or XLSX file."""
+    init_database()
+
+    def progress(report):
+        click.echo(f"{report.kind}: {report.rows} rows processed, {report.created} created")
+
+    try:
+        with open(path, 'rb') as stream:
+            reports = import_file(stream, path, kind, sheet, workers, allow_clashes, progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    invalidate_weeks(None)
+    for report in reports:
+        for row_number, message in report.errors:
+            click.echo(f"{report.kind} row {row_number}: {message}")
+        if report.error_count > len(report.errors):
+            click.echo(f"... and {report.error_count - len(report.errors)} more {report.kind} errors")
+        click.echo(report.summary())
+
+@app.cli.command('seed-school')
+@click.option('--size', default='small', type=click.Choice(list(SIZES)), help="Preset to start from.")
+@click.option('--year-groups', type=click.IntRange(1), help="Override the preset's number of year groups.")
+@click.option('--students-per-year', type=click.IntRange(1))
+@click.option('--subjects', type=click.IntRange(1))
+@click.option('--weeks', type=click.IntRange(1), help="Weeks of lessons to create.")
+@click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']), help="First week of lessons (default: this school year's).")
+@click.option('--seed', default=0)
+def seed_school_command(size, year_groups, students_per_year, subjects, weeks, start, seed):
+    """Fill an empty database with a synthetic school for load and benchmark runs."""
+    init_database()
+    if User.query.filter(User.role != 'admin').first() or Timetable.query.first():
+        raise click.ClickException("The database already has users or lessons; point DATABASE_URL at an empty one.")
+    try:
+        school_size = SchoolSize.named(size, year_groups=year_groups, students_per_year=students_per_year,
+                                       subjects=subjects, weeks=weeks)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    school = generate_school(school_size, start.date() if start else None, seed)
+    invalidate_weeks(None)
+    click.echo(school.summary())
+
+@app.cli.command('rebuild-analytics')
+def rebuild_analytics_command():
+    """Recompute the room, teacher and subject usage totals from the whole timetable."""
+    init_database()
+    started = datetime.now()
+    weeks = rebuild_usage()
+    click.echo(f"Recomputed {weeks} weeks of usage in {(datetime.now() - started).total_seconds():.2f}s.")
+
+@app.cli.command('run-jobs')
+@click.option('--workers', type=click.IntRange(1), help="Worker processes (default: JOB_WORKERS, at least 1).")
+def run_jobs_command(workers):
+    """Run background job workers until interrupted; use with JOB_WORKERS=0 on the web server."""
+    init_database()
+    processes = job_queue.start_workers(workers or max(app.config['JOB_WORKERS'], 1), daemon=False)
+    click.echo(f"Running {len(processes)} job workers.")
+    for process in processes:
+        process.join()
+
+@app.cli.command('compact-changes')
+@click.option('--retention-days', type=int, default=None, help="Drop changes older than this (default CHANGE_LOG_RETENTION_DAYS).")
+def compact_changes_command(retention_days):
+    """Drop superseded and expired rows from the change log behind /changes."""
+    init_database()
+    if retention_days is None:
+        retention_days = app.config['CHANGE_LOG_RETENTION_DAYS']
+    removed = compact_changes(retention_days)
+    click.echo(f"Removed {removed} change log rows.")
 
 # Ensure this is at the bottom
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
-        create_default_admin()
-        initialize_school_settings()
+        init_database()
         print("Database initialized successfully!")
     
     app.run(debug=True)
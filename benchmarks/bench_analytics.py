@@ -0,0 +1,51 @@
+"""Time the term-wide usage report from the weekly aggregates against computing the same totals by
+reading every lesson of the term, on a synthetic medium-sized school.
+
+Run from the repository root: python benchmarks/bench_analytics.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db
+from synthetic_school import SchoolSize, generate_school
+from analytics import UsageReport, add_lesson, iter_lessons, rebuild_usage, refresh_weeks, week_start_of
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def scan_term(start_date, end_date):
+    # What answering the report without aggregates costs: every lesson of the term read and counted
+    totals = {}
+    for _, minutes, room_id, teacher_id, subject_id, year_groups in iter_lessons(start_date, end_date):
+        add_lesson(totals, minutes, room_id, teacher_id, subject_id, year_groups)
+    return totals
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - started) * 1000
+
+
+if __name__ == '__main__':
+    app = make_app()
+    with app.app_context():
+        db.create_all()
+        school = generate_school(SchoolSize.named('medium'))
+        print(school.summary() + "\n")
+
+        print(f"{'operation':<34} {'time (ms)':>10}")
+        print(f"{'rebuild (one pass)':<34} {timed(rebuild_usage):>10.1f}")
+        print(f"{'refresh one week after a write':<34} {timed(refresh_weeks, [week_start_of(school.start)]):>10.1f}")
+        print(f"{'term report from aggregates':<34} {timed(UsageReport, school.start, school.end):>10.1f}")
+        print(f"{'term totals by reading lessons':<34} {timed(scan_term, school.start, school.end):>10.1f}")
@@ -0,0 +1,108 @@
+"""Page through a school year of entries with /api/v1/entries cursors, then compare the time and
+peak memory of single page requests with reading and serializing the whole range at once.
+
+Run from the repository root: python benchmarks/bench_api_pages.py
+"""
+import os
+import sys
+import time
+import tracemalloc
+from datetime import date, time as dt_time, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, User, Timetable, user_timetable
+from api import api
+
+TEACHERS = 80
+TERM_START = date(2025, 1, 6)
+TERM_WEEKS = 39
+PERIODS = [(dt_time(9 + hour, 0), dt_time(9 + hour, 50)) for hour in range(7)]
+PAGE_SIZE = 500
+API_KEY = 'benchmark'
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['API_KEYS'] = [API_KEY]
+    app.config['API_MAX_PAGE_SIZE'] = PAGE_SIZE
+    db.init_app(app)
+    app.register_blueprint(api)
+    return app
+
+
+def seed():
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [
+        {'username': f'teacher{i}', 'password': 'x', 'role': 'staff', 'year_group': None} for i in range(TEACHERS)
+    ])
+    days = [TERM_START + timedelta(weeks=week, days=day) for week in range(TERM_WEEKS) for day in range(5)]
+    entries, links = [], []
+    for day in days:
+        for start_time, end_time in PERIODS:
+            for teacher in range(TEACHERS):
+                entry_id = len(entries) + 1
+                entries.append({
+                    'id': entry_id, 'date': day, 'week': day.isocalendar()[1], 'day_of_week': day.strftime('%A'),
+                    'subject': f'Subject {entry_id % 30}', 'teacher': f'teacher{teacher}', 'teacher_id': teacher + 1,
+                    'start_time': start_time, 'end_time': end_time, 'room': f'Room {teacher}',
+                    'is_substitute': False, 'is_free_day': False
+                })
+                links.append({'user_id': teacher + 1, 'timetable_id': entry_id})
+    db.session.execute(Timetable.__table__.insert(), entries)
+    db.session.execute(user_timetable.insert(), links)
+    db.session.commit()
+    return days[0], days[-1], len(entries)
+
+
+def load_everything(start_date, end_date):
+    # What a client without paging costs: every entry of the range read and serialized at once
+    entries = Timetable.query.filter(Timetable.date.between(start_date, end_date)).order_by(
+        Timetable.date, Timetable.start_time, Timetable.id
+    ).all()
+    return [{'id': entry.id, 'date': entry.date.isoformat(), 'start_time': entry.start_time.isoformat(),
+             'subject': entry.subject, 'teacher': entry.teacher, 'room': entry.room} for entry in entries]
+
+
+def measure(function, *args, **kwargs):
+    """Return (seconds, peak traced memory in MiB) for one call."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    function(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 2 ** 20
+
+
+if __name__ == '__main__':
+    app = make_app()
+    with app.app_context():
+        start_date, end_date, total = seed()
+        client = app.test_client()
+        headers = {'Authorization': f'Bearer {API_KEY}'}
+
+        urls, cursor = [], None
+        started = time.perf_counter()
+        while True:
+            url = f'/api/v1/entries?start={start_date}&end={end_date}&limit={PAGE_SIZE}'
+            if cursor:
+                url += f'&cursor={cursor}'
+            urls.append(url)
+            cursor = client.get(url, headers=headers).get_json()['next_cursor']
+            if not cursor:
+                break
+        sync_time = time.perf_counter() - started
+
+        print(f"{total} entries, {len(urls)} pages of {PAGE_SIZE}; full sync over HTTP took {sync_time:.2f}s\n")
+        print(f"{'request':<22} {'time (ms)':>10} {'peak memory (MiB)':>18}")
+        for name, page in (('first page', 0), ('middle page', len(urls) // 2), ('last page', len(urls) - 1)):
+            db.session.expunge_all()
+            elapsed, peak = measure(client.get, urls[page], headers=headers)
+            print(f"{name:<22} {elapsed * 1000:>10.1f} {peak:>18.1f}")
+        db.session.expunge_all()
+        elapsed, peak = measure(load_everything, start_date, end_date)
+        print(f"{'whole range at once':<22} {elapsed * 1000:>10.1f} {peak:>18.1f}")
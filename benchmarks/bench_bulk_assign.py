@@ -0,0 +1,72 @@
+"""Time assigning one timetable entry to a whole population, per-user ORM appends versus the bulk INSERT ... SELECT path.
+
+Run from the repository root: python benchmarks/bench_bulk_assign.py
+"""
+import os
+import sys
+import time
+from datetime import date, time as dt_time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, User, Timetable
+from bulk import assign_users_bulk, all_user_ids
+
+POPULATIONS = [100, 500, 2000, 5000]
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def seed(population):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [
+        {'username': f'student{i}', 'password': 'x', 'role': 'student', 'year_group': str(7 + i % 5)}
+        for i in range(population)
+    ])
+    db.session.commit()
+
+
+def free_day():
+    return Timetable(date=date(2025, 1, 6), subject='Free day', teacher='N/A',
+                     start_time=dt_time(0, 0), end_time=dt_time(23, 59), room='N/A')
+
+
+def per_user():
+    entry = free_day()
+    db.session.add(entry)
+    for user_id in [u.id for u in User.query.filter(User.role != 'admin').all()]:
+        entry.users.append(User.query.get(user_id))
+    db.session.commit()
+
+
+def bulk():
+    entry = free_day()
+    db.session.add(entry)
+    assign_users_bulk(entry, all_user_ids())
+    db.session.commit()
+
+
+def timed(fn):
+    db.session.expunge_all()
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    app = make_app()
+    print(f"{'users':>8} {'per-user (ms)':>15} {'bulk (ms)':>12} {'speedup':>9}")
+    with app.app_context():
+        for population in POPULATIONS:
+            seed(population)
+            slow = timed(per_user)
+            fast = timed(bulk)
+            print(f"{population:>8} {slow * 1000:>15.1f} {fast * 1000:>12.1f} {slow / fast:>8.1f}x")
@@ -0,0 +1,96 @@
+"""Time write-time clash checks and the term-wide clash scan as the number of timetable entries grows.
+
+Run from the repository root: python benchmarks/bench_clash_check.py
+"""
+import os
+import random
+import sys
+import time
+from datetime import date, time as dt_time, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, User, Room, Timetable, user_timetable
+from clashes import find_clashes, scan_for_clashes
+from bulk import year_group_user_ids
+
+ENTRY_COUNTS = [10000, 30000, 60000]
+TEACHERS = 80
+ROOMS = 60
+STUDENTS = 1500
+CLASS_SIZE = 25
+TERM_START = date(2025, 1, 6)
+TERM_WEEKS = 39
+PERIODS = [(dt_time(9 + hour, 0), dt_time(9 + hour, 50)) for hour in range(7)]
+DOUBLE_BOOKED = 0.01  # share of entries given a teacher who is already busy
+CHECKS = 500
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def school_days():
+    return [TERM_START + timedelta(weeks=week, days=day) for week in range(TERM_WEEKS) for day in range(5)]
+
+
+def seed(entry_count, rng):
+    # A clash-free school: each slot gets distinct teachers, rooms and classes, then a few double bookings
+    db.drop_all()
+    db.create_all()
+    users = [{'username': f'teacher{i}', 'password': 'x', 'role': 'staff', 'year_group': None} for i in range(TEACHERS)]
+    users += [{'username': f'student{i}', 'password': 'x', 'role': 'student', 'year_group': str(7 + i % 5)}
+              for i in range(STUDENTS)]
+    db.session.execute(User.__table__.insert(), users)
+    db.session.execute(Room.__table__.insert(), [{'id': i + 1, 'name': f'Room {i}'} for i in range(ROOMS)])
+
+    classes = [range(TEACHERS + start + 1, TEACHERS + start + CLASS_SIZE + 1) for start in range(0, STUDENTS, CLASS_SIZE)]
+    per_slot = min(TEACHERS, ROOMS, len(classes))
+    slots = [(day, period) for day in school_days() for period in PERIODS]
+    entries, links = [], []
+    for entry_id in range(1, entry_count + 1):
+        (day, (start_time, end_time)), position = slots[(entry_id - 1) // per_slot], (entry_id - 1) % per_slot
+        teacher = rng.randrange(TEACHERS) if rng.random() < DOUBLE_BOOKED else position
+        entries.append({
+            'id': entry_id, 'date': day, 'week': day.isocalendar()[1], 'day_of_week': day.strftime('%A'),
+            'subject': f'Subject {entry_id % 30}', 'teacher': f'teacher{teacher}', 'teacher_id': teacher + 1,
+            'start_time': start_time, 'end_time': end_time, 'room': f'Room {position}', 'room_id': position + 1,
+            'is_substitute': False, 'is_free_day': False
+        })
+        links.append({'user_id': teacher + 1, 'timetable_id': entry_id})
+        links.extend({'user_id': user_id, 'timetable_id': entry_id} for user_id in classes[position])
+    db.session.execute(Timetable.__table__.insert(), entries)
+    db.session.execute(user_timetable.insert(), links)
+    db.session.commit()
+
+
+def time_checks(rng, user_ids):
+    days = school_days()
+    start = time.perf_counter()
+    found = 0
+    for _ in range(CHECKS):
+        start_time, end_time = rng.choice(PERIODS)
+        found += bool(find_clashes(rng.choice(days), start_time, end_time,
+                                   teacher_id=rng.randrange(TEACHERS) + 1, room_id=rng.randrange(ROOMS) + 1,
+                                   user_ids=user_ids()))
+    return (time.perf_counter() - start) / CHECKS, found / CHECKS
+
+
+if __name__ == '__main__':
+    app = make_app()
+    rng = random.Random(0)
+    print(f"{'entries':>8} {'1 user (ms)':>12} {'year group (ms)':>16} {'clashing':>9} {'term scan (s)':>14} {'clashes':>9}")
+    with app.app_context():
+        for entry_count in ENTRY_COUNTS:
+            seed(entry_count, rng)
+            single, clashing = time_checks(rng, lambda: [TEACHERS + rng.randrange(STUDENTS) + 1])
+            group, _ = time_checks(rng, lambda: year_group_user_ids(str(rng.randrange(7, 12))))
+            start = time.perf_counter()
+            clashes = scan_for_clashes(TERM_START, TERM_START + timedelta(weeks=TERM_WEEKS))
+            scan = time.perf_counter() - start
+            print(f"{entry_count:>8} {single * 1000:>12.2f} {group * 1000:>16.2f} {clashing:>8.0%} {scan:>14.2f} {len(clashes):>9}")
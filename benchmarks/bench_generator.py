@@ -0,0 +1,83 @@
+"""Solve synthetic schools of growing size with the timetable generator's solver.
+
+Each school has seven year groups. Every student takes four core subjects and
+one option from each of four option blocks (two subjects per block), three
+lessons a week each, in classes of at most 30.
+
+Run from the repository root: python benchmarks/bench_generator.py [--cycle-weeks 2]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from solver import Section, SlotGrid, solve_timetable, allocate_teachers, build_events, TimetableSolver
+
+SCHOOLS = [(300, 20, 16), (750, 50, 30), (1500, 100, 60), (3000, 200, 120)]  # students, teachers, rooms
+YEAR_GROUPS = [str(year) for year in range(7, 14)]
+CORE_SUBJECTS = 4
+OPTION_BLOCKS = [(4, 5), (6, 7), (8, 9), (10, 11)]
+LESSONS_PER_WEEK = 3
+MAX_CLASS_SIZE = 30
+
+
+def synthetic_sections(students, teachers, cycle_weeks, rng):
+    subjects = CORE_SUBJECTS + 2 * len(OPTION_BLOCKS)
+    teachers_of = {subject: [] for subject in range(subjects)}
+    for teacher in range(teachers):
+        # Each teacher is qualified in two subjects
+        teachers_of[teacher % subjects].append(teacher)
+        teachers_of[(teacher + 5) % subjects].append(teacher)
+
+    sections = []
+    student_id = 0
+    for year_group in YEAR_GROUPS:
+        size = students // len(YEAR_GROUPS)
+        cohort = list(range(student_id, student_id + size))
+        student_id += size
+        takers = {subject: [] for subject in range(subjects)}
+        for student in cohort:
+            options = [rng.choice(block) for block in OPTION_BLOCKS]
+            for subject in list(range(CORE_SUBJECTS)) + options:
+                takers[subject].append(student)
+        for subject, members in takers.items():
+            count = -(-len(members) // MAX_CLASS_SIZE)
+            for number in range(count):
+                group = members[number::count]
+                sections.append(Section(
+                    key=(subject, year_group, number), subject_id=subject, subject_name=f"Subject {subject}",
+                    year_group=year_group, student_ids=group, teacher_ids=teachers_of[subject],
+                    lessons_per_cycle=LESSONS_PER_WEEK * cycle_weeks
+                ))
+    return sections
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cycle-weeks', type=int, default=1)
+    parser.add_argument('--time-limit', type=float, default=20.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    grid = SlotGrid(days_per_week=5, periods_per_day=6, cycle_weeks=args.cycle_weeks)
+    print(f"{'students':>8} {'teachers':>8} {'rooms':>5} {'lessons':>7} {'unplaced':>8} {'iterations':>10} {'solve (s)':>9} {'re-solve (s)':>12} {'moved':>5}")
+    for students, teachers, rooms in SCHOOLS:
+        rng = random.Random(args.seed)
+        sections = synthetic_sections(students, teachers, args.cycle_weeks, rng)
+        result = solve_timetable(sections, grid, list(range(rooms)), time_limit=args.time_limit, seed=args.seed)
+
+        # Incremental re-solve: one busy teacher becomes unavailable on Monday
+        busiest = max(range(teachers), key=lambda t: sum(1 for e in result.events if e.teacher_id == t))
+        blocked = {busiest: {grid.slot(week, 0, period) for week in range(args.cycle_weeks) for period in range(grid.periods_per_day)}}
+        previous = [event.slot for event in result.events]
+        solver = TimetableSolver(result.events, grid, list(range(rooms)), blocked, seed=args.seed)
+        started = time.perf_counter()
+        again = solver.solve(time_limit=args.time_limit, initial_slots=previous)
+        resolve_seconds = time.perf_counter() - started
+        moved = sum(1 for before, event in zip(previous, again.events) if before != event.slot)
+
+        print(f"{students:>8} {teachers:>8} {rooms:>5} {len(result.events):>7} {len(result.unplaced):>8} "
+              f"{result.iterations:>10} {result.seconds:>9.2f} {resolve_seconds:>12.2f} {moved:>5}")
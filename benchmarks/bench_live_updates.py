@@ -0,0 +1,57 @@
+"""Time the live update fan-out: how long one write takes to find and wake the open pages of the
+users it affects, with thousands of pages open, on a synthetic medium-sized school.
+
+Run from the repository root: python benchmarks/bench_live_updates.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, User
+from synthetic_school import SchoolSize, generate_school
+from changelog import log_changes, latest_seq, users_changed_since
+from live_updates import LiveUpdates
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - started) * 1000, result
+
+
+if __name__ == '__main__':
+    app = make_app()
+    with app.app_context():
+        db.create_all()
+        school = generate_school(SchoolSize.named('medium'))
+        print(school.summary() + "\n")
+        user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.role != 'admin')]
+
+        # Every user has a page open; nothing waits on them, so only the fan-out itself is timed
+        hub = LiveUpdates(app, max_connections=len(user_ids), poll_seconds=60)
+        hub._follower = object()  # Don't start the follower thread
+        for user_id in user_ids:
+            hub.subscribe(user_id)
+
+        year_group = user_ids[:len(user_ids) // len(school.year_groups)]
+        print(f"{'operation':<44} {'time (ms)':>10}")
+        for label, affected in [('one user', user_ids[:1]), (f'a year group ({len(year_group)} users)', year_group),
+                                (f'everyone ({len(user_ids)} users)', user_ids)]:
+            seq = latest_seq()
+            log_ms, _ = timed(log_changes, affected, ['1'])
+            read_ms, (changed, everyone, _) = timed(users_changed_since, seq)
+            wake_ms, woken = timed(hub.publish, changed)
+            print(f"{'log ' + label:<44} {log_ms:>10.1f}")
+            print(f"{'  find the users with new changes':<44} {read_ms:>10.1f}")
+            print(f"{f'  wake their {woken} open pages':<44} {wake_ms:>10.1f}")
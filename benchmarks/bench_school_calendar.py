@@ -0,0 +1,57 @@
+"""Time expanding a school year of recurring lessons into dates with the school calendar's lookup
+table versus the old per-date ISO week arithmetic, and building the table itself.
+
+Run from the repository root: python benchmarks/bench_school_calendar.py
+"""
+import os
+import sys
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recurring import lesson_dates
+from school_calendar import SchoolCalendar
+
+Term = namedtuple('Term', 'name start_date end_date first_week')
+Holiday = namedtuple('Holiday', 'name start_date end_date')
+Lesson = namedtuple('Lesson', 'weekday week_parity term_start term_end')
+
+YEAR_START, YEAR_END = date(2025, 9, 1), date(2026, 7, 22)
+TERMS = [Term('Autumn', date(2025, 9, 1), date(2025, 12, 19), 'A'),
+         Term('Spring', date(2026, 1, 5), date(2026, 3, 27), None),
+         Term('Summer', date(2026, 4, 13), date(2026, 7, 22), None)]
+HOLIDAYS = [Holiday('Half term', date(2025, 10, 27), date(2025, 10, 31)),
+            Holiday('Half term', date(2026, 2, 16), date(2026, 2, 20)),
+            Holiday('Half term', date(2026, 5, 25), date(2026, 5, 29))]
+LESSON_COUNTS = [100, 1000, 5000]  # 5000 is about every weekly lesson of a large school
+
+
+def legacy_lesson_dates(lesson, start_date, end_date):
+    # The old expansion: the ISO week of every candidate date picks Week A or B
+    day = max(start_date, lesson.term_start)
+    day += timedelta(days=(lesson.weekday - day.weekday()) % 7)
+    while day <= min(end_date, lesson.term_end):
+        if not lesson.week_parity or ('A' if day.isocalendar()[1] % 2 == 1 else 'B') == lesson.week_parity:
+            yield day
+        day += timedelta(weeks=1)
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return (time.perf_counter() - started) * 1000, result
+
+
+if __name__ == '__main__':
+    build_ms, calendar = timed(lambda: SchoolCalendar(2, TERMS, HOLIDAYS))
+    print(f"Built the {len(calendar._days)} day table in {build_ms:.2f} ms\n")
+
+    print(f"{'lessons':>8} {'ISO weeks (ms)':>15} {'lookup table (ms)':>18} {'dates':>8}")
+    for count in LESSON_COUNTS:
+        lessons = [Lesson(number % 5, (None, 'A', 'B')[number % 3], YEAR_START, YEAR_END) for number in range(count)]
+        legacy_ms, legacy = timed(lambda: sum(1 for lesson in lessons for _ in legacy_lesson_dates(lesson, YEAR_START, YEAR_END)))
+        table_ms, dates = timed(lambda: sum(1 for lesson in lessons for _ in lesson_dates(lesson, YEAR_START, YEAR_END, calendar)))
+        # The table also drops holidays and the weeks between terms, so it yields fewer dates
+        print(f"{count:>8} {legacy_ms:>15.1f} {table_ms:>18.1f} {dates:>8}")
@@ -0,0 +1,111 @@
+"""Time finding cover for a day of staff absences with the per-day free/busy bitmaps, against
+checking every member of staff with find_clashes() for every lesson that needs covering.
+
+Run from the repository root: python benchmarks/bench_substitutes.py
+"""
+import os
+import random
+import sys
+import time
+from datetime import date, time as dt_time, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, User, Timetable, Subject, AssignedSubject, user_timetable
+from clashes import find_clashes
+from substitutes import plan_cover, find_substitutes, _staff_days, _cover_weeks
+
+TEACHERS = 120
+STUDENTS = 1500
+CLASS_SIZE = 25
+SUBJECTS = 30
+WEEK_START = date(2025, 1, 6)
+PERIODS = [(dt_time(9 + hour, 0), dt_time(9 + hour, 50)) for hour in range(7)]
+ABSENCES = [1, 5, 15]
+LOOKUPS = 200
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def seed(rng):
+    # Every class has a lesson in every period of the week, each with a teacher who is free then
+    db.create_all()
+    users = [{'username': f'teacher{i}', 'password': 'x', 'role': 'staff', 'year_group': None} for i in range(TEACHERS)]
+    users += [{'username': f'student{i}', 'password': 'x', 'role': 'student', 'year_group': str(7 + i % 5)}
+              for i in range(STUDENTS)]
+    db.session.execute(User.__table__.insert(), users)
+    db.session.execute(Subject.__table__.insert(), [{'id': i + 1, 'name': f'Subject {i}'} for i in range(SUBJECTS)])
+    db.session.execute(AssignedSubject.__table__.insert(), [
+        {'user_id': teacher + 1, 'subject_id': subject + 1}
+        for teacher in range(TEACHERS) for subject in rng.sample(range(SUBJECTS), 3)
+    ])
+
+    classes = [range(TEACHERS + start + 1, TEACHERS + start + CLASS_SIZE + 1) for start in range(0, STUDENTS, CLASS_SIZE)]
+    entries, links = [], []
+    for day in (WEEK_START + timedelta(days=offset) for offset in range(5)):
+        for start_time, end_time in PERIODS:
+            teachers = rng.sample(range(TEACHERS), len(classes))
+            for position, students in enumerate(classes):
+                entry_id = len(entries) + 1
+                subject = rng.randrange(SUBJECTS)
+                entries.append({
+                    'id': entry_id, 'date': day, 'week': day.isocalendar()[1], 'day_of_week': day.strftime('%A'),
+                    'subject': f'Subject {subject}', 'subject_id': subject + 1,
+                    'teacher': f'teacher{teachers[position]}', 'teacher_id': teachers[position] + 1,
+                    'start_time': start_time, 'end_time': end_time, 'room': f'Room {position}',
+                    'is_substitute': rng.random() < 0.03, 'is_free_day': False
+                })
+                links.append({'user_id': teachers[position] + 1, 'timetable_id': entry_id})
+                links.extend({'user_id': user_id, 'timetable_id': entry_id} for user_id in students)
+    db.session.execute(Timetable.__table__.insert(), entries)
+    db.session.execute(user_timetable.insert(), links)
+    db.session.commit()
+
+
+def clash_check_cover(day, absent_ids):
+    # The old way: try every member of staff against every lesson of the absent teachers
+    staff = db.session.query(User.id, User.username).filter(User.role == 'staff').all()
+    lessons = Timetable.query.filter(Timetable.date == day, Timetable.teacher_id.in_(absent_ids)).all()
+    plan = []
+    for lesson in lessons:
+        free = [user_id for user_id, username in staff if user_id not in absent_ids
+                and not find_clashes(day, lesson.start_time, lesson.end_time, teacher_id=user_id)]
+        plan.append(free)
+    return plan
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    rng = random.Random(14)
+    app = make_app()
+    with app.app_context():
+        seed(rng)
+        day = WEEK_START + timedelta(days=2)
+
+        print(f"{'absent':>6} {'lessons':>8} {'clash checks (ms)':>18} {'bitmaps cold (ms)':>18} {'bitmaps warm (ms)':>18}")
+        for absent in ABSENCES:
+            absent_ids = rng.sample(range(1, TEACHERS + 1), absent)
+            legacy, _ = timed(clash_check_cover, day, absent_ids)
+            _staff_days.clear()
+            _cover_weeks.clear()
+            cold, plan = timed(plan_cover, absent_ids, day, day)
+            warm, _ = timed(plan_cover, absent_ids, day, day)
+            print(f"{absent:>6} {len(plan):>8} {legacy * 1000:>18.1f} {cold * 1000:>18.1f} {warm * 1000:>18.1f}")
+
+        start = time.perf_counter()
+        for _ in range(LOOKUPS):
+            start_time, end_time = rng.choice(PERIODS)
+            find_substitutes(day, start_time, end_time, subject_id=rng.randrange(1, SUBJECTS + 1))
+        print(f"\nSingle slot lookup with warm bitmaps: {(time.perf_counter() - start) / LOOKUPS * 1000:.2f} ms")
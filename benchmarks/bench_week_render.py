@@ -0,0 +1,103 @@
+"""Time rendering timetable.html for weeks with many entries, with entries bucketed per day
+by week_days() versus the old template loop that filtered every entry once per day column.
+
+The legacy timing renders the same templates with only the day loops in _week_table.html swapped back.
+
+Run from the repository root: python benchmarks/bench_week_render.py
+"""
+import os
+import sys
+import time
+from datetime import date, time as dt_time, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask import Flask
+from jinja2 import ChoiceLoader, DictLoader
+from week_grid import week_days
+
+ENTRY_COUNTS = [35, 200, 800, 2000]  # 2000 is about a year group of 60 classes
+WEEK_START = date(2025, 1, 6)
+PERIODS = [(dt_time(9 + hour, 0), dt_time(9 + hour, 50)) for hour in range(7)]
+RENDERS = 20
+
+LEGACY_DAY_LOOPS = [
+    ("""{% for day in days %}
+            <th>{{ day.name }} - {{ day.date.strftime('%d/%m') }}{% include '_calendar_day.html' %}</th>""",
+     """{% for day in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"] %}
+            <th>{{ day }} - {{ (week_start + timedelta(days=loop.index0)).strftime('%d/%m') }}</th>"""),
+    ("""{% for day in days %}
+            <td data-date="{{ day.date.strftime('%Y-%m-%d') }}">""",
+     """{% for day in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"] %}
+            <td data-date="{{ (week_start + timedelta(days=loop.index0)).strftime('%Y-%m-%d') }}">"""),
+    ("{% for entry in day.entries %}", "{% for entry in timetable if entry.date.strftime('%A') == day %}"),
+]
+
+
+class Entry:
+    """Stands in for a Timetable row with the attributes the template reads."""
+
+    is_recurring = False
+    is_free_day = False
+    is_substitute = False
+    note = None
+
+    def __init__(self, entry_id, day, start_time, end_time):
+        self.id = entry_id
+        self.date = day
+        self.start_time = start_time
+        self.end_time = end_time
+        self.subject = f'Subject {entry_id % 30}'
+        self.teacher = f'teacher{entry_id % 80}'
+        self.room = f'Room {entry_id % 60}'
+
+
+def make_app():
+    app = Flask(__name__, template_folder=os.path.join(ROOT, 'templates'))
+    for endpoint in ('dashboard', 'timetable', 'timetable_range', 'timetable_events', 'changes'):
+        app.add_url_rule(f'/{endpoint}', endpoint, lambda: '')
+    return app
+
+
+def make_week(entry_count):
+    slots = [(WEEK_START + timedelta(days=day), period) for day in range(5) for period in PERIODS]
+    entries = []
+    for entry_id in range(entry_count):
+        day, (start_time, end_time) = slots[entry_id % len(slots)]
+        entries.append(Entry(entry_id, day, start_time, end_time))
+    return sorted(entries, key=lambda entry: (entry.date, entry.start_time))
+
+
+def time_render(template, entries, bucketed):
+    context = dict(timetable=entries, week_range='', permission_level='admin', week_start=WEEK_START,
+                   previous_week='', next_week='', timedelta=timedelta, students=[],
+                   current_user=Entry(0, WEEK_START, None, None), feed_token=None, change_seq=0,
+                   days=week_days([], WEEK_START))  # The legacy loops only read the days for the week's bounds
+    start = time.perf_counter()
+    for _ in range(RENDERS):
+        if bucketed:
+            context['days'] = week_days(entries, WEEK_START)
+        template.render(**context)
+    return (time.perf_counter() - start) / RENDERS
+
+
+if __name__ == '__main__':
+    app = make_app()
+    with app.test_request_context():
+        legacy_source = app.jinja_env.loader.get_source(app.jinja_env, '_week_table.html')[0]
+        for current, legacy in LEGACY_DAY_LOOPS:
+            assert current in legacy_source, "_week_table.html no longer has the expected day loops"
+            legacy_source = legacy_source.replace(current, legacy)
+        legacy_env = app.jinja_env.overlay(
+            loader=ChoiceLoader([DictLoader({'_week_table.html': legacy_source}), app.jinja_env.loader])
+        )
+        current_template = app.jinja_env.get_template('timetable.html')
+        legacy_template = legacy_env.get_template('timetable.html')
+
+        print(f"{'entries':>8} {'per-day filter (ms)':>20} {'day buckets (ms)':>17} {'speedup':>8}")
+        for entry_count in ENTRY_COUNTS:
+            entries = make_week(entry_count)
+            legacy = time_render(legacy_template, entries, bucketed=False)
+            bucketed = time_render(current_template, entries, bucketed=True)
+            print(f"{entry_count:>8} {legacy * 1000:>20.2f} {bucketed * 1000:>17.2f} {legacy / bucketed:>7.1f}x")
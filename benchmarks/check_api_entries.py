@@ -0,0 +1,75 @@
+"""Fail if /api/v1/entries returns a cancelled recurring occurrence.
+
+Cancelling one week of a recurring lesson keeps a replacement entry with no users. Creates a
+weekly lesson in a temporary database, cancels one occurrence from the admin timetable and
+checks that every filter of the entries endpoint (none, user, teacher, room and subject) lists
+the other weeks and not the cancelled one.
+
+Run from the repository root: python benchmarks/check_api_entries.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+from datetime import date, time, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TERM_START, TERM_END = date(2026, 10, 5), date(2026, 10, 30)  # Four Mondays
+CANCELLED = date(2026, 10, 19)
+
+
+def run_check(directory):
+    # The app reads its configuration on import, so point it at the temporary database first
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'school.db')}"
+    os.environ['JOB_WORKERS'] = '0'
+    from app import app, init_database
+    from models import db, User, Subject, Room, RecurringLesson
+    from recurring import occurrence_key
+
+    with app.app_context():
+        init_database()
+        teacher = User(username='check_teacher', password='unused', role='staff')
+        student = User(username='check_student', password='unused', role='student', year_group='7')
+        subject, room = Subject(name='Maths'), Room('Room 1')
+        db.session.add_all([teacher, student, subject, room])
+        db.session.flush()
+        lesson = RecurringLesson(TERM_START, TERM_END, subject.name, teacher.username, time(9, 0), time(10, 0), room.name,
+                                 subject_id=subject.id, teacher_id=teacher.id, room_id=room.id)
+        lesson.users = [teacher, student]
+        db.session.add(lesson)
+        db.session.commit()
+        filters = {'no filter': '', 'user_id': f'&user_id={student.id}', 'teacher_id': f'&teacher_id={teacher.id}',
+                   'room_id': f'&room_id={room.id}', 'subject_id': f'&subject_id={subject.id}'}
+        key = occurrence_key(lesson.id, CANCELLED)
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    response = client.post('/admin_timetable', data={'action': 'cancel_occurrence', 'occurrence': key})
+    if response.status_code != 302:
+        raise RuntimeError(f"Cancelling {key}: expected 302, got {response.status_code}")
+
+    expected = [(TERM_START + timedelta(weeks=week)).isoformat() for week in range(4)]
+    expected.remove(CANCELLED.isoformat())
+    failures = 0
+    for name, query in filters.items():
+        response = client.get(f'/api/v1/entries?start={TERM_START}&end={TERM_END}{query}')
+        dates = [row['date'] for row in response.get_json()['data']]
+        passed = response.status_code == 200 and dates == expected
+        failures += not passed
+        print(f"{name:<12} {'ok' if passed else 'FAIL'} {', '.join(dates)}")
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    return failures == 0
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp(prefix='timetable-api-check-')
+    try:
+        passed = run_check(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,76 @@
+"""Fail if a users import run as a background job cannot hash its passwords in parallel.
+
+Queues an import_file job for a CSV of users with plain passwords and two hashing workers,
+runs it in a real job worker process (daemonic, as the web app starts them) against a
+temporary database, and checks that the job succeeded and created every user.
+
+Run from the repository root: python benchmarks/check_job_import.py
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+USERS = 40
+HASH_WORKERS = 2
+TIMEOUT_SECONDS = 120
+
+
+def write_users(path):
+    with open(path, 'w', newline='') as stream:
+        writer = csv.writer(stream)
+        writer.writerow(['username', 'role', 'year_group', 'password'])
+        for number in range(USERS):
+            writer.writerow([f'import-check-{number}', 'student', '7', f'password-{number}'])
+
+
+def run_check(directory):
+    # The app reads its configuration on import; its worker processes inherit the environment
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'school.db')}"
+    os.environ['UPLOAD_DIR'] = directory
+    os.environ['JOB_WORKERS'] = '0'  # Started below, once the job is queued
+    from app import app, init_database, job_queue
+    from models import db, Job, User
+
+    with app.app_context():
+        init_database()
+        path = os.path.join(directory, 'users.csv')
+        write_users(path)
+        job = job_queue.submit('import_file', dict(
+            path=path, filename='users.csv', kind='users', allow_clashes=False, workers=HASH_WORKERS
+        ), message="Importing users.csv")
+        job_id = job.id
+        processes = job_queue.start_workers(1)
+        try:
+            deadline = time.monotonic() + TIMEOUT_SECONDS
+            while True:
+                db.session.remove()
+                job = db.session.get(Job, job_id)
+                if job.status in ('succeeded', 'failed', 'cancelled') or time.monotonic() > deadline:
+                    break
+                time.sleep(0.5)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+        created = User.query.filter(User.username.like('import-check-%')).count()
+        status, error = job.status, job.error
+        db.session.remove()
+        db.engine.dispose()
+
+    print(f"Import job {job_id}: {status}{f' ({error})' if error else ''}; {created} of {USERS} users created")
+    return status == 'succeeded' and created == USERS
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp(prefix='timetable-job-check-')
+    try:
+        passed = run_check(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,127 @@
+"""Fail if the SQL statements behind a timetable week page grow with the number of entries.
+
+Builds a synthetic school in a temporary database, counts the statements each week page runs
+(the student and staff /timetable and /admin_timetable for a user, a subject and a year group),
+then adds a copy of every lesson in that week, each with a note, and counts again. The week
+cache is off, so every page reads its entries from the database both times.
+
+Run from the repository root: python benchmarks/check_query_counts.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def login(client, username, password):
+    response = client.post('/login', data={'username': username, 'password': password})
+    if response.status_code != 302:
+        raise RuntimeError(f"Could not log in as {username}: {response.status_code}")
+
+
+def build_pages(app, school, week):
+    from models import User, Subject
+
+    student = User.query.filter_by(role='student').order_by(User.id).first()
+    teacher = User.query.filter_by(role='staff').order_by(User.id).first()
+    subject = Subject.query.order_by(Subject.id).first()
+    student_client, teacher_client, admin_client = app.test_client(), app.test_client(), app.test_client()
+    login(student_client, student.username, school.password)
+    login(teacher_client, teacher.username, school.password)
+    login(admin_client, 'admin', 'admin123')
+    return {
+        'display_timetable student': (student_client, f'/timetable?week={week}'),
+        'display_timetable staff': (teacher_client, f'/timetable?week={week}'),
+        'admin_timetable user': (admin_client, f'/admin_timetable?week={week}&user_id={student.id}'),
+        'admin_timetable subject': (admin_client, f'/admin_timetable?week={week}&subject_id={subject.id}'),
+        'admin_timetable year group': (admin_client, f'/admin_timetable?week={week}&year_group={school.year_groups[0]}'),
+    }
+
+
+def count_statements(pages, counter):
+    counts = {}
+    for name, (client, url) in pages.items():
+        client.get(url)  # Warm-up: per-process caches such as the school calendar
+        counter.count = 0
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{name}: expected 200, got {response.status_code}")
+        counts[name] = counter.count
+    return counts
+
+
+def copy_week(week_start):
+    """Add a copy of every lesson in the week, with the same attendees and a note; returns the entries now in it."""
+    from models import db, Timetable, Note, user_timetable
+
+    week_end = week_start + timedelta(days=6)
+    lessons = Timetable.query.filter(Timetable.date.between(week_start, week_end), Timetable.is_free_day.is_(False)).all()
+    copies = [Timetable(date=lesson.date, subject=lesson.subject, teacher=lesson.teacher,
+                        start_time=lesson.start_time, end_time=lesson.end_time, room=lesson.room,
+                        subject_id=lesson.subject_id, teacher_id=lesson.teacher_id, room_id=lesson.room_id)
+              for lesson in lessons]
+    db.session.add_all(copies)
+    db.session.flush()
+    db.session.execute(user_timetable.insert(), [{'user_id': user.id, 'timetable_id': copy.id}
+                                                 for lesson, copy in zip(lessons, copies) for user in lesson.users])
+    db.session.add_all(Note(timetable_id=copy.id, content="Copied lesson.") for copy in copies)
+    db.session.commit()
+    return Timetable.query.filter(Timetable.date.between(week_start, week_end)).count()
+
+
+def run_check(directory):
+    # The app reads its configuration on import, so point it at the temporary database first
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'school.db')}"
+    os.environ['WEEK_CACHE_BACKEND'] = 'none'
+    os.environ['JOB_WORKERS'] = '0'
+    from sqlalchemy import event
+    from app import app, init_database, invalidate_weeks
+    from models import db, Timetable
+    from synthetic_school import SchoolSize, generate_school
+
+    with app.app_context():
+        init_database()
+        school = generate_school(SchoolSize.named('small', weeks=2), seed=0)
+        week_start = school.start + timedelta(weeks=1)
+        pages = build_pages(app, school, week_start.isoformat())
+        counter = StatementCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+        entries = [Timetable.query.filter(Timetable.date.between(week_start, week_start + timedelta(days=6))).count()]
+        counts = [count_statements(pages, counter)]
+        entries.append(copy_week(week_start))
+        invalidate_weeks(None, week_start)
+        counts.append(count_statements(pages, counter))
+
+        event.remove(db.engine, 'before_cursor_execute', counter)
+        db.session.remove()
+        db.engine.dispose()
+
+    print(f"{'page':<30} {f'{entries[0]} entries':>12} {f'{entries[1]} entries':>12}")
+    for name in pages:
+        print(f"{name:<30} {counts[0][name]:>12} {counts[1][name]:>12}")
+    changed = [name for name in pages if counts[0][name] != counts[1][name]]
+    for name in changed:
+        print(f"GROWS {name}: {counts[0][name]} -> {counts[1][name]} statements")
+    return not changed
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp(prefix='timetable-query-counts-')
+    try:
+        passed = run_check(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(0 if passed else 1)
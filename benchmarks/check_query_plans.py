@@ -0,0 +1,109 @@
+"""Fail if the timetable lookup queries stop using an index.
+
+Runs EXPLAIN QUERY PLAN for the queries behind display_timetable, admin_timetable,
+the get_* JSON endpoints, the /api/v1 entry pages, the clash checks and the usage reports against a freshly
+created schema.
+
+Run from the repository root: python benchmarks/check_query_plans.py
+"""
+import os
+import sys
+from datetime import date, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import text, tuple_
+from models import db, User, Timetable, AssignedSubject, Note, RecurringLesson, WeeklyUsage, TimetableChange, user_timetable
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def lookup_queries():
+    week_start, week_end = date(2025, 1, 6), date(2025, 1, 12)
+    return {
+        'week for user': Timetable.query.filter(
+            Timetable.users.any(id=1),
+            Timetable.date.between(week_start, week_end)
+        ).order_by(Timetable.date, Timetable.start_time),
+        'week for year group': Timetable.query.filter(
+            Timetable.users.any(User.id.in_([1, 2, 3])),
+            Timetable.date.between(week_start, week_end)
+        ).order_by(Timetable.date, Timetable.start_time),
+        'entry assignees': db.session.query(user_timetable.c.user_id).filter(user_timetable.c.timetable_id.in_([1, 2])),
+        'entry notes': Note.query.filter(Note.timetable_id.in_([1, 2])),
+        'recurring overrides': Timetable.query.filter(
+            Timetable.recurring_lesson_id.in_([1, 2]),
+            Timetable.occurrence_date.between(week_start, week_end)
+        ),
+        'recurring lessons in term': RecurringLesson.query.filter(
+            RecurringLesson.term_start <= week_end,
+            RecurringLesson.term_end >= week_start
+        ),
+        'teacher clashes on date': Timetable.query.filter(
+            Timetable.teacher_id == 1,
+            Timetable.date.in_([week_start]),
+            Timetable.start_time < time(10, 0),
+            Timetable.end_time > time(9, 0)
+        ),
+        'room clashes on date': Timetable.query.filter(
+            Timetable.room_id == 1,
+            Timetable.date.in_([week_start]),
+            Timetable.start_time < time(10, 0),
+            Timetable.end_time > time(9, 0)
+        ),
+        'recurring teacher clashes': RecurringLesson.query.filter(
+            RecurringLesson.teacher_id == 1,
+            RecurringLesson.weekday.in_([0])
+        ),
+        'entries of renamed room': Timetable.query.filter(Timetable.room_id == 1),
+        'recurring lessons of renamed subject': RecurringLesson.query.filter(RecurringLesson.subject_id == 1),
+        'api entries after cursor': Timetable.query.filter(
+            Timetable.date.between(week_start, week_end),
+            tuple_(Timetable.date, Timetable.start_time, Timetable.id) > tuple_(week_start, time(9, 0), 10),
+            db.exists().where(user_timetable.c.timetable_id == Timetable.id)
+        ).order_by(Timetable.date, Timetable.start_time, Timetable.id).limit(101),
+        'latest timetable change': db.session.query(db.func.max(User.timetable_updated_at)),
+        'usage totals for term': db.session.query(
+            WeeklyUsage.key_id, WeeklyUsage.year_group, db.func.sum(WeeklyUsage.lessons)
+        ).filter(
+            WeeklyUsage.week_start.between(week_start, date(2025, 4, 4)), WeeklyUsage.kind == 'room'
+        ).group_by(WeeklyUsage.key_id, WeeklyUsage.year_group),
+        'changes for user since': db.session.query(TimetableChange.entry_key, db.func.max(TimetableChange.seq)).filter(
+            db.or_(TimetableChange.user_id == 1, TimetableChange.user_id.is_(None)),
+            TimetableChange.seq > 100, TimetableChange.seq <= 200
+        ).group_by(TimetableChange.entry_key),
+        'subjects of user': AssignedSubject.query.filter_by(user_id=1),
+        'users of subject': AssignedSubject.query.filter_by(subject_id=1),
+        'students in year group': User.query.filter_by(year_group='7', role='student'),
+        'staff': User.query.filter_by(role='staff'),
+    }
+
+
+def full_scans(query):
+    sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    plan = db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+    details = [row[-1] for row in plan]
+    # "SCAN <table>" without an index means every row is read
+    return [d for d in details if d.startswith('SCAN') and 'INDEX' not in d], details
+
+
+if __name__ == '__main__':
+    app = make_app()
+    failures = 0
+    with app.app_context():
+        db.create_all()
+        for name, query in lookup_queries().items():
+            scans, details = full_scans(query)
+            status = 'FULL SCAN' if scans else 'ok'
+            print(f"{name:<28} {status}")
+            for detail in details:
+                print(f"    {detail}")
+            failures += bool(scans)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,143 @@
+"""Reproduce the morning login spike against a running server: every student logs in and fetches
+/timetable, with up to --concurrency students at once, then report p50/p95/p99 latency.
+
+Seed the students once into the database the server uses, start the server, then run the spike:
+
+    python benchmarks/load_login_spike.py seed --users 1000
+    python wsgi.py
+    python benchmarks/load_login_spike.py run --users 1000 --concurrency 100 --url http://127.0.0.1:8000
+
+The client is plain asyncio (one connection per request), so it needs nothing beyond the standard library.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import date, time as dt_time, timedelta
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+USERNAME = 'loadtest_student{}'
+PASSWORD = 'loadtest-password'
+PERIODS = [(dt_time(9 + hour, 0), dt_time(9 + hour, 50)) for hour in range(7)]
+
+
+def seed(user_count):
+    from werkzeug.security import generate_password_hash
+    from app import app, init_database
+    from models import db, User, Timetable, user_timetable
+
+    with app.app_context():
+        init_database()
+        # One hash for everyone: it still costs a full pbkdf2 check at login, without hashing 1,000 times here
+        password = generate_password_hash(PASSWORD, method='pbkdf2:sha256')
+        existing = {username for username, in db.session.query(User.username).filter(User.username.like('loadtest_%'))}
+        new_users = [
+            {'username': USERNAME.format(i), 'password': password, 'role': 'student', 'year_group': 'LT'}
+            for i in range(user_count) if USERNAME.format(i) not in existing
+        ]
+        if new_users:
+            db.session.execute(User.__table__.insert(), new_users)
+        student_ids = [user_id for user_id, in db.session.query(User.id).filter(User.year_group == 'LT')]
+
+        # A full week of lessons this week for every student
+        week_start = date.today() - timedelta(days=date.today().weekday())
+        if not Timetable.query.filter(Timetable.subject == 'Load test', Timetable.date >= week_start).first():
+            for offset in range(5):
+                day = week_start + timedelta(days=offset)
+                for start_time, end_time in PERIODS:
+                    entry = Timetable(date=day, subject='Load test', teacher='loadtest_teacher',
+                                      start_time=start_time, end_time=end_time, room='Hall')
+                    db.session.add(entry)
+                    db.session.flush()
+                    db.session.execute(user_timetable.insert(), [
+                        {'user_id': user_id, 'timetable_id': entry.id} for user_id in student_ids
+                    ])
+        db.session.commit()
+        print(f"{len(student_ids)} load test students with a week of lessons each.")
+
+
+async def http_request(host, port, method, path, headers=(), body=b''):
+    """Send one request on a new connection; return (status, Set-Cookie values)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}:{port}", "Connection: close",
+             f"Content-Length: {len(body)}", *headers]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head = response.partition(b"\r\n\r\n")[0].decode('latin-1').split("\r\n")
+    status = int(head[0].split(" ", 2)[1])
+    cookies = [line.split(":", 1)[1].strip().split(";", 1)[0] for line in head[1:]
+               if line.lower().startswith('set-cookie:')]
+    return status, cookies
+
+
+async def student(index, host, port, results, limit):
+    async with limit:
+        started = time.perf_counter()
+        form = urlencode({'username': USERNAME.format(index), 'password': PASSWORD}).encode()
+        try:
+            status, cookies = await http_request(host, port, 'POST', '/login', [
+                "Content-Type: application/x-www-form-urlencoded"
+            ], form)
+            results['login'].append((time.perf_counter() - started, status))
+            if status != 302:
+                return
+            fetched = time.perf_counter()
+            status, _ = await http_request(host, port, 'GET', '/timetable', [f"Cookie: {'; '.join(cookies)}"])
+            results['timetable'].append((time.perf_counter() - fetched, status))
+            results['login + timetable'].append((time.perf_counter() - started, status))
+        except OSError as error:
+            results['login'].append((time.perf_counter() - started, type(error).__name__))
+
+
+def percentile(values, fraction):
+    # Nearest rank
+    return values[max(0, min(len(values) - 1, round(fraction * len(values)) - 1))]
+
+
+async def run(url, user_count, concurrency):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    results = {'login': [], 'timetable': [], 'login + timetable': []}
+    limit = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(*(student(i, host, port, results, limit) for i in range(user_count)))
+    elapsed = time.perf_counter() - started
+
+    print(f"{user_count} students, {concurrency} at a time, finished in {elapsed:.1f}s "
+          f"({user_count / elapsed:.1f} students/s)\n")
+    print(f"{'request':<18} {'ok':>6} {'failed':>7} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for name, samples in results.items():
+        ok = sorted(seconds * 1000 for seconds, status in samples if status in (200, 302))
+        failed = {}
+        for _, status in samples:
+            if status not in (200, 302):
+                failed[status] = failed.get(status, 0) + 1
+        if ok:
+            print(f"{name:<18} {len(ok):>6} {len(samples) - len(ok):>7} {percentile(ok, 0.5):>9.0f} "
+                  f"{percentile(ok, 0.95):>9.0f} {percentile(ok, 0.99):>9.0f} {ok[-1]:>9.0f}")
+        else:
+            print(f"{name:<18} {0:>6} {len(samples):>7}")
+        if failed:
+            print(f"{'':<18} failures: {', '.join(f'{status} x{count}' for status, count in sorted(failed.items(), key=str))}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    seed_parser = commands.add_parser('seed', help="create the load test students and their lessons")
+    seed_parser.add_argument('--users', type=int, default=1000)
+    run_parser = commands.add_parser('run', help="run the spike against a running server")
+    run_parser.add_argument('--users', type=int, default=1000)
+    run_parser.add_argument('--concurrency', type=int, default=100)
+    run_parser.add_argument('--url', default='http://127.0.0.1:8000')
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        seed(args.users)
+    else:
+        asyncio.run(run(args.url, args.users, args.concurrency))
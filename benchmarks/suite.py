@@ -0,0 +1,255 @@
+"""End-to-end benchmark suite: build a synthetic school in a temporary database, time the key
+request paths through the app and count the SQL statements each one runs, write the results to
+JSON and fail if any path runs more statements than the baseline, or is slower than the local
+timings by more than the tolerance.
+
+    python benchmarks/suite.py                     # compare with the baseline and local timings
+    python benchmarks/suite.py --save-baseline     # record the statement counts as the baseline
+    python benchmarks/suite.py --save-timings      # record this machine's timings
+
+The statement counts in benchmarks/baseline.json are the same on every machine, so that file is
+committed. Timings are not: benchmarks/timings.json stays out of the tree, so record it on the
+machine that runs the comparison, before making the change being measured. The rendered week
+cache is off, so the week views are timed doing their real work, and no job
+workers run: the bulk assignments run their queued job inline, inside the timed call.
+
+Run from the repository root: python benchmarks/suite.py
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+DEFAULT_TIMINGS = os.path.join(ROOT, 'benchmarks', 'timings.json')
+DEFAULT_OUTPUT = os.path.join(ROOT, 'benchmarks', 'results.json')
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def login(client, username, password):
+    response = client.post('/login', data={'username': username, 'password': password})
+    if response.status_code != 302:
+        raise RuntimeError(f"Could not log in as {username}: {response.status_code}")
+
+
+def drain_jobs(job_queue):
+    # Run every queued job in this process, as a job worker would
+    job = job_queue.claim()
+    while job is not None:
+        job_queue.run(job)
+        job = job_queue.claim()
+
+
+def build_cases(app, school):
+    from app import job_queue
+    from models import db, User, Subject, Room, Note, Timetable
+
+    student = User.query.filter_by(role='student').order_by(User.id).first()
+    teacher = User.query.filter_by(role='staff').order_by(User.id).first()
+    subject = Subject.query.order_by(Subject.id).first()
+    room = Room.query.order_by(Room.id).first()
+    noted_entry = db.session.query(Note.timetable_id).order_by(Note.id).first()[0]
+    entry = Timetable.query.filter_by(is_free_day=False).order_by(Timetable.id).first().id
+    year_group = school.year_groups[0]
+    week = (school.start + timedelta(weeks=min(4, (school.end - school.start).days // 7))).isoformat()
+
+    student_client, teacher_client, admin_client = app.test_client(), app.test_client(), app.test_client()
+    login(student_client, student.username, school.password)
+    login(teacher_client, teacher.username, school.password)
+    login(admin_client, 'admin', 'admin123')
+
+    bulk_runs = {'count': 0}
+
+    def bulk(action, form):
+        # A Saturday after the last lesson, a week later each run, so the new entries never clash
+        def run():
+            bulk_runs['count'] += 1
+            day = school.end + timedelta(days=6 + 7 * bulk_runs['count'])
+            response = admin_client.post('/admin_timetable', data={
+                'action': action, 'date': day.isoformat(), 'start_time': '09:00', 'end_time': '10:00',
+                'subject_id': subject.id, 'teacher_id': teacher.id, 'room_id': room.id, **form
+            })
+            drain_jobs(job_queue)
+            return response
+        return run
+
+    def get(client, url):
+        return lambda: client.get(url)
+
+    return {
+        'login': (lambda: app.test_client().post('/login', data={'username': student.username, 'password': school.password}), 302),
+        'display_timetable student': (get(student_client, f'/timetable?week={week}'), 200),
+        'display_timetable staff': (get(teacher_client, f'/timetable?week={week}'), 200),
+        'admin_timetable user': (get(admin_client, f'/admin_timetable?week={week}&user_id={student.id}'), 200),
+        'admin_timetable subject': (get(admin_client, f'/admin_timetable?week={week}&subject_id={subject.id}'), 200),
+        'admin_timetable year group': (get(admin_client, f'/admin_timetable?week={week}&year_group={year_group}'), 200),
+        'get_assigned_subjects': (get(admin_client, f'/get_assigned_subjects/{student.id}'), 200),
+        'get_assigned_users': (get(admin_client, f'/get_assigned_users/{subject.id}'), 200),
+        'get_students_by_year_group': (get(admin_client, f'/get_students_by_year_group/{year_group}'), 200),
+        'get_subject_users': (get(admin_client, f'/get_subject_users/{subject.id}'), 200),
+        'get_subject_teachers': (get(admin_client, f'/get_subject_teachers/{subject.id}'), 200),
+        'get_entry_details': (get(admin_client, f'/get_entry_details/{entry}'), 200),
+        'get_entry_assignees': (get(admin_client, f'/get_entry_assignees/{entry}'), 200),
+        'get_note': (get(admin_client, f'/get_note/{noted_entry}'), 200),
+        'bulk assign year group': (bulk('assign_by_year_group', {'year_group': year_group}), 302),
+        'bulk assign subject': (bulk('assign_by_subject', {'original_subject_id': subject.id}), 302),
+    }
+
+
+def time_case(run, expected_status, repeat, counter):
+    run()  # Warm-up: first-use imports, template compilation and SQLite page cache
+    samples, statements = [], 0
+    for _ in range(repeat):
+        counter.count = 0
+        started = time.perf_counter()
+        response = run()
+        samples.append((time.perf_counter() - started) * 1000)
+        statements = max(statements, counter.count)
+        if response.status_code != expected_status:
+            raise RuntimeError(f"Expected {expected_status}, got {response.status_code}")
+    return {'median_ms': round(statistics.median(samples), 3), 'min_ms': round(min(samples), 3), 'runs': repeat,
+            'statements': statements}
+
+
+def compare_statements(results, baseline):
+    """Return the cases that run more SQL statements than the baseline."""
+    regressions = []
+    for name, result in results['cases'].items():
+        before = baseline['cases'].get(name)
+        if before is not None and result['statements'] > before['statements']:
+            regressions.append((name, before['statements'], result['statements']))
+    return regressions
+
+
+def compare_timings(results, timings, tolerance, floor_ms):
+    """Return the cases slower than the recorded timings by more than tolerance and floor_ms."""
+    regressions = []
+    for name, result in results['cases'].items():
+        before = timings['cases'].get(name)
+        if before is None:
+            continue
+        limit = max(before['median_ms'] * (1 + tolerance), before['median_ms'] + floor_ms)
+        if result['median_ms'] > limit:
+            regressions.append((name, before['median_ms'], result['median_ms']))
+    return regressions
+
+
+def load_reference(path, args, kind):
+    """Read a baseline or timings file, or return None if it is missing or for another school."""
+    if not os.path.exists(path):
+        print(f"No {kind} at {path}; run with --save-{kind} to record one.")
+        return None
+    with open(path) as stream:
+        reference = json.load(stream)
+    if (reference['size'], reference['seed']) != (args.size, args.seed):
+        print(f"The {kind} at {path} is for the {reference['size']} school with seed {reference['seed']}; not comparing.")
+        return None
+    return reference
+
+
+def run_suite(args, directory):
+    # The app reads its configuration on import, so point it at the temporary database first
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'school.db')}"
+    os.environ['WEEK_CACHE_BACKEND'] = 'none'
+    os.environ['JOB_WORKERS'] = '0'  # Jobs run inline, see build_cases
+    from sqlalchemy import event
+    from app import app, init_database
+    from models import db
+    from synthetic_school import SchoolSize, generate_school
+
+    with app.app_context():
+        init_database()
+        started = time.perf_counter()
+        school = generate_school(SchoolSize.named(args.size), seed=args.seed)
+        print(f"Built the {args.size} school in {time.perf_counter() - started:.1f}s: {school.summary()}\n")
+
+        cases = build_cases(app, school)
+        if args.only:
+            cases = {name: case for name, case in cases.items() if any(part in name for part in args.only)}
+        results = {'size': args.size, 'seed': args.seed, 'entries': school.entries, 'links': school.links, 'cases': {}}
+        counter = StatementCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+        print(f"{'case':<30} {'median (ms)':>12} {'min (ms)':>10} {'statements':>11}")
+        for name, (run, expected_status) in cases.items():
+            result = results['cases'][name] = time_case(run, expected_status, args.repeat, counter)
+            print(f"{name:<30} {result['median_ms']:>12.1f} {result['min_ms']:>10.1f} {result['statements']:>11}")
+        event.remove(db.engine, 'before_cursor_execute', counter)
+        db.session.remove()
+        db.engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', default='small', choices=['small', 'medium', 'large'], help="Synthetic school preset.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per case, after one warm-up.")
+    parser.add_argument('--only', action='append', help="Run only the cases whose name contains this (repeatable).")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--timings', default=DEFAULT_TIMINGS)
+    parser.add_argument('--save-baseline', action='store_true', help="Write the statement counts to --baseline instead of comparing.")
+    parser.add_argument('--save-timings', action='store_true', help="Write the timings to --timings instead of comparing.")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown as a fraction of the recorded median.")
+    parser.add_argument('--floor-ms', type=float, default=2.0, help="Slowdowns smaller than this are never regressions.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='timetable-bench-')
+    try:
+        results = run_suite(args, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    write_json(args.output, results)
+    print()
+    if args.save_baseline or args.save_timings:
+        if args.save_baseline:
+            counts = {name: {'statements': result['statements']} for name, result in results['cases'].items()}
+            write_json(args.baseline, {'size': args.size, 'seed': args.seed, 'cases': counts})
+            print(f"Saved the statement counts to {args.baseline}")
+        if args.save_timings:
+            write_json(args.timings, results)
+            print(f"Saved the timings to {args.timings}")
+        return 0
+
+    regressions = 0
+    baseline = load_reference(args.baseline, args, 'baseline')
+    if baseline is not None:
+        grown = compare_statements(results, baseline)
+        for name, before, after in grown:
+            print(f"REGRESSION {name}: {before} -> {after} statements")
+        print(f"{len(grown)} statement regressions against {args.baseline}")
+        regressions += len(grown)
+    timings = load_reference(args.timings, args, 'timings')
+    if timings is not None:
+        slower = compare_timings(results, timings, args.tolerance, args.floor_ms)
+        for name, before, after in slower:
+            print(f"REGRESSION {name}: {before:.1f} ms -> {after:.1f} ms")
+        print(f"{len(slower)} timing regressions against {args.timings} (tolerance {args.tolerance:.0%}, floor {args.floor_ms} ms)")
+        regressions += len(slower)
+    return 1 if regressions else 0
+
+
+def write_json(path, data):
+    with open(path, 'w') as stream:
+        json.dump(data, stream, indent=2)
+        stream.write('\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
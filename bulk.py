@@ -0,0 +1,36 @@
+from sqlalchemy import select, literal
+from models import db, User, AssignedSubject, RecurringLesson, user_timetable, user_recurring_lesson
+
+# Set-based assignment of timetable entries to many users. The target users are
+# described as a SELECT of user ids and linked with a single INSERT ... SELECT,
+# so no User rows are loaded into the session.
+
+
+def subject_user_ids(subject_id):
+    return select(AssignedSubject.user_id.label('user_id')).where(AssignedSubject.subject_id == subject_id)
+
+
+def year_group_user_ids(year_group):
+    return select(User.id.label('user_id')).where(User.year_group == year_group)
+
+
+def all_user_ids():
+    return select(User.id.label('user_id')).where(User.role != 'admin')
+
+
+def assign_users_bulk(entry, user_ids):
+    """Link a Timetable entry or RecurringLesson to every user id selected by user_ids. Returns the number of links written."""
+    if entry.id is None:
+        db.session.flush()
+
+    if isinstance(entry, RecurringLesson):
+        table, column = user_recurring_lesson, 'recurring_lesson_id'
+    else:
+        table, column = user_timetable, 'timetable_id'
+
+    targets = user_ids.subquery()
+    # Skip users who are already linked (e.g. a teacher added alongside the class)
+    existing = select(table.c.user_id).where(table.c[column] == entry.id)
+    rows = select(targets.c.user_id, literal(entry.id)).where(targets.c.user_id.not_in(existing)).distinct()
+    result = db.session.execute(table.insert().from_select(['user_id', column], rows))
+    return result.rowcount
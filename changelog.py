@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+from sqlalchemy import func, or_
+from models import db, Timetable, RecurringLesson, TimetableChange, ChangeLogCompaction, user_timetable
+from recurring import LessonOccurrence, is_occurrence_key, parse_occurrence_key, lesson_dates
+from school_calendar import school_calendar
+
+# Change log behind /changes, so a client mirroring one user's timetable
+# fetches what changed since its last sync instead of whole weeks.
+#
+# Every write appends one row per affected user and entry key, or one row
+# for everyone (see invalidate_weeks in app.py); seq only ever grows. The log records which
+# entries changed, not how: /changes reads each changed entry's current
+# state, so an entry the user can still see is sent whole ('upsert') and one
+# that is gone or no longer theirs is sent as a 'delete'. Writes that cannot
+# be described per entry log one row for everyone with no key, and any
+# client behind it downloads its timetable again ('resync').
+#
+# compact_changes() keeps the log bounded: only the newest row per user and
+# entry is needed, and rows older than the retention are dropped. Clients
+# whose cursor is older than the dropped rows are told to resync.
+
+SERIES_PREFIX = 'series:'
+
+
+def change_key(entry):
+    """The log key of a dated entry, a lesson occurrence or a recurring lesson series."""
+    if isinstance(entry, RecurringLesson):
+        return f"{SERIES_PREFIX}{entry.id}"
+    return str(entry.id)
+
+
+def log_changes(user_ids, keys, compact_every=None, retention_days=None):
+    """Append the changed keys for each of user_ids. user_ids=None logs the keys once for
+    everyone, or a resync for everyone when there are no keys.
+
+    Returns the new highest seq. Every compact_every rows the log is compacted.
+    """
+    before = latest_seq()
+    now = datetime.utcnow()
+    if user_ids is None:
+        rows = [{'user_id': None, 'entry_key': key, 'changed_at': now} for key in dict.fromkeys(keys or [None])]
+    else:
+        rows = [{'user_id': user_id, 'entry_key': key, 'changed_at': now}
+                for user_id in set(user_ids) for key in dict.fromkeys(keys)]
+    if not rows:
+        return before
+    db.session.execute(TimetableChange.__table__.insert(), rows)
+    db.session.commit()
+    after = latest_seq()
+    if compact_every and before // compact_every != after // compact_every:
+        compact_changes(retention_days)
+    return after
+
+
+def latest_seq():
+    # Compaction can remove the newest rows, but never moves the sequence back
+    return max(db.session.query(func.max(TimetableChange.seq)).scalar() or 0, pruned_through())
+
+
+def pruned_through():
+    return db.session.query(func.max(ChangeLogCompaction.pruned_through)).scalar() or 0
+
+
+def changes_since(user_id, since, through, limit):
+    """The keys changed for user_id after since, up to seq through, oldest first, as
+    (resync, [(key, seq)], has_more). A key changed several times is listed once, at its latest seq.
+    """
+    if since < pruned_through():
+        return True, [], False
+    latest = func.max(TimetableChange.seq)
+    rows = db.session.query(TimetableChange.entry_key, latest).filter(
+        or_(TimetableChange.user_id == user_id, TimetableChange.user_id.is_(None)),
+        TimetableChange.seq > since,
+        TimetableChange.seq <= through
+    ).group_by(TimetableChange.entry_key).order_by(latest).limit(limit + 1).all()
+    if any(key is None for key, _ in rows):
+        return True, [], False
+    return False, rows[:limit], len(rows) > limit
+
+
+def users_changed_since(since):
+    """(user ids, whether a row for everyone was logged, latest seq) for the rows after since."""
+    rows = db.session.query(TimetableChange.user_id, func.max(TimetableChange.seq)).filter(
+        TimetableChange.seq > since
+    ).group_by(TimetableChange.user_id).all()
+    user_ids = {user_id for user_id, _ in rows if user_id is not None}
+    everyone = any(user_id is None for user_id, _ in rows)
+    return user_ids, everyone, max([since] + [seq for _, seq in rows])
+
+
+def resolve_changes(user_id, keys):
+    """The current state of each key as seen by user_id: the entry, or None where it is gone for them."""
+    found = {}
+    dated_ids = [int(key) for key in keys if key.isdigit()]
+    if dated_ids:
+        visible = db.session.query(user_timetable.c.timetable_id).filter(
+            user_timetable.c.user_id == user_id, user_timetable.c.timetable_id.in_(dated_ids)
+        )
+        for entry in Timetable.query.filter(Timetable.id.in_(visible)):
+            found[str(entry.id)] = entry
+
+    calendar = None
+    for key in keys:
+        if key.startswith(SERIES_PREFIX):
+            lesson = RecurringLesson.query.get(int(key[len(SERIES_PREFIX):]))
+            if lesson and any(user.id == user_id for user in lesson.users):
+                found[key] = lesson
+        elif is_occurrence_key(key):
+            lesson_id, day = parse_occurrence_key(key)
+            lesson = RecurringLesson.query.get(lesson_id) if lesson_id else None
+            if not lesson or not any(user.id == user_id for user in lesson.users):
+                continue
+            if calendar is None:
+                calendar = school_calendar()
+            replaced = Timetable.query.filter_by(recurring_lesson_id=lesson.id, occurrence_date=day).first()
+            if replaced is None and day in lesson_dates(lesson, day, day, calendar):
+                found[key] = LessonOccurrence(lesson, day)
+    return {key: found.get(key) for key in keys}
+
+
+def compact_changes(retention_days=None, now=None):
+    """Drop rows superseded by a later change to the same user and entry, and rows older than
+    retention_days. Returns the number of rows removed."""
+    newest = db.session.query(func.max(TimetableChange.seq)).group_by(TimetableChange.user_id, TimetableChange.entry_key)
+    removed = db.session.query(TimetableChange).filter(
+        TimetableChange.seq.not_in(newest)
+    ).delete(synchronize_session=False)
+
+    if retention_days is not None:
+        cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+        expired_through = db.session.query(func.max(TimetableChange.seq)).filter(TimetableChange.changed_at < cutoff).scalar()
+        if expired_through:
+            removed += db.session.query(TimetableChange).filter(
+                TimetableChange.seq <= expired_through
+            ).delete(synchronize_session=False)
+            db.session.add(ChangeLogCompaction(pruned_through=expired_through))
+    db.session.commit()
+    return removed
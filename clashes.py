@@ -0,0 +1,248 @@
+from collections import defaultdict
+from sqlalchemy import and_, bindparam, exists, literal, or_, select, union_all
+from models import db, User, Room, Timetable, RecurringLesson, user_timetable, user_recurring_lesson
+from recurring import lesson_dates
+from school_calendar import school_calendar
+
+# Double-booking checks for teachers, rooms and assigned users.
+#
+# Write-time checks run two prebuilt queries (dated entries and recurring
+# lessons) that use the (teacher_id, date) and (room_id, date) indexes to look
+# only at the dates and times being booked. Teachers and rooms are matched by
+# key; the name columns are only shown in the report. The term-wide scan loads every booking once
+# into an IntervalIndex (bookings per resource and date, sorted by start time)
+# and sweeps each bucket for overlaps.
+
+MAX_REPORTED = 10
+
+
+class Clash:
+    def __init__(self, kind, name, date, start_time, end_time, subject):
+        self.kind = kind  # 'teacher', 'room' or 'user'
+        self.name = name
+        self.date = date
+        self.start_time = start_time
+        self.end_time = end_time
+        self.subject = subject
+
+    def __str__(self):
+        return (f"{self.kind.capitalize()} {self.name} is already booked for {self.subject} on "
+                f"{self.date.strftime('%Y-%m-%d')} {self.start_time.strftime('%H:%M')}-{self.end_time.strftime('%H:%M')}")
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'name': self.name,
+            'date': self.date.strftime('%Y-%m-%d'),
+            'start_time': self.start_time.strftime('%H:%M'),
+            'end_time': self.end_time.strftime('%H:%M'),
+            'subject': self.subject
+        }
+
+
+def _overlapping(table, *criteria):
+    return and_(
+        table.c.start_time < bindparam('end_time'),
+        table.c.end_time > bindparam('start_time'),
+        *criteria
+    )
+
+
+def _build_dated_query():
+    entry, user = Timetable.__table__, User.__table__
+    overlapping = _overlapping(
+        entry,
+        entry.c.date.in_(bindparam('dates', expanding=True)),
+        entry.c.is_free_day == False,
+        entry.c.id != bindparam('exclude_entry_id')
+    )
+    # Cancelled recurring occurrences are rows without users, so they book nothing
+    booked = exists().where(user_timetable.c.timetable_id == entry.c.id)
+    columns = (entry.c.subject, entry.c.date, entry.c.start_time, entry.c.end_time)
+    return union_all(
+        select(literal('teacher').label('kind'), entry.c.teacher.label('name'), *columns).where(
+            overlapping, entry.c.teacher_id == bindparam('teacher_id'), booked),
+        select(literal('room').label('kind'), entry.c.room.label('name'), *columns).where(
+            overlapping, entry.c.room_id == bindparam('room_id'), booked),
+        select(literal('user').label('kind'), user.c.username.label('name'), *columns).select_from(
+            entry.join(user_timetable, user_timetable.c.timetable_id == entry.c.id).join(user, user.c.id == user_timetable.c.user_id)
+        ).where(overlapping, user_timetable.c.user_id.in_(bindparam('user_ids', expanding=True)),
+                or_(entry.c.teacher_id.is_(None), user_timetable.c.user_id != entry.c.teacher_id))
+    ).limit(MAX_REPORTED)
+
+
+def _build_recurring_query():
+    lesson, user = RecurringLesson.__table__, User.__table__
+    overlapping = _overlapping(
+        lesson,
+        lesson.c.weekday.in_(bindparam('weekdays', expanding=True)),
+        lesson.c.term_start <= bindparam('last_date'),
+        lesson.c.term_end >= bindparam('first_date'),
+        lesson.c.id != bindparam('exclude_lesson_id')
+    )
+    # Named like RecurringLesson attributes so rows can be passed to lesson_dates
+    columns = (lesson.c.id, lesson.c.weekday, lesson.c.week_parity, lesson.c.term_start, lesson.c.term_end,
+               lesson.c.subject, lesson.c.start_time, lesson.c.end_time)
+    return union_all(
+        select(literal('teacher').label('kind'), lesson.c.teacher.label('name'), *columns).where(
+            overlapping, lesson.c.teacher_id == bindparam('teacher_id')),
+        select(literal('room').label('kind'), lesson.c.room.label('name'), *columns).where(
+            overlapping, lesson.c.room_id == bindparam('room_id')),
+        select(literal('user').label('kind'), user.c.username.label('name'), *columns).select_from(
+            lesson.join(user_recurring_lesson, user_recurring_lesson.c.recurring_lesson_id == lesson.c.id)
+            .join(user, user.c.id == user_recurring_lesson.c.user_id)
+        ).where(overlapping, user_recurring_lesson.c.user_id.in_(bindparam('user_ids', expanding=True)),
+                or_(lesson.c.teacher_id.is_(None), user_recurring_lesson.c.user_id != lesson.c.teacher_id))
+    )
+
+
+# Built once so each check only binds parameters instead of constructing statements
+DATED_CLASHES = _build_dated_query()
+RECURRING_CLASHES = _build_recurring_query()
+
+
+def find_clashes(date, start_time, end_time, teacher_id=None, room_id=None, user_ids=None,
+                 repeat_until=None, week_parity=None, exclude_entry_id=None, exclude_lesson_id=None):
+    """Return bookings that overlap a new or edited lesson. user_ids may be a list or a SELECT of ids."""
+    calendar = None
+    if repeat_until:
+        # A recurring lesson books the same weekday in its weeks of the rotation, through its term
+        calendar = school_calendar()
+        pattern = RecurringLesson(date, repeat_until, '', '', start_time, end_time, week_parity=week_parity)
+        dates = list(lesson_dates(pattern, date, repeat_until, calendar))
+    else:
+        dates = [date]
+    if not dates:
+        return []
+    if user_ids is None:
+        user_ids = []
+    elif not isinstance(user_ids, (list, tuple, set)):
+        user_ids = db.session.scalars(user_ids).all()
+
+    params = {
+        'start_time': start_time,
+        'end_time': end_time,
+        'teacher_id': teacher_id,
+        'room_id': room_id,
+        'user_ids': list(user_ids),
+    }
+    clashes = [
+        Clash(row.kind, row.name, row.date, row.start_time, row.end_time, row.subject)
+        for row in db.session.execute(DATED_CLASHES, dict(
+            params, dates=dates, exclude_entry_id=exclude_entry_id if exclude_entry_id is not None else -1
+        ))
+    ]
+
+    rows = db.session.execute(RECURRING_CLASHES, dict(
+        params,
+        weekdays=list({d.weekday() for d in dates}),
+        first_date=min(dates),
+        last_date=max(dates),
+        exclude_lesson_id=exclude_lesson_id if exclude_lesson_id is not None else -1
+    )).all()
+    if rows:
+        if calendar is None:
+            calendar = school_calendar()
+        overridden = set(db.session.query(Timetable.recurring_lesson_id, Timetable.occurrence_date).filter(
+            Timetable.recurring_lesson_id.in_({row.id for row in rows}),
+            Timetable.occurrence_date.in_(dates)
+        ))
+        wanted = set(dates)
+        for row in rows:
+            day = next((d for d in lesson_dates(row, min(dates), max(dates), calendar)
+                        if d in wanted and (row.id, d) not in overridden), None)
+            if day is not None:
+                clashes.append(Clash(row.kind, row.name, day, row.start_time, row.end_time, row.subject))
+    return clashes[:MAX_REPORTED]
+
+
+class IntervalIndex:
+    """Bookings grouped per (resource, date), each bucket sorted by start time."""
+
+    def __init__(self):
+        self._buckets = defaultdict(list)
+        self._sorted = True
+
+    def add(self, resource, date, start_time, end_time, booking):
+        self._buckets[(resource, date)].append((start_time, end_time, booking))
+        self._sorted = False
+
+    def _sort(self):
+        if not self._sorted:
+            for bucket in self._buckets.values():
+                bucket.sort(key=lambda item: (item[0], item[1]))
+            self._sorted = True
+
+    def clashes(self):
+        """Yield (resource, date, first, second) for every pair of overlapping bookings."""
+        self._sort()
+        for (resource, date), bucket in self._buckets.items():
+            active = []
+            for start, end, booking in bucket:
+                active = [item for item in active if item[1] > start]
+                for other in active:
+                    yield resource, date, other[2], booking
+                active.append((start, end, booking))
+
+
+def scan_for_clashes(start_date, end_date):
+    """Find every double booking between two dates, including recurring lessons."""
+    index = IntervalIndex()
+    names = {'teacher': dict(db.session.query(User.id, User.username)), 'room': dict(db.session.query(Room.id, Room.name))}
+    names['user'] = names['teacher']
+
+    assignees = defaultdict(list)
+    rows = db.session.query(user_timetable.c.timetable_id, user_timetable.c.user_id).join(
+        Timetable, Timetable.id == user_timetable.c.timetable_id
+    ).filter(Timetable.date.between(start_date, end_date), Timetable.is_free_day == False)
+    for timetable_id, user_id in rows:
+        assignees[timetable_id].append(user_id)
+
+    entries = Timetable.query.filter(
+        Timetable.date.between(start_date, end_date),
+        Timetable.is_free_day == False
+    ).yield_per(1000)
+    overridden = set()
+    for entry in entries:
+        if entry.recurring_lesson_id:
+            overridden.add((entry.recurring_lesson_id, entry.occurrence_date))
+        users = assignees.get(entry.id, [])
+        if not users:
+            continue
+        booking = (entry.subject, entry.date, entry.start_time, entry.end_time)
+        _index_booking(index, booking, entry.teacher_id, entry.room_id, users)
+
+    lessons = RecurringLesson.query.options(db.selectinload(RecurringLesson.users)).filter(
+        RecurringLesson.term_start <= end_date,
+        RecurringLesson.term_end >= start_date
+    ).all()
+    calendar = school_calendar()
+    for lesson in lessons:
+        users = [user.id for user in lesson.users]
+        for day in lesson_dates(lesson, start_date, end_date, calendar):
+            if (lesson.id, day) not in overridden:
+                booking = (lesson.subject, day, lesson.start_time, lesson.end_time)
+                _index_booking(index, booking, lesson.teacher_id, lesson.room_id, users)
+
+    clashes = []
+    for (kind, key), day, first, second in index.clashes():
+        clashes.append({
+            'kind': kind,
+            'name': names[kind].get(key),
+            'date': day.strftime('%Y-%m-%d'),
+            'first': f"{first[0]} {first[2].strftime('%H:%M')}-{first[3].strftime('%H:%M')}",
+            'second': f"{second[0]} {second[2].strftime('%H:%M')}-{second[3].strftime('%H:%M')}"
+        })
+    return clashes
+
+
+def _index_booking(index, booking, teacher_id, room_id, user_ids):
+    subject, day, start_time, end_time = booking
+    if teacher_id is not None:
+        index.add(('teacher', teacher_id), day, start_time, end_time, booking)
+    if room_id is not None:
+        index.add(('room', room_id), day, start_time, end_time, booking)
+    for user_id in user_ids:
+        # The teacher is also one of the users of their own lesson
+        if user_id != teacher_id:
+            index.add(('user', user_id), day, start_time, end_time, booking)
@@ -0,0 +1,32 @@
+from sqlalchemy import update
+from models import db, Timetable, RecurringLesson
+
+# Timetable entries and recurring lessons point at their subject, teacher and
+# room by id and also keep a copy of each name, so week views, feeds and clash
+# checks read one flat row without joins. Renames rewrite the copies through
+# the id columns; deletes clear the ids and leave the names as history.
+
+KEY_COLUMNS = {'subject': 'subject_id', 'teacher': 'teacher_id', 'room': 'room_id'}
+
+
+def rename_references(kind, key, name):
+    """Copy a new subject, teacher or room name onto every entry and recurring lesson that uses it."""
+    column = KEY_COLUMNS[kind]
+    changed = 0
+    for model in (Timetable, RecurringLesson):
+        result = db.session.execute(
+            update(model).where(getattr(model, column) == key).values({kind: name}),
+            execution_options={'synchronize_session': False}
+        )
+        changed += result.rowcount
+    return changed
+
+
+def detach_references(kind, key):
+    """Clear the id of a deleted subject, teacher or room so a new row reusing the id is not picked up."""
+    column = KEY_COLUMNS[kind]
+    for model in (Timetable, RecurringLesson):
+        db.session.execute(
+            update(model).where(getattr(model, column) == key).values({column: None}),
+            execution_options={'synchronize_session': False}
+        )
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import secrets
+from datetime import datetime, timedelta
+from sqlalchemy import func, update
+from models import db, User
+from recurring import iter_user_entries
+
+# Per-user calendar feeds (.ics and JSON) built from the same entries as the
+# timetable page. Each user has a secret token for the feed URL and a
+# timetable_updated_at stamp that every write touching their entries moves
+# forward; the stamp and the feed range make the ETag, so polling clients get
+# a 304 from a single lookup.
+
+PRODID = '-//school_timetable//Timetable feed//EN'
+UID_DOMAIN = 'school-timetable'
+
+
+def feed_token_for(user):
+    if not user.feed_token:
+        user.feed_token = secrets.token_urlsafe(32)
+        db.session.commit()
+    return user.feed_token
+
+
+def reset_feed_token(user):
+    user.feed_token = secrets.token_urlsafe(32)
+    db.session.commit()
+    return user.feed_token
+
+
+def mark_timetables_changed(user_ids):
+    """Record that the entries of user_ids (every user if None) changed now."""
+    statement = update(User).values(timetable_updated_at=datetime.utcnow())
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        statement = statement.where(User.id.in_(user_ids))
+    db.session.execute(statement)
+    db.session.commit()
+
+
+def timetable_version():
+    """A value that changes whenever any timetable, or the set of users, changes."""
+    # Every timetable write moves some user's change stamp (see invalidate_weeks);
+    # the count and highest id catch users being added or removed.
+    return tuple(db.session.query(
+        func.max(User.timetable_updated_at), func.count(User.id), func.max(User.id)
+    ).one())
+
+
+def feed_range(weeks_before, weeks_after, today=None):
+    today = today or datetime.today().date()
+    week_start = today - timedelta(days=today.weekday())
+    return week_start - timedelta(weeks=weeks_before), week_start + timedelta(weeks=weeks_after, days=-1)
+
+
+def feed_version(user, start_date, end_date, feed_format):
+    """Return (strong ETag, Last-Modified) for a user's feed over a date range."""
+    if user.timetable_updated_at is None:
+        mark_timetables_changed([user.id])
+    # The range moves every week even when no entry changes
+    last_modified = max(user.timetable_updated_at, datetime.combine(start_date, datetime.min.time()))
+    version = f"{user.id}:{user.feed_token}:{user.timetable_updated_at.isoformat()}:{start_date}:{end_date}:{feed_format}"
+    return hashlib.sha256(version.encode()).hexdigest()[:32], last_modified
+
+
+def entry_uid(entry):
+    # Edited or annotated occurrences keep the UID of the recurring lesson occurrence they replace
+    if entry.is_recurring:
+        return f"lesson-{entry.lesson_id}-{entry.date.isoformat()}@{UID_DOMAIN}"
+    if entry.recurring_lesson_id:
+        return f"lesson-{entry.recurring_lesson_id}-{entry.occurrence_date.isoformat()}@{UID_DOMAIN}"
+    return f"entry-{entry.id}@{UID_DOMAIN}"
+
+
+def ics_escape(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def ics_line(name, value):
+    # Lines longer than 75 octets are folded; continuation lines start with a space
+    line = f"{name}:{value}".encode()
+    parts = []
+    limit = 75
+    while len(line) > limit:
+        cut = limit
+        while cut and (line[cut] & 0xC0) == 0x80:  # don't split a multi-byte character
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+        limit = 74
+    parts.append(line)
+    return '\r\n '.join(part.decode() for part in parts) + '\r\n'
+
+
+def ics_event(entry, stamp):
+    lines = [ics_line('BEGIN', 'VEVENT'), ics_line('UID', entry_uid(entry)), ics_line('DTSTAMP', stamp)]
+    if entry.is_free_day:
+        lines += [
+            ics_line('DTSTART;VALUE=DATE', entry.date.strftime('%Y%m%d')),
+            ics_line('DTEND;VALUE=DATE', (entry.date + timedelta(days=1)).strftime('%Y%m%d')),
+            ics_line('SUMMARY', ics_escape(f"Free day: {entry.subject}")),
+            ics_line('TRANSP', 'TRANSPARENT'),
+        ]
+    else:
+        summary = f"{entry.subject} (Substitute)" if entry.is_substitute else entry.subject
+        # Floating local times: calendar apps show them in the school's own time zone
+        lines += [
+            ics_line('DTSTART', datetime.combine(entry.date, entry.start_time).strftime('%Y%m%dT%H%M%S')),
+            ics_line('DTEND', datetime.combine(entry.date, entry.end_time).strftime('%Y%m%dT%H%M%S')),
+            ics_line('SUMMARY', ics_escape(summary)),
+        ]
+        if entry.room:
+            lines.append(ics_line('LOCATION', ics_escape(entry.room)))
+    description = [] if entry.is_free_day else [f"Teacher: {entry.teacher}" + (" (substitute)" if entry.is_substitute else "")]
+    if entry.note:
+        description.append(f"Note: {entry.note.content}")
+    if description:
+        lines.append(ics_line('DESCRIPTION', ics_escape('\n'.join(description))))
+    lines.append(ics_line('END', 'VEVENT'))
+    return ''.join(lines)
+
+
+def ics_feed(user, start_date, end_date, last_modified):
+    stamp = last_modified.strftime('%Y%m%dT%H%M%SZ')
+    yield (ics_line('BEGIN', 'VCALENDAR') + ics_line('VERSION', '2.0') + ics_line('PRODID', PRODID)
+           + ics_line('CALSCALE', 'GREGORIAN') + ics_line('X-WR-CALNAME', ics_escape(f"Timetable - {user.username}")))
+    for entry in iter_user_entries(user.id, start_date, end_date):
+        yield ics_event(entry, stamp)
+    yield ics_line('END', 'VCALENDAR')
+
+
+def json_event(entry):
+    return {
+        'uid': entry_uid(entry),
+        'date': entry.date.strftime('%Y-%m-%d'),
+        'start_time': entry.start_time.strftime('%H:%M'),
+        'end_time': entry.end_time.strftime('%H:%M'),
+        'subject': entry.subject,
+        'teacher': None if entry.is_free_day else entry.teacher,
+        'room': None if entry.is_free_day else entry.room,
+        'is_substitute': bool(entry.is_substitute),
+        'is_free_day': bool(entry.is_free_day),
+        'is_recurring': entry.is_recurring,
+        'note': entry.note.content if entry.note else None,
+    }
+
+
+def json_feed(user, start_date, end_date, last_modified):
+    header = {
+        'user': user.username,
+        'start': start_date.strftime('%Y-%m-%d'),
+        'end': end_date.strftime('%Y-%m-%d'),
+        'updated_at': last_modified.strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
+    yield json.dumps(header)[:-1] + ', "events": ['
+    separator = ''
+    for entry in iter_user_entries(user.id, start_date, end_date):
+        yield separator + json.dumps(json_event(entry))
+        separator = ', '
+    yield ']}'
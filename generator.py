@@ -0,0 +1,378 @@
+from collections import defaultdict
+from datetime import time
+from sqlalchemy import insert, or_
+from clashes import scan_for_clashes
+from models import db, User, Room, AssignedSubject, RecurringLesson, Timetable, Period, SubjectRequirement, TeacherUnavailability, user_recurring_lesson, user_timetable
+from recurring import delete_lesson_series
+from school_calendar import WEEK_LABELS, calendar_changed, school_calendar
+from solver import Section, Event, SlotGrid, TimetableSolver, allocate_teachers, build_events
+
+# Database side of the timetable generator: builds solver input from subjects,
+# assignments, rooms, requirements and teacher availability, and writes the
+# result as generated RecurringLesson rows for a term.
+#
+# Lessons already in the term (manual recurring lessons and dated entries)
+# block their teachers, students and rooms in the solver. The written result
+# is still scanned for clashes before it is committed, for what the period
+# grid cannot express (lessons off the periods, dated entries in one week of
+# a weekly slot): new clashes are reported, and with reject_clashes nothing
+# is saved.
+
+DAYS_PER_WEEK = 5
+DEFAULT_PERIODS = [
+    (time(9, 0), time(9, 50)),
+    (time(9, 50), time(10, 40)),
+    (time(11, 0), time(11, 50)),
+    (time(11, 50), time(12, 40)),
+    (time(13, 30), time(14, 20)),
+    (time(14, 20), time(15, 10)),
+]
+MAX_CLASH_PROBLEMS = 20  # Clashes listed one by one in a report; the rest are counted
+
+
+class GeneratorReport:
+    def __init__(self):
+        self.problems = []
+        self.lessons_written = 0
+        self.lessons_changed = 0
+        self.result = None
+
+
+def ensure_periods():
+    if Period.query.count() == 0:
+        for number, (start_time, end_time) in enumerate(DEFAULT_PERIODS, start=1):
+            db.session.add(Period(number=number, start_time=start_time, end_time=end_time))
+        calendar_changed()
+        db.session.commit()
+    return Period.query.order_by(Period.number).all()
+
+
+def load_blocked_slots(grid, periods, term_start, term_end, placing=(), keep_overrides=False):
+    """Slots the solver must leave free, as ({user id: slots}, {room id: slots}).
+
+    Teachers are blocked where they are unavailable, and the users and room of
+    every lesson in the term the solver does not place are blocked in the
+    periods it overlaps: recurring lessons on their weekday and week of the
+    rotation, dated entries on the weekday and week of their date. placing
+    holds the ids of the recurring lessons being placed; rows replacing their
+    occurrences are their own too, unless keep_overrides (deleting a series
+    keeps its customised occurrences as standalone entries).
+    """
+    period_index = {period.number: index for index, period in enumerate(periods)}
+    blocked, blocked_rooms = defaultdict(set), defaultdict(set)
+    for row in TeacherUnavailability.query.all():
+        if row.weekday >= grid.days_per_week:
+            continue
+        if row.period is None:
+            indexes = range(grid.periods_per_day)
+        elif row.period in period_index:
+            indexes = [period_index[row.period]]
+        else:
+            continue
+        for week in range(grid.cycle_weeks):
+            for index in indexes:
+                blocked[row.user_id].add(grid.slot(week, row.weekday, index))
+
+    room_ids = dict(db.session.query(Room.name, Room.id))
+
+    def block(weeks, weekday, start_time, end_time, user_ids, room_id):
+        if weekday >= grid.days_per_week:
+            return
+        for index, period in enumerate(periods):
+            if period.start_time < end_time and start_time < period.end_time:
+                for week in weeks:
+                    slot = grid.slot(week, weekday, index)
+                    for user_id in user_ids:
+                        blocked[user_id].add(slot)
+                    if room_id:
+                        blocked_rooms[room_id].add(slot)
+
+    def weeks_of(label):
+        if grid.cycle_weeks > 1 and label in WEEK_LABELS[:grid.cycle_weeks]:
+            return [WEEK_LABELS.index(label)]
+        return range(grid.cycle_weeks)
+
+    placing = list(placing)
+    lessons = RecurringLesson.query.filter(
+        RecurringLesson.id.notin_(placing),
+        RecurringLesson.term_start <= term_end,
+        RecurringLesson.term_end >= term_start
+    ).all()
+    members = defaultdict(set)
+    for lesson_id, user_id in db.session.query(user_recurring_lesson.c.recurring_lesson_id, user_recurring_lesson.c.user_id).filter(
+        user_recurring_lesson.c.recurring_lesson_id.in_([lesson.id for lesson in lessons])
+    ):
+        members[lesson_id].add(user_id)
+    for lesson in lessons:
+        user_ids = members[lesson.id] | ({lesson.teacher_id} if lesson.teacher_id else set())
+        block(weeks_of(lesson.week_parity), lesson.weekday, lesson.start_time, lesson.end_time,
+              user_ids, lesson.room_id or room_ids.get(lesson.room))
+
+    # One row per attendee; cancelled occurrences have none and free days hide lessons rather than clash
+    calendar = school_calendar()
+    rows = db.session.query(
+        Timetable.id, Timetable.date, Timetable.start_time, Timetable.end_time, Timetable.teacher_id,
+        Timetable.room_id, Timetable.room, user_timetable.c.user_id
+    ).join(user_timetable, user_timetable.c.timetable_id == Timetable.id).filter(
+        Timetable.date.between(term_start, term_end),
+        Timetable.is_free_day == False
+    )
+    if placing and not keep_overrides:
+        rows = rows.filter(or_(Timetable.recurring_lesson_id.is_(None), Timetable.recurring_lesson_id.notin_(placing)))
+    for row in rows:
+        day = calendar.day(row.date)
+        if not day.is_holiday:
+            block(weeks_of(day.week_label), row.date.weekday(), row.start_time, row.end_time,
+                  {row.user_id, row.teacher_id} - {None}, row.room_id or room_ids.get(row.room))
+    return blocked, blocked_rooms
+
+
+def clash_keys(term_start, term_end):
+    return {tuple(clash.items()) for clash in scan_for_clashes(term_start, term_end)}
+
+
+def check_new_clashes(report, before, term_start, term_end, reject_clashes):
+    """Report clashes in the term that were not in before; returns False when they must not be saved."""
+    clashes = [clash for clash in scan_for_clashes(term_start, term_end) if tuple(clash.items()) not in before]
+    for clash in clashes[:MAX_CLASH_PROBLEMS]:
+        report.problems.append(f"Clash on {clash['date']}: {clash['kind']} {clash['name']} has "
+                               f"{clash['first']} and {clash['second']}.")
+    if len(clashes) > MAX_CLASH_PROBLEMS:
+        report.problems.append(f"... and {len(clashes) - MAX_CLASH_PROBLEMS} more clashes; run scan-clashes for the full list.")
+    if clashes and reject_clashes:
+        report.problems.append("Nothing was saved, because the result double-books existing lessons.")
+        return False
+    return True
+
+
+def qualified_teachers():
+    teachers = defaultdict(list)
+    rows = db.session.query(AssignedSubject.subject_id, User.id).join(
+        User, User.id == AssignedSubject.user_id
+    ).filter(User.role == 'staff').order_by(User.id)
+    for subject_id, user_id in rows:
+        teachers[subject_id].append(user_id)
+    return teachers
+
+
+def load_sections(grid, max_class_size, report):
+    students = defaultdict(list)
+    rows = db.session.query(AssignedSubject.subject_id, User.year_group, User.id).join(
+        User, User.id == AssignedSubject.user_id
+    ).filter(User.role == 'student').order_by(User.id)
+    for subject_id, year_group, user_id in rows:
+        students[(subject_id, year_group)].append(user_id)
+    teachers = qualified_teachers()
+
+    sections = []
+    for requirement in SubjectRequirement.query.options(db.joinedload(SubjectRequirement.subject)).all():
+        name = requirement.subject.name
+        members = students.get((requirement.subject_id, requirement.year_group), [])
+        if not members:
+            report.problems.append(f"No students in year group {requirement.year_group} are assigned {name}.")
+            continue
+        if not teachers[requirement.subject_id]:
+            report.problems.append(f"No staff are assigned to teach {name}.")
+            continue
+        # Split large groups into classes of at most max_class_size
+        count = -(-len(members) // max_class_size)
+        for number in range(count):
+            sections.append(Section(
+                key=(requirement.subject_id, requirement.year_group, number),
+                subject_id=requirement.subject_id,
+                subject_name=name,
+                year_group=requirement.year_group,
+                student_ids=members[number::count],
+                teacher_ids=teachers[requirement.subject_id],
+                lessons_per_cycle=requirement.periods_per_week * grid.cycle_weeks
+            ))
+    return sections
+
+
+def generate_timetable(term_start, term_end, cycle_weeks=1, max_class_size=30, time_limit=10.0, seed=0, dry_run=False,
+                       reject_clashes=True):
+    """Solve the whole timetable and replace the generated lessons of the term with the result."""
+    report = GeneratorReport()
+    periods = ensure_periods()
+    grid = SlotGrid(DAYS_PER_WEEK, len(periods), cycle_weeks)
+    room_ids = [room.id for room in Room.query.order_by(Room.id)]
+    if not room_ids:
+        report.problems.append("Add at least one room before generating a timetable.")
+        return report
+
+    replaced = RecurringLesson.query.filter(
+        RecurringLesson.is_generated == True,
+        RecurringLesson.term_start <= term_end,
+        RecurringLesson.term_end >= term_start
+    ).all()
+    blocked, blocked_rooms = load_blocked_slots(grid, periods, term_start, term_end,
+                                                [lesson.id for lesson in replaced], keep_overrides=True)
+    sections = load_sections(grid, max_class_size, report)
+    allocate_teachers(sections, grid, blocked)
+    events = build_events(sections)
+    report.result = TimetableSolver(events, grid, room_ids, blocked, seed=seed, blocked_rooms=blocked_rooms).solve(
+        time_limit=time_limit
+    )
+    for event in report.result.unplaced:
+        report.problems.append(f"Could not place a {event.section.subject_name} lesson for year group {event.section.year_group}.")
+
+    if not dry_run:
+        for lesson in replaced:
+            delete_lesson_series(lesson)
+        before = clash_keys(term_start, term_end)
+        written = write_lessons(report.result.events, grid, periods, term_start, term_end)
+        if check_new_clashes(report, before, term_start, term_end, reject_clashes):
+            db.session.commit()
+            report.lessons_written = written
+        else:
+            db.session.rollback()
+    return report
+
+
+def lesson_fields(event, grid, periods, usernames, room_names):
+    week, day, period = grid.split(event.slot)
+    return {
+        'weekday': day,
+        'week_parity': WEEK_LABELS[week] if grid.cycle_weeks > 1 else None,
+        'subject': event.section.subject_name,
+        'subject_id': event.section.subject_id,
+        'teacher': usernames[event.teacher_id],
+        'teacher_id': event.teacher_id,
+        'start_time': periods[period].start_time,
+        'end_time': periods[period].end_time,
+        'room': room_names[event.room_id],
+        'room_id': event.room_id,
+    }
+
+
+def write_lessons(events, grid, periods, term_start, term_end):
+    placed = [event for event in events if event.slot is not None]
+    if not placed:
+        return 0
+    usernames = dict(db.session.query(User.id, User.username).filter(User.role == 'staff'))
+    room_names = dict(db.session.query(Room.id, Room.name))
+
+    rows = [
+        dict(lesson_fields(event, grid, periods, usernames, room_names),
+             term_start=term_start, term_end=term_end, is_substitute=False, is_generated=True)
+        for event in placed
+    ]
+    lesson_ids = db.session.scalars(
+        insert(RecurringLesson).returning(RecurringLesson.id, sort_by_parameter_order=True), rows
+    ).all()
+
+    links = [
+        {'user_id': user_id, 'recurring_lesson_id': lesson_id}
+        for lesson_id, event in zip(lesson_ids, placed)
+        for user_id in event.section.student_ids | {event.teacher_id}
+    ]
+    db.session.execute(user_recurring_lesson.insert(), links)
+    return len(rows)
+
+
+def load_generated_events(term_start, term_end, grid, periods, report):
+    lessons = RecurringLesson.query.options(db.selectinload(RecurringLesson.users)).filter(
+        RecurringLesson.is_generated == True,
+        RecurringLesson.term_start == term_start,
+        RecurringLesson.term_end == term_end
+    ).order_by(RecurringLesson.id).all()
+
+    period_index = {period.start_time: index for index, period in enumerate(periods)}
+    teachers = qualified_teachers()
+
+    sections = {}
+    events = []
+    for lesson in lessons:
+        teacher = next((user for user in lesson.users if user.id == lesson.teacher_id), None)
+        if teacher is None or lesson.start_time not in period_index or lesson.weekday >= grid.days_per_week:
+            report.problems.append(f"Lesson {lesson.id} no longer fits the period grid and was left unchanged.")
+            continue
+        student_ids = frozenset(user.id for user in lesson.users if user.role == 'student')
+        key = (lesson.subject, student_ids)
+        if key not in sections:
+            sections[key] = Section(
+                key=key,
+                subject_id=lesson.subject_id,
+                subject_name=lesson.subject,
+                year_group=None,
+                student_ids=student_ids,
+                teacher_ids=teachers.get(lesson.subject_id, [teacher.id]),
+                lessons_per_cycle=0,
+                teacher_id=teacher.id
+            )
+        section = sections[key]
+        section.lessons_per_cycle += 1
+        week = WEEK_LABELS.index(lesson.week_parity) if grid.cycle_weeks > 1 and lesson.week_parity in WEEK_LABELS else 0
+        events.append(Event(
+            section,
+            slot=grid.slot(week, lesson.weekday, period_index[lesson.start_time]),
+            room_id=lesson.room_id,
+            lesson_id=lesson.id
+        ))
+    return list(sections.values()), events, {lesson.id: lesson for lesson in lessons}
+
+
+def generated_terms():
+    return db.session.query(RecurringLesson.term_start, RecurringLesson.term_end).filter(
+        RecurringLesson.is_generated == True
+    ).distinct().all()
+
+
+def resolve_generated_term(term_start, term_end, time_limit=10.0, seed=0, reject_clashes=True):
+    """Re-solve a generated term after availability changes, moving as few lessons as possible."""
+    report = GeneratorReport()
+    periods = ensure_periods()
+    fortnightly = RecurringLesson.query.filter(
+        RecurringLesson.is_generated == True,
+        RecurringLesson.term_start == term_start,
+        RecurringLesson.term_end == term_end,
+        RecurringLesson.week_parity.isnot(None)
+    ).first()
+    cycle_weeks = 2 if fortnightly else 1
+    grid = SlotGrid(DAYS_PER_WEEK, len(periods), cycle_weeks)
+    room_ids = [room.id for room in Room.query.order_by(Room.id)]
+    sections, events, lessons = load_generated_events(term_start, term_end, grid, periods, report)
+    blocked, blocked_rooms = load_blocked_slots(grid, periods, term_start, term_end, list(lessons))
+    before = clash_keys(term_start, term_end)
+
+    # Teachers who can no longer teach any slot hand their classes to another qualified teacher
+    previous_teachers = {id(section): section.teacher_id for section in sections}
+    for section in sections:
+        if len(blocked.get(section.teacher_id, ())) >= grid.size:
+            section.teacher_ids = [t for t in section.teacher_ids if t != section.teacher_id]
+            section.teacher_id = None
+    allocate_teachers(sections, grid, blocked)
+
+    movable = [event for event in events if event.teacher_id is not None]
+    for section in sections:
+        if section.teacher_id is None:
+            report.problems.append(f"No other teacher can take {section.subject_name}; its lessons were left unchanged.")
+    previous_slots = [event.slot for event in movable]
+    previous_rooms = [event.room_id for event in movable]
+    report.result = TimetableSolver(movable, grid, room_ids, blocked, seed=seed, blocked_rooms=blocked_rooms).solve(
+        time_limit=time_limit, initial_slots=previous_slots
+    )
+
+    usernames = dict(db.session.query(User.id, User.username).filter(User.role == 'staff'))
+    room_names = dict(db.session.query(Room.id, Room.name))
+    for event, slot, room_id in zip(movable, previous_slots, previous_rooms):
+        teacher_changed = previous_teachers[id(event.section)] != event.teacher_id
+        if event.slot is None:
+            report.problems.append(f"Could not re-place {event.section.subject_name} lesson {event.lesson_id}; it was left unchanged.")
+            continue
+        if event.slot == slot and event.room_id == room_id and not teacher_changed:
+            continue
+        lesson = lessons[event.lesson_id]
+        for field, value in lesson_fields(event, grid, periods, usernames, room_names).items():
+            setattr(lesson, field, value)
+        if teacher_changed:
+            lesson.users = [user for user in lesson.users if user.id != previous_teachers[id(event.section)]]
+            lesson.users.append(User.query.get(event.teacher_id))
+        report.lessons_changed += 1
+    db.session.flush()
+    if check_new_clashes(report, before, term_start, term_end, reject_clashes):
+        db.session.commit()
+    else:
+        db.session.rollback()
+        report.lessons_changed = 0
+    return report
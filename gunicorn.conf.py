@@ -0,0 +1,27 @@
+# gunicorn -c gunicorn.conf.py wsgi:application
+#
+# Threaded workers: requests mostly wait on SQLite and the password check pool,
+# so a few processes with several threads each serve the login spike without a
+# process per connection. Use WEEK_CACHE_BACKEND=sqlite so the workers share
+# the rendered week cache.
+#
+# Open timetable pages hold a live update stream, which ties up a thread of a
+# threaded worker, so at most LIVE_MAX_CONNECTIONS streams are kept per worker.
+# To keep one open for every student, run an async worker instead:
+# SERVER_WORKER_CLASS=gevent (pip install gevent) and LIVE_MAX_CONNECTIONS=5000.
+#
+# Background jobs (jobs.py) should run once beside the workers rather than from
+# each of them: set JOB_WORKERS=0 here and run `flask run-jobs --workers 1`.
+import os
+
+# Each worker process has its own password check pool; one check thread per worker keeps the
+# pools together at about one per CPU
+os.environ.setdefault('PASSWORD_CHECK_WORKERS', '1')
+
+bind = os.environ.get('SERVER_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_class = os.environ.get('SERVER_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('SERVER_THREADS', 16))
+worker_connections = int(os.environ.get('SERVER_WORKER_CONNECTIONS', 5000))  # Async workers only
+timeout = 30
+keepalive = 5
@@ -0,0 +1,342 @@
+import csv
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date as dt_date, datetime, time as dt_time
+from itertools import islice
+from sqlalchemy import insert, select
+from werkzeug.security import generate_password_hash
+from models import db, User, Subject, Room, AssignedSubject, Timetable, RecurringLesson
+from bulk import assign_users_bulk
+from clashes import find_clashes
+from school_calendar import school_calendar
+
+# Streaming import of users, subjects, rooms, subject assignments and lessons
+# from CSV or XLSX. Rows are read and validated a chunk at a time, checked
+# against existing names, and each chunk is written and committed as one
+# batch. Password hashing (pbkdf2, the slow part) runs in worker processes,
+# or in threads inside a background job worker, which as a daemonic process
+# cannot start processes of its own (pbkdf2 releases the GIL, so threads
+# hash in parallel too).
+
+CHUNK_SIZE = 1000
+MAX_ERRORS = 500
+KINDS = ['subjects', 'rooms', 'users', 'assignments', 'lessons']  # dependency order for whole-workbook imports
+REQUIRED_COLUMNS = {
+    'subjects': ['name'],
+    'rooms': ['name'],
+    'users': ['username', 'role'],
+    'assignments': ['username', 'subject'],
+    'lessons': ['date', 'start_time', 'end_time', 'subject', 'teacher'],
+}
+USER_ROLES = ('student', 'staff')
+
+
+class ImportReport:
+    def __init__(self, kind):
+        self.kind = kind
+        self.rows = 0
+        self.created = 0
+        self.skipped = 0  # already in the database
+        self.error_count = 0
+        self.errors = []  # (row number, message), the first MAX_ERRORS only
+
+    def error(self, row_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((row_number, message))
+
+    def summary(self):
+        return (f"{self.kind}: {self.rows} rows, {self.created} created, "
+                f"{self.skipped} already existed, {self.error_count} errors")
+
+
+def hash_password(password):
+    return generate_password_hash(password, method='pbkdf2:sha256')
+
+
+def iter_csv_rows(stream):
+    """Yield (row number, row dict) from a text or binary CSV stream without reading it all into memory."""
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def iter_xlsx_rows(stream, sheet=None):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Reading .xlsx files needs the openpyxl package (pip install openpyxl).")
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    if sheet is not None and sheet not in workbook.sheetnames:
+        workbook.close()
+        return
+    worksheet = workbook[sheet] if sheet else workbook.active
+    rows = worksheet.iter_rows(values_only=True)
+    header = [str(value).strip() if value is not None else '' for value in next(rows, ())]
+    for number, values in enumerate(rows, start=2):
+        if any(value is not None for value in values):
+            yield number, dict(zip(header, values))
+    workbook.close()
+
+
+def clean(row):
+    row = {(key or '').strip().lower(): value for key, value in row.items()}
+    # Passwords are kept exactly as given
+    return {
+        key: value.strip() if isinstance(value, str) and key != 'password' else value
+        for key, value in row.items()
+    }
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, dt_date):
+        return value
+    return datetime.strptime(str(value), '%Y-%m-%d').date()
+
+
+def parse_time(value):
+    if isinstance(value, datetime):
+        return value.time()
+    if isinstance(value, dt_time):
+        return value
+    return datetime.strptime(str(value), '%H:%M').time()
+
+
+def text(value):
+    return '' if value is None else str(value).strip()
+
+
+def import_rows(kind, rows, workers=None, allow_clashes=False, progress=None):
+    """Import an iterable of (row number, row dict) pairs of one kind and return an ImportReport."""
+    if kind not in REQUIRED_COLUMNS:
+        raise ValueError(f"Unknown import type '{kind}'. Expected one of: {', '.join(KINDS)}.")
+    report = ImportReport(kind)
+    seen = {}
+    workers = workers or os.cpu_count() or 1
+    executor = ThreadPoolExecutor if multiprocessing.current_process().daemon else ProcessPoolExecutor
+    pool = executor(max_workers=workers) if kind == 'users' and workers > 1 else None
+    try:
+        for chunk in chunks(rows):
+            chunk = [(number, clean(row)) for number, row in chunk]
+            if report.rows == 0 and chunk:
+                missing = [column for column in REQUIRED_COLUMNS[kind] if column not in chunk[0][1]]
+                if missing:
+                    raise ValueError(f"Missing column(s) for {kind}: {', '.join(missing)}.")
+            report.rows += len(chunk)
+            if kind in ('subjects', 'rooms'):
+                import_names(Subject if kind == 'subjects' else Room, chunk, seen, report)
+            elif kind == 'users':
+                import_users(chunk, seen, report, pool, workers)
+            elif kind == 'assignments':
+                import_assignments(chunk, seen, report)
+            else:
+                import_lessons(chunk, report, allow_clashes)
+            db.session.commit()
+            if progress:
+                progress(report)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if pool:
+            pool.shutdown()
+    return report
+
+
+def first_seen(seen, key, number, report):
+    # Rows repeating an earlier row of the same file are reported, not imported twice
+    if key in seen:
+        report.error(number, f"Duplicate of row {seen[key]}.")
+        return False
+    seen[key] = number
+    return True
+
+
+def import_names(model, chunk, seen, report):
+    valid = {}
+    for number, row in chunk:
+        name = text(row.get('name'))
+        if not name:
+            report.error(number, "Name is required.")
+        elif len(name) > 100:
+            report.error(number, "Name is longer than 100 characters.")
+        elif first_seen(seen, name, number, report):
+            valid[name] = number
+    existing = set(db.session.scalars(select(model.name).where(model.name.in_(list(valid)))))
+    new_rows = [{'name': name} for name in valid if name not in existing]
+    report.skipped += len(valid) - len(new_rows)
+    if new_rows:
+        db.session.execute(insert(model), new_rows)
+    report.created += len(new_rows)
+
+
+def import_users(chunk, seen, report, pool, workers):
+    valid = []
+    for number, row in chunk:
+        username = text(row.get('username'))
+        role = text(row.get('role')).lower()
+        year_group = text(row.get('year_group')) or None
+        password, password_hash = row.get('password') or '', text(row.get('password_hash'))
+        if not username or len(username) > 50:
+            report.error(number, "Username is required and must be at most 50 characters.")
+        elif role not in USER_ROLES:
+            report.error(number, f"Role must be one of: {', '.join(USER_ROLES)}.")
+        elif year_group and len(year_group) > 10:
+            report.error(number, "Year group must be at most 10 characters.")
+        elif not password and not password_hash:
+            report.error(number, "A password or password_hash is required.")
+        elif password_hash and not password_hash.startswith(('pbkdf2:', 'scrypt:')):
+            report.error(number, "password_hash must be a werkzeug pbkdf2 or scrypt hash.")
+        elif first_seen(seen, username, number, report):
+            valid.append({
+                'username': username,
+                'role': role,
+                'year_group': year_group if role == 'student' else None,
+                'password': password_hash or password,
+                'hashed': bool(password_hash)
+            })
+
+    existing = set(db.session.scalars(select(User.username).where(User.username.in_([u['username'] for u in valid]))))
+    new_users = [user for user in valid if user['username'] not in existing]
+    report.skipped += len(valid) - len(new_users)
+
+    plain = [user for user in new_users if not user.pop('hashed')]
+    passwords = [user['password'] for user in plain]
+    if pool:
+        hashes = pool.map(hash_password, passwords, chunksize=max(1, len(passwords) // (workers * 4)))
+    else:
+        hashes = map(hash_password, passwords)
+    for user, hashed in zip(plain, hashes):
+        user['password'] = hashed
+    if new_users:
+        db.session.execute(insert(User), new_users)
+    report.created += len(new_users)
+
+
+def import_assignments(chunk, seen, report):
+    usernames = {text(row.get('username')) for _, row in chunk}
+    subjects = {text(row.get('subject')) for _, row in chunk}
+    user_ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(usernames)))
+    subject_ids = dict(db.session.query(Subject.name, Subject.id).filter(Subject.name.in_(subjects)))
+
+    pairs = {}
+    for number, row in chunk:
+        username, subject = text(row.get('username')), text(row.get('subject'))
+        if username not in user_ids:
+            report.error(number, f"Unknown user '{username}'.")
+        elif subject not in subject_ids:
+            report.error(number, f"Unknown subject '{subject}'.")
+        elif first_seen(seen, (username, subject), number, report):
+            pairs[(user_ids[username], subject_ids[subject])] = number
+
+    existing = set(db.session.query(AssignedSubject.user_id, AssignedSubject.subject_id).filter(
+        AssignedSubject.user_id.in_({user_id for user_id, _ in pairs})
+    ))
+    new_rows = [{'user_id': user_id, 'subject_id': subject_id} for user_id, subject_id in pairs if (user_id, subject_id) not in existing]
+    report.skipped += len(pairs) - len(new_rows)
+    if new_rows:
+        db.session.execute(insert(AssignedSubject), new_rows)
+    report.created += len(new_rows)
+
+
+def import_lessons(chunk, report, allow_clashes):
+    # Lessons are written one at a time within the chunk so later rows are checked against earlier ones
+    names = set()
+    for _, row in chunk:
+        names.add(text(row.get('teacher')))
+        names.update(name.strip() for name in text(row.get('users')).split(';') if name.strip())
+    user_ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(names)))
+    subjects = dict(db.session.query(Subject.name, Subject.id))
+    rooms = dict(db.session.query(Room.name, Room.id))
+    week_labels = school_calendar().week_labels or 'AB'
+
+    for number, row in chunk:
+        try:
+            date = parse_date(row.get('date'))
+            start_time, end_time = parse_time(row.get('start_time')), parse_time(row.get('end_time'))
+            repeat_until = parse_date(row['repeat_until']) if row.get('repeat_until') else None
+        except (TypeError, ValueError):
+            report.error(number, "Dates must be YYYY-MM-DD and times HH:MM.")
+            continue
+        subject, teacher, room = text(row.get('subject')), text(row.get('teacher')), text(row.get('room')) or None
+        attendees = [name.strip() for name in text(row.get('users')).split(';') if name.strip()]
+        year_group = text(row.get('year_group')) or None
+        week_parity = text(row.get('week_parity')).upper() or None
+        unknown = [name for name in [teacher] + attendees if name not in user_ids]
+
+        if end_time <= start_time:
+            report.error(number, "End time must be after start time.")
+        elif repeat_until and repeat_until < date:
+            report.error(number, "repeat_until must not be before the date.")
+        elif subject not in subjects:
+            report.error(number, f"Unknown subject '{subject}'.")
+        elif room and room not in rooms:
+            report.error(number, f"Unknown room '{room}'.")
+        elif unknown:
+            report.error(number, f"Unknown user(s): {', '.join(unknown)}.")
+        elif not attendees and not year_group:
+            report.error(number, "Give the attending users or a year_group.")
+        elif week_parity is not None and week_parity not in week_labels:
+            report.error(number, f"week_parity must be one of {', '.join(week_labels)} or empty.")
+        else:
+            members = [user_ids[name] for name in attendees]
+            if year_group:
+                members += db.session.scalars(select(User.id).where(User.year_group == year_group)).all()
+            clashes = [] if allow_clashes else find_clashes(
+                date, start_time, end_time, teacher_id=user_ids[teacher], room_id=rooms.get(room), user_ids=members,
+                repeat_until=repeat_until, week_parity=week_parity
+            )
+            if clashes:
+                report.error(number, str(clashes[0]))
+                continue
+            is_substitute = text(row.get('is_substitute')).lower() in ('1', 'true', 'yes', 'y')
+            keys = dict(subject_id=subjects[subject], teacher_id=user_ids[teacher], room_id=rooms.get(room))
+            if repeat_until:
+                entry = RecurringLesson(date, repeat_until, subject, teacher, start_time, end_time, room, is_substitute, week_parity, **keys)
+            else:
+                entry = Timetable(date, subject, teacher, start_time, end_time, room, is_substitute, **keys)
+            db.session.add(entry)
+            assign_users_bulk(entry, select(User.id.label('user_id')).where(User.id.in_(members + [user_ids[teacher]])))
+            report.created += 1
+
+
+def import_file(stream, filename, kind, sheet=None, workers=None, allow_clashes=False, progress=None):
+    """Import a CSV (one kind) or XLSX file. kind='all' imports every sheet named after a kind, in dependency order."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        if kind == 'all':
+            raise ValueError("A CSV file holds one kind of row; choose what it contains.")
+        return [import_rows(kind, iter_csv_rows(stream), workers, allow_clashes, progress)]
+    if extension in ('.xlsx', '.xlsm'):
+        if kind != 'all':
+            return [import_rows(kind, iter_xlsx_rows(stream, sheet), workers, allow_clashes, progress)]
+        reports = []
+        for sheet_kind in KINDS:
+            if hasattr(stream, 'seek'):
+                stream.seek(0)
+            rows = iter_xlsx_rows(stream, sheet_kind)
+            first = next(rows, None)
+            if first is not None:
+                reports.append(import_rows(sheet_kind, _prepend(first, rows), workers, allow_clashes, progress))
+        return reports
+    raise ValueError("Only .csv and .xlsx files can be imported.")
+
+
+def _prepend(first, rows):
+    yield first
+    yield from rows
@@ -0,0 +1,238 @@
+import importlib
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.exc import OperationalError
+from models import db, Job
+
+# Background jobs for slow admin operations (school-wide free days, bulk
+# assignments, imports, timetable generation), so the admin's request only
+# queues the work and returns.
+#
+# The queue is the job table in the app's own SQLite database; there is no
+# broker. Worker processes claim the oldest queued job with a conditional
+# UPDATE, so two workers never run the same job, and run its handler in an
+# app context. Handlers report progress through their JobContext, which also
+# stops them at that point when the admin cancelled the job. A job that hits
+# "database is locked" is rolled back and queued again with a growing delay,
+# up to max_attempts; a worker that dies stops the heartbeat of its job, which
+# is queued again after stale_seconds. Handlers must therefore be safe to run
+# again after a failed attempt.
+#
+# The web app starts JOB_WORKERS worker processes the first time it queues a
+# job. With several web server processes set JOB_WORKERS=0 and run the
+# workers once, beside the server: flask run-jobs --workers N.
+
+log = logging.getLogger('timetable.jobs')
+
+FINISHED = ('succeeded', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and 'locked' in str(error.orig)
+
+
+class JobContext:
+    """What a handler gets to report progress. Call progress() between commits: it writes the job row
+    on its own connection, and raises JobCancelled when the admin asked the job to stop."""
+
+    def __init__(self, job_id, engine):
+        self.job_id = job_id
+        self.engine = engine
+
+    def progress(self, done, total=None, message=None):
+        values = {'progress': done, 'heartbeat_at': datetime.utcnow()}
+        if total is not None:
+            values['total'] = total
+        if message is not None:
+            values['message'] = message[:200]
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(update(Job).where(Job.id == self.job_id).values(**values))
+                cancelled = connection.execute(select(Job.cancel_requested).where(Job.id == self.job_id)).scalar()
+        except OperationalError as e:
+            if not is_lock_error(e):
+                raise
+            return  # Progress is best effort; the next report will get through
+        if cancelled:
+            raise JobCancelled()
+
+
+class JobQueue:
+    def __init__(self, app, import_path, workers=1, poll_seconds=1.0, max_attempts=5, stale_seconds=300):
+        self.app = app
+        self.import_path = import_path  # 'module:attribute' of this queue, for the worker processes to import
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.stale_seconds = stale_seconds
+        self.handlers = {}
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def kind(self, name):
+        """Register a handler, called as handler(context, **params); it returns a JSON-able result,
+        whose 'message' is shown to the admin."""
+        def register(handler):
+            self.handlers[name] = handler
+            return handler
+        return register
+
+    def submit(self, kind, params=None, user_id=None, message=None):
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind '{kind}'.")
+        job = Job(kind=kind, params=json.dumps(params or {}), created_by=user_id, message=message)
+        db.session.add(job)
+        db.session.commit()
+        self.start_workers()
+        return job
+
+    def cancel(self, job):
+        """Cancel a queued job at once, or ask a running one to stop at its next progress report.
+        Returns False for a job that has already finished."""
+        if job.status == 'queued':
+            job.status, job.finished_at, job.message = 'cancelled', datetime.utcnow(), "Cancelled before it started."
+        elif job.status == 'running':
+            job.cancel_requested = True
+        else:
+            return False
+        db.session.commit()
+        return True
+
+    def claim(self):
+        """Mark the oldest queued job running and return it, or None when there is nothing to run."""
+        now = datetime.utcnow()
+        # A running job whose heartbeat stopped lost its worker
+        db.session.execute(update(Job).where(
+            Job.status == 'running', Job.heartbeat_at < now - timedelta(seconds=self.stale_seconds)
+        ).values(status='queued', message="Worker stopped; queued again."))
+        db.session.commit()
+        job_id = db.session.execute(select(Job.id).where(
+            Job.status == 'queued', or_(Job.run_after.is_(None), Job.run_after <= now)
+        ).order_by(Job.id).limit(1)).scalar()
+        if job_id is None:
+            return None
+        claimed = db.session.execute(update(Job).where(Job.id == job_id, Job.status == 'queued').values(
+            status='running', started_at=now, heartbeat_at=now, attempts=Job.attempts + 1
+        )).rowcount
+        db.session.commit()
+        return db.session.get(Job, job_id) if claimed else None
+
+    def run(self, job):
+        engine = db.engine
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(engine, job.id, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        job_id, attempts, kind, params = job.id, job.attempts, job.kind, json.loads(job.params)
+        try:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                raise ValueError(f"Unknown job kind '{kind}'.")
+            result = handler(JobContext(job_id, engine), **params)
+        except JobCancelled:
+            db.session.rollback()
+            self._finish(job_id, status='cancelled', message="Cancelled.")
+        except Exception as e:
+            db.session.rollback()
+            if is_lock_error(e) and attempts < self.max_attempts:
+                self._finish(job_id, status='queued', run_after=datetime.utcnow() + timedelta(seconds=2 ** attempts),
+                             message=f"Database busy; retrying (attempt {attempts + 1} of {self.max_attempts}).")
+            else:
+                log.exception("Job %s (%s) failed", job_id, kind)
+                self._finish(job_id, status='failed', error=str(e), message="Failed.")
+        else:
+            result = result or {}
+            self._finish(job_id, status='succeeded', progress=func.coalesce(Job.total, Job.progress),
+                         result=json.dumps(result), message=result.get('message', "Done."))
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+
+    def _finish(self, job_id, **values):
+        if values['status'] in FINISHED:
+            values['finished_at'] = datetime.utcnow()
+        for attempt in range(self.max_attempts):
+            try:
+                db.session.execute(update(Job).where(Job.id == job_id).values(**values))
+                db.session.commit()
+                return
+            except OperationalError as e:
+                db.session.rollback()
+                if not is_lock_error(e) or attempt == self.max_attempts - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def _heartbeat(self, engine, job_id, stop):
+        while not stop.wait(self.stale_seconds / 4):
+            try:
+                with engine.begin() as connection:
+                    connection.execute(update(Job).where(Job.id == job_id).values(heartbeat_at=datetime.utcnow()))
+            except OperationalError:
+                pass  # The job itself holds the write lock; the next beat will do
+
+    def work(self, stop=None):
+        """Run queued jobs until stop is set (forever without one). Needs an app context."""
+        while stop is None or not stop.is_set():
+            try:
+                job = self.claim()
+            except OperationalError as e:
+                db.session.rollback()
+                if not is_lock_error(e):
+                    raise
+                job = None
+            if job is None:
+                db.session.remove()
+                time.sleep(self.poll_seconds)
+                continue
+            self.run(job)
+            db.session.remove()
+
+    def start_workers(self, count=None, daemon=True):
+        """Start worker processes up to count (JOB_WORKERS by default); returns the running processes."""
+        count = self.workers if count is None else count
+        with self._lock:
+            self._processes = [process for process in self._processes if process.is_alive()]
+            context = multiprocessing.get_context('spawn')  # A fresh interpreter, not a fork of a threaded server
+            while len(self._processes) < count:
+                process = context.Process(target=worker_main, args=(self.import_path,), daemon=daemon,
+                                          name=f'job-worker-{len(self._processes) + 1}')
+                process.start()
+                self._processes.append(process)
+            return list(self._processes)
+
+
+def worker_main(import_path):
+    module_name, attribute = import_path.split(':')
+    queue = getattr(importlib.import_module(module_name), attribute)
+    with queue.app.app_context():
+        queue.work()
+
+
+def job_dict(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'message': job.message,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'attempts': job.attempts,
+        'cancel_requested': job.cancel_requested,
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else None,
+        'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None,
+    }
+
+
+def create_job_queue(app, import_path):
+    return JobQueue(app, import_path, app.config['JOB_WORKERS'], app.config['JOB_POLL_SECONDS'],
+                    app.config['JOB_MAX_ATTEMPTS'], app.config['JOB_STALE_SECONDS'])
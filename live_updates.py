@@ -0,0 +1,127 @@
+import logging
+import threading
+from changelog import latest_seq, users_changed_since
+from models import db
+
+# Live timetable updates. Open /timetable pages keep a Server-Sent Events
+# stream (or a long poll of /changes) waiting here, and are woken when the
+# change log gains rows for their user, so a substitute or a free day shows
+# up without reloading.
+#
+# One follower thread per process reads the change log for the users with
+# new rows and wakes only their subscribers, so a write costs one query
+# however many pages are open, and a bulk write wakes each affected user
+# once. Writes in this process wake the follower at once (notify()); writes
+# in other worker processes are picked up within poll_seconds.
+#
+# The follower also hands the users to on_change, which the app uses to drop
+# their rendered weeks from this process's memory cache: writes made by other
+# processes (job workers, other server processes) then reach this process's
+# pages too. The app starts it as soon as it caches a page.
+#
+# A waiting stream holds one server thread, so at most max_connections are
+# open per process and further clients fall back to slow polling. With an
+# async worker (gunicorn -k gevent) waiting is cheap and the limit can be
+# in the thousands.
+
+log = logging.getLogger('timetable.live')
+
+
+class Subscriber:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._event = threading.Event()
+
+    def wake(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        """Block until woken or timeout seconds pass; returns whether it was woken."""
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+
+class LiveUpdates:
+    def __init__(self, app, max_connections, poll_seconds, on_change=None):
+        self.app = app
+        self.on_change = on_change
+        self.max_connections = max_connections
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._subscribers = {}  # user_id -> set of Subscriber
+        self._count = 0
+        self._changed = threading.Event()
+        self._follower = None
+
+    @property
+    def connections(self):
+        return self._count
+
+    def subscribe(self, user_id):
+        """A Subscriber woken on changes for user_id, or None when max_connections are already open."""
+        with self._lock:
+            if self._count >= self.max_connections:
+                return None
+            subscriber = Subscriber(user_id)
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+            self._count += 1
+        self.start()
+        return subscriber
+
+    def start(self):
+        """Start following the change log, if this process is not already."""
+        if self._follower is not None:
+            return
+        with self._lock:
+            if self._follower is None:
+                self._follower = threading.Thread(target=self._follow, name='live-updates', daemon=True)
+                self._follower.start()
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id)
+            if subscribers and subscriber in subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.user_id]
+                self._count -= 1
+
+    def notify(self):
+        """Have the follower read the change log now, after a write in this process."""
+        self._changed.set()
+
+    def publish(self, user_ids):
+        """Wake the subscribers of user_ids (everyone's if None); returns how many were woken."""
+        with self._lock:
+            if user_ids is None:
+                targets = [subscriber for subscribers in self._subscribers.values() for subscriber in subscribers]
+            else:
+                targets = [subscriber for user_id in user_ids for subscriber in self._subscribers.get(user_id, ())]
+        for subscriber in targets:
+            subscriber.wake()
+        return len(targets)
+
+    def _follow(self):
+        with self.app.app_context():
+            seq = None
+            while True:
+                try:
+                    if seq is None:
+                        seq = latest_seq()
+                    self._changed.wait(self.poll_seconds)
+                    self._changed.clear()
+                    user_ids, everyone, seq = users_changed_since(seq)
+                    if everyone or user_ids:
+                        if self.on_change:
+                            self.on_change(None if everyone else user_ids)
+                        self.publish(None if everyone else user_ids)
+                except Exception:
+                    log.exception("Could not read the change log")
+                    self._changed.wait(self.poll_seconds)
+                finally:
+                    db.session.remove()
+
+
+def create_live_updates(app, on_change=None):
+    return LiveUpdates(app, app.config['LIVE_MAX_CONNECTIONS'], app.config['LIVE_POLL_SECONDS'], on_change)
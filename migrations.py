@@ -0,0 +1,84 @@
+from sqlalchemy import inspect, text
+
+# db.create_all() only creates missing tables, so columns added to existing
+# tables are patched in here for databases created by older versions.
+COLUMN_MIGRATIONS = [
+    ('timetable', 'recurring_lesson_id', 'INTEGER REFERENCES recurring_lesson (id)'),
+    ('timetable', 'occurrence_date', 'DATE'),
+    ('recurring_lesson', 'is_generated', 'BOOLEAN DEFAULT 0'),
+    ('user', 'feed_token', 'VARCHAR(64)'),
+    ('user', 'timetable_updated_at', 'DATETIME'),
+    ('timetable', 'subject_id', 'INTEGER REFERENCES subject (id) ON DELETE SET NULL'),
+    ('timetable', 'teacher_id', 'INTEGER REFERENCES user (id) ON DELETE SET NULL'),
+    ('timetable', 'room_id', 'INTEGER REFERENCES room (id) ON DELETE SET NULL'),
+    ('recurring_lesson', 'subject_id', 'INTEGER REFERENCES subject (id) ON DELETE SET NULL'),
+    ('recurring_lesson', 'teacher_id', 'INTEGER REFERENCES user (id) ON DELETE SET NULL'),
+    ('recurring_lesson', 'room_id', 'INTEGER REFERENCES room (id) ON DELETE SET NULL'),
+    ('school_settings', 'cycle_weeks', 'INTEGER DEFAULT 2'),
+    ('school_settings', 'calendar_version', 'INTEGER DEFAULT 0'),
+]
+
+# Rows written before a key column existed only had names; fill the new key from the name once,
+# when the column is added. Names that match nothing (free days' "N/A") keep a NULL key.
+KEY_BACKFILLS = {
+    'subject_id': ('subject', 'subject', 'name'),
+    'teacher_id': ('teacher', 'user', 'username'),
+    'room_id': ('room', 'room', 'name'),
+}
+
+# Indexes replaced by others; dropped from databases that still have them. The clash checks look
+# teachers and rooms up by key, and the (key, date) indexes also serve lookups by key alone.
+DROPPED_INDEXES = [
+    'ix_timetable_teacher_date',
+    'ix_timetable_room_date',
+    'ix_timetable_teacher_id',
+    'ix_timetable_room_id',
+    'ix_recurring_lesson_teacher_weekday',
+    'ix_recurring_lesson_room_weekday',
+    'ix_recurring_lesson_teacher_id',
+    'ix_recurring_lesson_room_id',
+]
+
+
+def run_migrations(db):
+    inspector = inspect(db.engine)
+    for table, column, ddl in COLUMN_MIGRATIONS:
+        existing_columns = {c['name'] for c in inspector.get_columns(table)}
+        if column not in existing_columns:
+            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            print(f"Added column {table}.{column}")
+            if column in KEY_BACKFILLS:
+                backfill_key(db, table, column)
+    db.session.commit()
+    drop_replaced_indexes(db)
+    create_missing_indexes(db)
+
+
+def backfill_key(db, table, column):
+    name_column, target, target_name = KEY_BACKFILLS[column]
+    result = db.session.execute(text(
+        f'UPDATE {table} SET {column} = (SELECT id FROM "{target}" WHERE "{target}".{target_name} = {table}.{name_column}) '
+        f'WHERE {column} IS NULL AND {name_column} IN (SELECT {target_name} FROM "{target}")'
+    ))
+    print(f"Filled {table}.{column} for {result.rowcount} rows")
+
+
+def drop_replaced_indexes(db):
+    inspector = inspect(db.engine)
+    for table in inspector.get_table_names():
+        for index in inspector.get_indexes(table):
+            if index['name'] in DROPPED_INDEXES:
+                db.session.execute(text(f"DROP INDEX {index['name']}"))
+                print(f"Dropped index {index['name']}")
+    db.session.commit()
+
+
+def create_missing_indexes(db):
+    # Indexes are declared on the models; older databases get any that are missing
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(db.engine)
+                print(f"Created index {index.name}")
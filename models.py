@@ -1,6 +1,7 @@
-from datetime import datetime, date as dt_date, timedelta
+from datetime import datetime, date as dt_date
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from week_grid import week_number
 
 db = SQLAlchemy()
 
@@ -11,16 +12,43 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String(100), nullable=False)
     role = db.Column(db.String(10), nullable=False)  # 'student', 'staff', 'admin'
     year_group = db.Column(db.String(10), nullable=True)
+    feed_token = db.Column(db.String(64), nullable=True)  # Secret part of the user's calendar feed URLs
+    timetable_updated_at = db.Column(db.DateTime, nullable=True)  # Last change to any of the user's entries
+
+    __table_args__ = (
+        db.Index('ix_user_role', 'role'),
+        db.Index('ix_user_year_group_role', 'year_group', 'role'),
+        db.Index('ix_user_feed_token', 'feed_token', unique=True),
+        db.Index('ix_user_timetable_updated_at', 'timetable_updated_at'),
+    )
 
 # School Settings Model (For Week A/B System)
 class SchoolSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     use_week_ab = db.Column(db.Boolean, default=False)  # Default: No A/B week system
+    cycle_weeks = db.Column(db.Integer, default=2)  # Weeks in the rotation when use_week_ab is on (2 = Week A/B)
+    calendar_version = db.Column(db.Integer, default=0)  # Moved on every calendar change, so cached calendars are rebuilt
+
+# Terms and holidays of the school year, read by the school calendar (school_calendar.py)
+class SchoolTerm(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    first_week = db.Column(db.String(1), nullable=True)  # Week label the term starts on; None carries on the rotation
+
+class SchoolHoliday(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
 
 # Association table for many-to-many relationship between users and timetable entries
 user_timetable = db.Table('user_timetable',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('timetable_id', db.Integer, db.ForeignKey('timetable.id'), primary_key=True)
+    db.Column('timetable_id', db.Integer, db.ForeignKey('timetable.id'), primary_key=True),
+    # The primary key covers lookups by user; this covers loading the assignees of an entry
+    db.Index('ix_user_timetable_timetable_user', 'timetable_id', 'user_id')
 )
 
 # Timetable Model
@@ -29,21 +57,43 @@ class Timetable(db.Model):
     date = db.Column(db.Date, nullable=False)
     week = db.Column(db.Integer, nullable=False)
     day_of_week = db.Column(db.String(10), nullable=False)
+    # subject, teacher and room are display copies of the names behind subject_id, teacher_id and room_id,
+    # so week views read one flat row; the ids are None for free days and names that matched nothing
     subject = db.Column(db.String(100), nullable=False)
     teacher = db.Column(db.String(100), nullable=False)
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
     room = db.Column(db.String(100), nullable=True)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='SET NULL'), nullable=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id', ondelete='SET NULL'), nullable=True)
     is_substitute = db.Column(db.Boolean, default=False)
     is_free_day = db.Column(db.Boolean, default=False)
+    # Set when this row replaces one occurrence of a recurring lesson (an edit, a note or a cancellation)
+    recurring_lesson_id = db.Column(db.Integer, db.ForeignKey('recurring_lesson.id'), nullable=True)
+    occurrence_date = db.Column(db.Date, nullable=True)
     users = db.relationship('User', secondary=user_timetable, backref=db.backref('timetables', lazy='dynamic'))
 
-    def __init__(self, date, subject, teacher, start_time, end_time, room=None, is_substitute=False):
+    __table_args__ = (
+        db.Index('ix_timetable_date_start_time', 'date', 'start_time'),
+        db.Index('ix_timetable_recurring_occurrence', 'recurring_lesson_id', 'occurrence_date'),
+        db.Index('ix_timetable_teacher_id_date', 'teacher_id', 'date', 'start_time'),
+        db.Index('ix_timetable_room_id_date', 'room_id', 'date', 'start_time'),
+        db.Index('ix_timetable_subject_id', 'subject_id'),
+    )
+
+    is_recurring = False
+
+    def __init__(self, date, subject, teacher, start_time, end_time, room=None, is_substitute=False,
+                 subject_id=None, teacher_id=None, room_id=None):
         self.subject = subject
         self.teacher = teacher
         self.start_time = start_time
         self.end_time = end_time
         self.room = room  # Room is optional
+        self.subject_id = subject_id
+        self.teacher_id = teacher_id
+        self.room_id = room_id
         self.is_substitute = is_substitute
         self.is_free_day = False
 
@@ -57,18 +107,64 @@ class Timetable(db.Model):
         else:
             raise ValueError("Invalid date format. Expected a string, datetime, or date object.")
 
-        # Fix: Ensure Monday entries are assigned to the correct week
-        self.week = self.date.isocalendar()[1]
-        if self.date.weekday() == 0:  # If it's Monday
-            previous_sunday = self.date - timedelta(days=1)
-            self.week = previous_sunday.isocalendar()[1] + 1
-
+        self.week = week_number(self.date)
         self.day_of_week = self.date.strftime('%A')  # Convert date to day name
 
+# Association table for many-to-many relationship between users and recurring lessons
+user_recurring_lesson = db.Table('user_recurring_lesson',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('recurring_lesson_id', db.Integer, db.ForeignKey('recurring_lesson.id'), primary_key=True),
+    db.Index('ix_user_recurring_lesson_lesson_user', 'recurring_lesson_id', 'user_id')
+)
+
+# Recurring Lesson Model (one row per weekly lesson, expanded into dated occurrences when a week is viewed)
+class RecurringLesson(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = Monday ... 6 = Sunday
+    week_parity = db.Column(db.String(1), nullable=True)  # None = every week, 'A' or 'B' with the A/B week system
+    term_start = db.Column(db.Date, nullable=False)
+    term_end = db.Column(db.Date, nullable=False)
+    subject = db.Column(db.String(100), nullable=False)  # Display names, as on Timetable
+    teacher = db.Column(db.String(100), nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    room = db.Column(db.String(100), nullable=True)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='SET NULL'), nullable=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id', ondelete='SET NULL'), nullable=True)
+    is_substitute = db.Column(db.Boolean, default=False)
+    is_generated = db.Column(db.Boolean, default=False)  # Created by the timetable generator
+    users = db.relationship('User', secondary=user_recurring_lesson, backref=db.backref('recurring_lessons', lazy='dynamic'))
+
+    __table_args__ = (
+        db.Index('ix_recurring_lesson_term', 'term_start', 'term_end'),
+        db.Index('ix_recurring_lesson_teacher_id_weekday', 'teacher_id', 'weekday'),
+        db.Index('ix_recurring_lesson_room_id_weekday', 'room_id', 'weekday'),
+        db.Index('ix_recurring_lesson_subject_id', 'subject_id'),
+    )
+
+    def __init__(self, term_start, term_end, subject, teacher, start_time, end_time, room=None, is_substitute=False, week_parity=None,
+                 subject_id=None, teacher_id=None, room_id=None):
+        if term_end < term_start:
+            raise ValueError("Term end must not be before term start.")
+        self.term_start = term_start
+        self.term_end = term_end
+        self.weekday = term_start.weekday()
+        self.subject = subject
+        self.teacher = teacher
+        self.start_time = start_time
+        self.end_time = end_time
+        self.room = room
+        self.subject_id = subject_id
+        self.teacher_id = teacher_id
+        self.room_id = room_id
+        self.is_substitute = is_substitute
+        self.week_parity = week_parity or None
+
 # Note Model
 class Note(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    timetable_id = db.Column(db.Integer, db.ForeignKey('timetable.id'), nullable=False)
+    timetable_id = db.Column(db.Integer, db.ForeignKey('timetable.id'), nullable=False, index=True)
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -90,6 +186,11 @@ class AssignedSubject(db.Model):
     user = db.relationship('User', backref='assigned_subjects')
     subject = db.relationship('Subject', backref='assigned_users')
 
+    __table_args__ = (
+        db.Index('ix_assigned_subject_user_subject', 'user_id', 'subject_id'),
+        db.Index('ix_assigned_subject_subject_user', 'subject_id', 'user_id'),
+    )
+
 # Room Model
 class Room(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -97,3 +198,92 @@ class Room(db.Model):
 
     def __init__(self, name):
         self.name = name
+
+# Period Model (the lesson slots of a school day, used by the timetable generator)
+class Period(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    number = db.Column(db.Integer, unique=True, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+
+# Weekly lessons a year group needs in a subject (input for the timetable generator)
+class SubjectRequirement(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
+    year_group = db.Column(db.String(10), nullable=False)
+    periods_per_week = db.Column(db.Integer, nullable=False)
+
+    subject = db.relationship('Subject', backref=db.backref('requirements', cascade='all, delete-orphan'))
+
+    __table_args__ = (
+        db.UniqueConstraint('subject_id', 'year_group'),
+    )
+
+# Times a teacher cannot be timetabled (period None = the whole day)
+class TeacherUnavailability(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = Monday
+    period = db.Column(db.Integer, nullable=True)
+
+    user = db.relationship('User', backref='unavailability')
+
+# Lessons and teaching minutes per room, teacher or subject in one week, maintained by analytics.py.
+# Subject rows are split by the year groups of the students taught; other rows have year_group ''.
+class WeeklyUsage(db.Model):
+    week_start = db.Column(db.Date, primary_key=True)  # Monday
+    kind = db.Column(db.String(10), primary_key=True)  # 'room', 'teacher' or 'subject'
+    key_id = db.Column(db.Integer, primary_key=True)
+    year_group = db.Column(db.String(10), primary_key=True, default='')
+    lessons = db.Column(db.Integer, nullable=False)
+    minutes = db.Column(db.Integer, nullable=False)
+
+# Weeks whose WeeklyUsage rows are up to date; weeks without a row are recomputed before they are reported
+class UsageWeek(db.Model):
+    week_start = db.Column(db.Date, primary_key=True)
+    refreshed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Append-only log of timetable writes, one row per affected user and entry, read by /changes.
+# user_id None means every user; entry_key None means the change cannot be described per entry
+# (imports, renames, generated timetables) and clients must download their timetable again.
+class TimetableChange(db.Model):
+    seq = db.Column(db.Integer, primary_key=True)  # Never reused, so a client's cursor only moves forward
+    user_id = db.Column(db.Integer, nullable=True)  # No foreign key: changes outlive deleted users until compacted
+    entry_key = db.Column(db.String(40), nullable=True)  # '42', an occurrence '12@2025-01-06' or a series 'series:12'
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_timetable_change_user_seq', 'user_id', 'seq'),
+        db.Index('ix_timetable_change_changed_at', 'changed_at'),
+        {'sqlite_autoincrement': True},
+    )
+
+# Each compaction of the change log; a cursor older than the latest pruned_through has lost changes
+class ChangeLogCompaction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    pruned_through = db.Column(db.Integer, nullable=False)
+    compacted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Slow admin operations queued for the background workers in jobs.py
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)  # A handler registered with JobQueue.kind
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments for the handler
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, running, succeeded, failed, cancelled
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)  # None while the amount of work is unknown
+    message = db.Column(db.String(200), nullable=True)
+    result = db.Column(db.Text, nullable=True)  # JSON returned by the handler
+    error = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=True)  # A retry waits until then
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_by = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # Moved on while a worker runs the job
+
+    __table_args__ = (
+        db.Index('ix_job_status_id', 'status', 'id'),
+    )
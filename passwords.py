@@ -0,0 +1,36 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import check_password_hash
+
+# Checking a pbkdf2 password hash costs a few hundred milliseconds of CPU. At
+# the start of the day every student logs in within minutes, so logins run
+# the check in one small pool shared by all server threads, sized to the CPUs:
+# hashlib releases the GIL while hashing, so the checks use the cores while
+# the other threads keep serving timetables, and a burst of logins waits in
+# the pool's queue instead of oversubscribing the CPU. Once queue_limit checks
+# are already waiting, further logins are turned away at once (503) rather than
+# queueing for longer than a client would wait.
+
+
+class PasswordCheckBusy(Exception):
+    pass
+
+
+class PasswordVerifier:
+    def __init__(self, workers, queue_limit):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-check')
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+
+    def verify(self, password_hash, password):
+        """Return whether password matches password_hash; raises PasswordCheckBusy when the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            raise PasswordCheckBusy()
+        try:
+            return self._executor.submit(check_password_hash, password_hash, password).result()
+        finally:
+            self._slots.release()
+
+
+def create_password_verifier(app):
+    return PasswordVerifier(app.config['PASSWORD_CHECK_WORKERS'], app.config['PASSWORD_CHECK_QUEUE'])
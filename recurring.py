@@ -0,0 +1,175 @@
+import heapq
+from datetime import date as dt_date
+from models import db, User, Timetable, RecurringLesson, user_timetable
+from school_calendar import school_calendar
+from week_grid import week_number
+
+# Recurring lessons are stored once and expanded into dated occurrences for the
+# week being viewed. A concrete Timetable row with recurring_lesson_id and
+# occurrence_date set replaces that one occurrence (edits, notes, cancellations).
+
+
+class LessonOccurrence:
+    """One dated occurrence of a RecurringLesson, shaped like a Timetable row for the templates."""
+
+    is_recurring = True
+    is_free_day = False
+    note = None
+
+    def __init__(self, lesson, date):
+        self.id = occurrence_key(lesson.id, date)
+        self.lesson_id = lesson.id
+        self.date = date
+        self.week = week_number(date)
+        self.day_of_week = date.strftime('%A')
+        self.subject = lesson.subject
+        self.teacher = lesson.teacher
+        self.start_time = lesson.start_time
+        self.end_time = lesson.end_time
+        self.room = lesson.room
+        self.subject_id = lesson.subject_id
+        self.teacher_id = lesson.teacher_id
+        self.room_id = lesson.room_id
+        self.is_substitute = lesson.is_substitute
+        self.week_parity = lesson.week_parity
+        self.users = lesson.users
+
+
+def occurrence_key(lesson_id, date):
+    return f"{lesson_id}@{date.isoformat()}"
+
+
+def parse_occurrence_key(key):
+    try:
+        lesson_id, date = str(key).split('@', 1)
+        return int(lesson_id), dt_date.fromisoformat(date)
+    except ValueError:
+        return None, None
+
+
+def is_occurrence_key(value):
+    return isinstance(value, str) and '@' in value
+
+
+def lesson_dates(lesson, start_date, end_date, calendar):
+    # A list, looked up in the school calendar: weekly, in the lesson's week of the rotation and not on holidays
+    return calendar.lesson_dates(lesson.weekday, lesson.week_parity, max(start_date, lesson.term_start),
+                                 min(end_date, lesson.term_end))
+
+
+def expand_lessons(user_ids, start_date, end_date, calendar=None):
+    """Return the occurrences of every recurring lesson assigned to any of user_ids within the date range."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return []
+    return expand_matching_lessons([RecurringLesson.users.any(User.id.in_(user_ids))], start_date, end_date, user_ids,
+                                   calendar)
+
+
+def expand_matching_lessons(criteria, start_date, end_date, user_ids=None, calendar=None):
+    """Return the occurrences within the date range of the recurring lessons matching criteria.
+
+    Free days hide an occurrence when they cover all of its users, or all of
+    the ones in user_ids when given; a lesson without users is never hidden.
+    """
+    lessons = RecurringLesson.query.options(db.selectinload(RecurringLesson.users)).filter(
+        *criteria,
+        RecurringLesson.term_start <= end_date,
+        RecurringLesson.term_end >= start_date
+    ).all()
+    if not lessons:
+        return []
+
+    calendar = calendar or school_calendar()
+
+    # Occurrences already replaced by a concrete Timetable row
+    overridden = set(db.session.query(Timetable.recurring_lesson_id, Timetable.occurrence_date).filter(
+        Timetable.recurring_lesson_id.in_([lesson.id for lesson in lessons]),
+        Timetable.occurrence_date.between(start_date, end_date)
+    ).all())
+
+    # Free days hide lessons for the users they cover
+    free_day_users = {}
+    free_day_rows = db.session.query(Timetable.date, user_timetable.c.user_id).join(
+        user_timetable, user_timetable.c.timetable_id == Timetable.id
+    ).filter(
+        Timetable.is_free_day == True,
+        Timetable.date.between(start_date, end_date)
+    )
+    if user_ids is not None:
+        free_day_rows = free_day_rows.filter(user_timetable.c.user_id.in_(user_ids))
+    for day, user_id in free_day_rows:
+        free_day_users.setdefault(day, set()).add(user_id)
+
+    occurrences = []
+    for lesson in lessons:
+        attendees = {user.id for user in lesson.users}
+        if user_ids is not None:
+            attendees &= user_ids
+        for day in lesson_dates(lesson, start_date, end_date, calendar):
+            if (lesson.id, day) in overridden:
+                continue
+            if attendees and attendees <= free_day_users.get(day, set()):
+                continue
+            occurrences.append(LessonOccurrence(lesson, day))
+    return occurrences
+
+
+def merge_entries(entries, occurrences):
+    return sorted(list(entries) + occurrences, key=lambda entry: (entry.date, entry.start_time))
+
+
+def iter_user_entries(user_id, start_date, end_date, calendar=None):
+    """Yield a user's entries and lesson occurrences in date order, reading the entries in batches."""
+    entries = Timetable.query.options(db.joinedload(Timetable.note)).filter(
+        Timetable.users.any(id=user_id),
+        Timetable.date.between(start_date, end_date)
+    ).order_by(Timetable.date, Timetable.start_time).yield_per(500)
+    occurrences = sorted(expand_lessons([user_id], start_date, end_date, calendar), key=lambda o: (o.date, o.start_time))
+    return heapq.merge(entries, occurrences, key=lambda entry: (entry.date, entry.start_time))
+
+
+def materialize_occurrence(key):
+    """Return the concrete Timetable row for an occurrence, creating it (uncommitted) if needed."""
+    lesson_id, date = parse_occurrence_key(key)
+    if lesson_id is None:
+        return None
+    lesson = RecurringLesson.query.get(lesson_id)
+    if not lesson or date not in lesson_dates(lesson, date, date, school_calendar()):
+        return None
+
+    entry = Timetable.query.filter_by(recurring_lesson_id=lesson.id, occurrence_date=date).first()
+    if entry:
+        return entry
+
+    entry = Timetable(
+        date=date,
+        subject=lesson.subject,
+        teacher=lesson.teacher,
+        start_time=lesson.start_time,
+        end_time=lesson.end_time,
+        room=lesson.room,
+        is_substitute=lesson.is_substitute,
+        subject_id=lesson.subject_id,
+        teacher_id=lesson.teacher_id,
+        room_id=lesson.room_id
+    )
+    entry.recurring_lesson_id = lesson.id
+    entry.occurrence_date = date
+    entry.users = list(lesson.users)
+    db.session.add(entry)
+    db.session.flush()
+    return entry
+
+
+def delete_lesson_series(lesson):
+    # Keep customised occurrences as standalone entries, drop cancelled ones
+    for entry in Timetable.query.filter_by(recurring_lesson_id=lesson.id).all():
+        if entry.users:
+            entry.recurring_lesson_id = None
+            entry.occurrence_date = None
+        else:
+            if entry.note:
+                db.session.delete(entry.note)
+            db.session.delete(entry)
+    db.session.delete(lesson)
@@ -0,0 +1,48 @@
+import hashlib
+import json
+from models import db, User, Subject, AssignedSubject, Room
+
+# Everything the admin timetable page needs to fill its dropdowns and
+# assignee lists, built with one query per table. The ETag is a hash of the
+# payload, so the page can keep a copy between visits and revalidate it with
+# If-None-Match instead of asking the server on every dropdown change.
+
+
+def build_reference_data():
+    """Return (payload, etag) for the admin reference data."""
+    users = {}
+    year_groups = {}
+    for user_id, username, role, year_group in db.session.query(
+        User.id, User.username, User.role, User.year_group
+    ).filter(User.role != 'admin').order_by(User.username):
+        users[str(user_id)] = {'username': username, 'role': role, 'year_group': year_group}
+        if role == 'student' and year_group:
+            year_groups.setdefault(year_group, []).append(user_id)
+
+    subjects = {}
+    for subject_id, name in db.session.query(Subject.id, Subject.name).order_by(Subject.name):
+        subjects[subject_id] = {'id': subject_id, 'name': name, 'teachers': [], 'assignees': []}
+
+    # Ordered by username so every list comes out sorted like the users map
+    assignments = db.session.query(AssignedSubject.subject_id, User.id, User.role).join(
+        User, User.id == AssignedSubject.user_id
+    ).order_by(User.username).distinct()
+    for subject_id, user_id, role in assignments:
+        subject = subjects.get(subject_id)
+        if subject is None:
+            continue
+        subject['assignees'].append(user_id)
+        if role == 'staff':
+            subject['teachers'].append(user_id)
+
+    payload = {
+        'subjects': list(subjects.values()),
+        'users': users,
+        'staff': [int(user_id) for user_id, user in users.items() if user['role'] == 'staff'],
+        'rooms': [{'id': room_id, 'name': name} for room_id, name in db.session.query(Room.id, Room.name).order_by(Room.name)],
+        'year_groups': [{'name': name, 'students': year_groups[name]} for name in sorted(year_groups)],
+    }
+    body = json.dumps(payload, sort_keys=True)
+    etag = hashlib.sha256(body.encode()).hexdigest()[:32]
+    payload['version'] = etag
+    return payload, etag
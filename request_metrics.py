@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+
+# Opt-in request profiling. Each request records its wall time, how many SQL
+# statements it ran and how long they took (from engine events), and the time
+# spent rendering templates. The numbers are folded into per-endpoint
+# histograms, rendered in the Prometheus text format for /metrics. Statements
+# slower than the threshold are logged with their parameters to the
+# "timetable.slow_sql" logger.
+#
+# The histograms are per process. Streamed responses are measured up to the
+# point the response starts, not until the last chunk is sent.
+
+REQUEST_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNTS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SQL_SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+MAX_PARAMETER_LENGTH = 200
+
+slow_query_log = logging.getLogger('timetable.slow_sql')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class RequestStats:
+    """What one request has done so far; kept on flask.g."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_starts = []
+
+
+HISTOGRAMS = {
+    'timetable_request_duration_seconds': ('Wall time of each request, up to the start of the response.', REQUEST_SECONDS),
+    'timetable_request_sql_queries': ('SQL statements run by each request.', QUERY_COUNTS),
+    'timetable_request_sql_duration_seconds': ('Total SQL time of each request.', SQL_SECONDS),
+    'timetable_request_template_duration_seconds': ('Template rendering time of each request.', REQUEST_SECONDS),
+}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _short(parameters):
+    text = repr(parameters)
+    return text if len(text) <= MAX_PARAMETER_LENGTH else text[:MAX_PARAMETER_LENGTH] + '...'
+
+
+class RequestMetrics:
+    def __init__(self, slow_query_seconds):
+        self.slow_query_seconds = slow_query_seconds
+        self._histograms = {}  # (metric, endpoint) -> Histogram
+        self._requests = {}  # (endpoint, method, status) -> count
+        self._slow_queries = 0
+        self._lock = threading.Lock()
+
+    def attach(self, app, engine):
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+        event.listen(engine, 'before_cursor_execute', self._start_query)
+        event.listen(engine, 'after_cursor_execute', self._finish_query)
+
+    def _start_request(self):
+        g.request_stats = RequestStats()
+
+    def _finish_request(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        # Unrouted paths share one label so scanners cannot grow the series without bound
+        endpoint = request.endpoint or 'unmatched'
+        observations = {
+            'timetable_request_duration_seconds': time.perf_counter() - stats.started,
+            'timetable_request_sql_queries': stats.queries,
+            'timetable_request_sql_duration_seconds': stats.sql_seconds,
+            'timetable_request_template_duration_seconds': stats.template_seconds,
+        }
+        with self._lock:
+            for metric, value in observations.items():
+                histogram = self._histograms.get((metric, endpoint))
+                if histogram is None:
+                    histogram = self._histograms[(metric, endpoint)] = Histogram(HISTOGRAMS[metric][1])
+                histogram.observe(value)
+            key = (endpoint, request.method, response.status_code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+        return response
+
+    def _start_template(self, sender, template, context, **extra):
+        stats = g.get('request_stats') if has_request_context() else None
+        if stats is not None:
+            stats.template_starts.append(time.perf_counter())
+
+    def _finish_template(self, sender, template, context, **extra):
+        stats = g.get('request_stats') if has_request_context() else None
+        if stats is not None and stats.template_starts:
+            stats.template_seconds += time.perf_counter() - stats.template_starts.pop()
+
+    def _start_query(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_starts', []).append(time.perf_counter())
+
+    def _finish_query(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_starts'].pop()
+        endpoint = None
+        if has_request_context():
+            endpoint = request.endpoint
+            stats = g.get('request_stats')
+            if stats is not None:
+                stats.queries += 1
+                stats.sql_seconds += elapsed
+        if elapsed >= self.slow_query_seconds:
+            with self._lock:
+                self._slow_queries += 1
+            slow_query_log.warning("%.1f ms%s: %s; parameters %s", elapsed * 1000,
+                                   f" in {endpoint}" if endpoint else "", ' '.join(statement.split()), _short(parameters))
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            requests = sorted(self._requests.items(), key=lambda item: tuple(map(str, item[0])))
+            slow_queries = self._slow_queries
+
+        lines = ['# HELP timetable_requests_total Requests handled, by endpoint, method and status.',
+                 '# TYPE timetable_requests_total counter']
+        for (endpoint, method, status), count in requests:
+            lines.append(f'timetable_requests_total{{endpoint="{_label(endpoint)}",method="{method}",status="{status}"}} {count}')
+
+        current = None
+        for (metric, endpoint), histogram in histograms:
+            if metric != current:
+                current = metric
+                lines.append(f'# HELP {metric} {HISTOGRAMS[metric][0]}')
+                lines.append(f'# TYPE {metric} histogram')
+            label = f'endpoint="{_label(endpoint)}"'
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum{{{label}}} {histogram.sum:.6f}')
+            lines.append(f'{metric}_count{{{label}}} {histogram.count}')
+
+        lines += ['# HELP timetable_slow_queries_total SQL statements slower than the slow query threshold.',
+                  '# TYPE timetable_slow_queries_total counter',
+                  f'timetable_slow_queries_total {slow_queries}']
+        return '\n'.join(lines) + '\n'
+
+
+def enable_request_metrics(app, engine):
+    """Start recording request metrics for app; returns the RequestMetrics to render /metrics from."""
+    metrics = RequestMetrics(app.config['SLOW_QUERY_MS'] / 1000)
+    metrics.attach(app, engine)
+    if app.config['SLOW_QUERY_LOG']:
+        handler = logging.FileHandler(app.config['SLOW_QUERY_LOG'])
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_query_log.addHandler(handler)
+    return metrics
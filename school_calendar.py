@@ -0,0 +1,174 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import timedelta
+from sqlalchemy import select, update
+from models import db, SchoolSettings, SchoolTerm, SchoolHoliday, Period
+from week_grid import week_number
+
+# The school calendar: which term a date is in, its teaching week, its week of
+# the rotation (Week A/B or an N-week cycle), whether it is a holiday, and the
+# period a time falls in.
+#
+# Everything is worked out once from the terms, holidays and periods into
+# lookup tables: one slot per day from the first term's Monday to the last
+# term's Sunday, and one per minute of the school day, so rendering weeks
+# indexes a list instead of doing date arithmetic per row. Days of the same
+# week share one CalendarDay, so a school year is a few dozen objects. For
+# expanding recurring lessons the dates a lesson can take place on are listed
+# per weekday and week of the rotation, and a lesson's dates are a slice. The
+# calendar is cached per process and rebuilt when the settings'
+# calendar_version moves, which calendar_changed() does on every edit.
+#
+# Days between terms count as holidays. Dates outside the recorded terms (or
+# every date, when no terms are recorded) fall back to the ISO week: odd weeks
+# are Week A, even weeks Week B, and so on through a longer cycle.
+
+WEEK_LABELS = 'ABCDEFGH'
+MAX_CYCLE_WEEKS = len(WEEK_LABELS)
+TEACHING_DAYS = 5  # Monday to Friday
+BETWEEN_TERMS = "School holiday"
+
+
+class CalendarDay(namedtuple('CalendarDay', 'term teaching_week week_label holiday')):
+    """term: the term's name or None; teaching_week: the week of the term, counting only weeks with teaching
+    days; week_label: 'A', 'B', ... with a rotation, else None; holiday: the holiday's name or None."""
+
+    __slots__ = ()
+
+    @property
+    def is_holiday(self):
+        return self.holiday is not None
+
+
+class SchoolCalendar:
+    def __init__(self, cycle_weeks=1, terms=(), holidays=(), periods=(), version=None):
+        self.cycle_weeks = cycle_weeks
+        self.week_labels = WEEK_LABELS[:cycle_weeks] if cycle_weeks > 1 else ''
+        self.version = version
+        self.first_day = None
+        self._days = []
+        self._period_at = bytearray(24 * 60)  # Minute of the day -> period number, 0 outside every period
+        self._outside = {}  # ISO week -> CalendarDay, for dates outside the recorded terms
+        self._lesson_days = {}  # (weekday, week label or None) -> dates in the table a lesson on them takes place
+        terms = sorted(terms, key=lambda term: term.start_date)
+        if terms:
+            self._build_days(terms, holidays)
+        for period in periods:
+            start = period.start_time.hour * 60 + period.start_time.minute
+            end = period.end_time.hour * 60 + period.end_time.minute
+            self._period_at[start:end] = bytes([period.number]) * (end - start)
+
+    def _build_days(self, terms, holidays):
+        self.first_day = terms[0].start_date - timedelta(days=terms[0].start_date.weekday())
+        last_day = max(term.end_date for term in terms)
+        last_day += timedelta(days=6 - last_day.weekday())
+        between_terms = CalendarDay(None, None, None, BETWEEN_TERMS)
+        self._days = [between_terms] * ((last_day - self.first_day).days + 1)
+
+        holiday_names = {}
+        for holiday in holidays:
+            day = holiday.start_date
+            while day <= holiday.end_date:
+                holiday_names[day] = holiday.name
+                day += timedelta(days=1)
+
+        rotation = 0  # Teaching weeks so far, for the week label
+        for term in terms:
+            teaching_week = 0
+            week_start = term.start_date - timedelta(days=term.start_date.weekday())
+            while week_start <= term.end_date:
+                days = [week_start + timedelta(days=offset) for offset in range(7)]
+                in_term = [day for day in days if term.start_date <= day <= term.end_date]
+                if any(day.weekday() < TEACHING_DAYS and day not in holiday_names for day in in_term):
+                    if teaching_week == 0 and term.first_week and term.first_week in self.week_labels:
+                        rotation = self.week_labels.index(term.first_week)
+                    teaching_week += 1
+                    label = self.week_labels[rotation % self.cycle_weeks] if self.week_labels else None
+                    rotation += 1
+                    week = CalendarDay(term.name, teaching_week, label, None)
+                else:
+                    week = CalendarDay(term.name, None, None, None)
+                for day in in_term:
+                    holiday = holiday_names.get(day)
+                    self._days[(day - self.first_day).days] = week._replace(holiday=holiday) if holiday else week
+                week_start += timedelta(weeks=1)
+
+    def day(self, date):
+        """The CalendarDay for date."""
+        if self.first_day is not None:
+            offset = (date - self.first_day).days
+            if 0 <= offset < len(self._days):
+                return self._days[offset]
+        iso_week = week_number(date)
+        outside = self._outside.get(iso_week)
+        if outside is None:
+            label = self.week_labels[(iso_week - 1) % self.cycle_weeks] if self.week_labels else None
+            outside = self._outside[iso_week] = CalendarDay(None, None, label, None)
+        return outside
+
+    def week_label(self, date):
+        return self.day(date).week_label
+
+    def period(self, time):
+        """The number of the period time falls in, or None."""
+        return self._period_at[time.hour * 60 + time.minute] or None
+
+    def lesson_dates(self, weekday, week_parity, first, last):
+        """The dates from first to last on weekday (0 = Monday) that a weekly lesson repeating in week_parity
+        (None = every week) takes place: in its week of the rotation and not on a holiday."""
+        week_parity = week_parity if self.week_labels else None
+        if self.first_day is None:
+            return self._walk(weekday, week_parity, first, last)
+        table_last = self.first_day + timedelta(days=len(self._days) - 1)
+        dates = []
+        if first < self.first_day:
+            dates += self._walk(weekday, week_parity, first, min(last, self.first_day - timedelta(days=1)))
+        if first <= table_last and last >= self.first_day:
+            listed = self._lesson_days.get((weekday, week_parity))
+            if listed is None:
+                listed = self._lesson_days[(weekday, week_parity)] = [
+                    self.first_day + timedelta(days=offset) for offset in range(weekday, len(self._days), 7)
+                    if self._days[offset].holiday is None and week_parity in (None, self._days[offset].week_label)
+                ]
+            dates += listed[bisect_left(listed, first):bisect_right(listed, last)]
+        if last > table_last:
+            dates += self._walk(weekday, week_parity, max(first, table_last + timedelta(days=1)), last)
+        return dates
+
+    def _walk(self, weekday, week_parity, first, last):
+        # Dates outside the table, a week at a time
+        dates = []
+        day = first + timedelta(days=(weekday - first.weekday()) % 7)
+        while day <= last:
+            if week_parity in (None, self.day(day).week_label):
+                dates.append(day)
+            day += timedelta(weeks=1)
+        return dates
+
+
+_calendars = {}  # Database URL -> SchoolCalendar
+
+
+def school_calendar():
+    """The calendar for the current settings, terms and holidays; one small query when it is cached."""
+    settings = db.session.execute(select(
+        SchoolSettings.use_week_ab, SchoolSettings.cycle_weeks, SchoolSettings.calendar_version
+    ).order_by(SchoolSettings.id).limit(1)).first()
+    version = tuple(settings) if settings else (False, None, None)
+    database = str(db.engine.url)
+    calendar = _calendars.get(database)
+    if calendar is None or calendar.version != version:
+        use_week_ab, cycle_weeks, _ = version
+        calendar = SchoolCalendar(
+            min(cycle_weeks or 2, MAX_CYCLE_WEEKS) if use_week_ab else 1,
+            SchoolTerm.query.all(), SchoolHoliday.query.all(), Period.query.all(), version
+        )
+        _calendars[database] = calendar
+    return calendar
+
+
+def calendar_changed():
+    # Call before committing a change to the settings, terms, holidays or periods
+    db.session.execute(update(SchoolSettings).values(
+        calendar_version=db.func.coalesce(SchoolSettings.calendar_version, 0) + 1
+    ))
@@ -0,0 +1,167 @@
+import json
+import os
+import re
+import secrets
+import sqlite3
+import time
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# Optional server-side sessions. By default Flask keeps the whole session in a
+# signed cookie. With SESSION_BACKEND set to 'sqlite' or 'filesystem' the
+# cookie only carries a random session id, and the data (login, role,
+# flashed messages) stays on the server, so it can be revoked by deleting
+# it and never grows the cookie. Sessions expire after
+# PERMANENT_SESSION_LIFETIME.
+
+SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid or new_session_id()
+        self.new = new
+        self.replaced_sid = None
+        self.modified = False
+
+    def clear(self):
+        # Clearing (at login and logout) also moves the data to a new id, so an id
+        # planted before login is never the one that ends up authenticated
+        if not self.new and self.replaced_sid is None:
+            self.replaced_sid = self.sid
+        self.sid = new_session_id()
+        super().clear()
+        self.modified = True
+
+
+class SQLiteSessionStore:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session ("
+                "sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_session_expires_at ON session (expires_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def load(self, sid):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM session WHERE sid = ? AND expires_at >= ?", (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, data, expires_at):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO session VALUES (?, ?, ?)", (sid, data, expires_at))
+            conn.execute("DELETE FROM session WHERE expires_at < ?", (time.time(),))
+
+    def delete(self, sid):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM session WHERE sid = ?", (sid,))
+
+
+class FileSessionStore:
+    """One JSON file per session; expired files are swept every purge_every saves."""
+
+    def __init__(self, directory, purge_every=100):
+        self.directory = directory
+        self.purge_every = purge_every
+        self._saves = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, sid):
+        return os.path.join(self.directory, sid)
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid)) as stream:
+                stored = json.load(stream)
+        except (OSError, ValueError):
+            return None
+        return stored['data'] if stored['expires_at'] >= time.time() else None
+
+    def save(self, sid, data, expires_at):
+        # Write then rename, so a concurrent load never sees half a file
+        temporary = self._path(f'{sid}.{secrets.token_hex(8)}.tmp')
+        with open(temporary, 'w') as stream:
+            json.dump({'data': data, 'expires_at': expires_at}, stream)
+        os.replace(temporary, self._path(sid))
+        self._saves += 1
+        if self._saves % self.purge_every == 0:
+            self.purge()
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def purge(self):
+        for sid in os.listdir(self.directory):
+            if SESSION_ID.match(sid) and self.load(sid) is None:
+                self.delete(sid)
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and SESSION_ID.match(sid):
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(self.serializer.loads(data), sid=sid)
+        # Unknown or expired ids are never adopted; a new session gets a fresh one
+        return ServerSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replaced_sid:
+            self.store.delete(session.replaced_sid)
+
+        if not session:
+            if session.modified and not session.new:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not self.should_set_cookie(app, session):
+            return
+
+        expires = self.get_expiration_time(app, session)
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), time.time() + lifetime)
+        response.set_cookie(
+            name, session.sid, expires=expires, httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app)
+        )
+
+
+def configure_sessions(app):
+    """Install the server-side session backend named by SESSION_BACKEND; 'cookie' keeps Flask's default."""
+    backend = app.config.get('SESSION_BACKEND', 'cookie')
+    if backend == 'sqlite':
+        path = app.config.get('SESSION_PATH') or os.path.join(app.instance_path, 'sessions.db')
+        app.session_interface = ServerSessionInterface(SQLiteSessionStore(path))
+    elif backend == 'filesystem':
+        directory = app.config.get('SESSION_PATH') or os.path.join(app.instance_path, 'sessions')
+        app.session_interface = ServerSessionInterface(FileSessionStore(directory))
+    elif backend != 'cookie':
+        raise ValueError(f"Unknown SESSION_BACKEND '{backend}'; use 'cookie', 'sqlite' or 'filesystem'.")
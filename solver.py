@@ -0,0 +1,324 @@
+import random
+import time
+from collections import defaultdict
+
+# Weekly (or N-week cycle) timetable solver. Independent of the database so it
+# can be benchmarked and re-run on its own.
+#
+# A Section is one teaching group (a subject for a set of students in a year
+# group) taught by one teacher; it needs a number of lessons per cycle. Each
+# lesson is an Event that must get a slot (week, day, period) and a room with:
+#   - no teacher teaching two events in the same slot
+#   - no student attending two events in the same slot
+#   - no more events in a slot than there are rooms free in it
+#   - no event in a slot where its teacher or one of its students is blocked
+#     (unavailable, or busy with a lesson the solver does not place)
+#
+# Slots are filled with DSatur (most constrained event first, with domains
+# kept up to date by forward checking), then any events left over are placed
+# by a tabu search that evicts the cheapest set of clashing events and
+# re-queues them. Passing previous slots in initial_slots re-solves
+# incrementally: valid placements are kept and only the rest is searched.
+
+
+class Section:
+    def __init__(self, key, subject_id, subject_name, year_group, student_ids, teacher_ids, lessons_per_cycle, teacher_id=None):
+        self.key = key
+        self.subject_id = subject_id
+        self.subject_name = subject_name
+        self.year_group = year_group
+        self.student_ids = frozenset(student_ids)
+        self.teacher_ids = list(teacher_ids)  # qualified teachers
+        self.lessons_per_cycle = lessons_per_cycle
+        self.teacher_id = teacher_id
+
+
+class Event:
+    def __init__(self, section, slot=None, room_id=None, lesson_id=None):
+        self.section = section
+        self.slot = slot
+        self.room_id = room_id
+        self.lesson_id = lesson_id  # set when the event was loaded from an existing lesson
+
+    @property
+    def teacher_id(self):
+        return self.section.teacher_id
+
+
+class SlotGrid:
+    def __init__(self, days_per_week, periods_per_day, cycle_weeks=1):
+        self.days_per_week = days_per_week
+        self.periods_per_day = periods_per_day
+        self.cycle_weeks = cycle_weeks
+        self.size = cycle_weeks * days_per_week * periods_per_day
+
+    def slot(self, week, day, period):
+        return (week * self.days_per_week + day) * self.periods_per_day + period
+
+    def split(self, slot):
+        day_index, period = divmod(slot, self.periods_per_day)
+        week, day = divmod(day_index, self.days_per_week)
+        return week, day, period
+
+    def day_of(self, slot):
+        return slot // self.periods_per_day
+
+
+class SolverResult:
+    def __init__(self, events, unplaced, iterations, seconds):
+        self.events = events
+        self.unplaced = unplaced
+        self.iterations = iterations
+        self.seconds = seconds
+
+    @property
+    def complete(self):
+        return not self.unplaced
+
+
+def allocate_teachers(sections, grid, blocked_slots=None):
+    """Give every section without a teacher the least loaded qualified teacher that still has room for it."""
+    blocked_slots = blocked_slots or {}
+    load = defaultdict(int)
+    for section in sections:
+        if section.teacher_id is not None:
+            load[section.teacher_id] += section.lessons_per_cycle
+
+    pending = [s for s in sections if s.teacher_id is None and s.teacher_ids]
+    pending.sort(key=lambda s: (len(s.teacher_ids), -s.lessons_per_cycle))
+    for section in pending:
+        def spare(teacher_id):
+            return grid.size - len(blocked_slots.get(teacher_id, ())) - load[teacher_id]
+        fitting = [t for t in section.teacher_ids if spare(t) >= section.lessons_per_cycle]
+        teacher_id = min(fitting or section.teacher_ids, key=lambda t: (load[t], t))
+        section.teacher_id = teacher_id
+        load[teacher_id] += section.lessons_per_cycle
+
+
+def build_events(sections):
+    return [Event(section) for section in sections if section.teacher_id is not None for _ in range(section.lessons_per_cycle)]
+
+
+def build_conflicts(events):
+    by_teacher = defaultdict(list)
+    by_section = defaultdict(list)
+    for index, event in enumerate(events):
+        by_teacher[event.teacher_id].append(index)
+        by_section[event.section.key].append(index)
+
+    # Sections sharing any student clash; sections of one subject and year group are disjoint
+    sections_of_student = defaultdict(set)
+    for event in events:
+        for student_id in event.section.student_ids:
+            sections_of_student[student_id].add(event.section.key)
+    clashing_sections = defaultdict(set)
+    for keys in sections_of_student.values():
+        for key in keys:
+            clashing_sections[key].update(keys)
+
+    neighbours = [set() for _ in events]
+    for group in by_teacher.values():
+        for index in group:
+            neighbours[index].update(group)
+    for key, indexes in by_section.items():
+        clashing = set()
+        for other in clashing_sections[key] | {key}:
+            clashing.update(by_section[other])
+        for index in indexes:
+            neighbours[index].update(clashing)
+    for index, group in enumerate(neighbours):
+        group.discard(index)
+    return [frozenset(group) for group in neighbours]
+
+
+class TimetableSolver:
+    def __init__(self, events, grid, room_ids, blocked_slots=None, seed=0, blocked_rooms=None):
+        """blocked_slots maps user ids (teachers and students) and blocked_rooms maps room ids to the slots
+        they are not free in."""
+        self.events = events
+        self.grid = grid
+        self.room_ids = list(room_ids)
+        self.blocked_rooms = blocked_rooms or {}
+        self.capacity = [sum(1 for room_id in self.room_ids if s not in self.blocked_rooms.get(room_id, ()))
+                         for s in range(grid.size)]
+        self.random = random.Random(seed)
+        blocked_slots = blocked_slots or {}
+        section_blocked = {}
+        for event in events:
+            section = event.section
+            if section.key not in section_blocked:
+                section_blocked[section.key] = set(blocked_slots.get(event.teacher_id, ())).union(
+                    *(blocked_slots.get(student_id, ()) for student_id in section.student_ids))
+        self.allowed = [
+            [s for s in range(grid.size) if self.capacity[s] and s not in section_blocked[event.section.key]]
+            for event in events
+        ]
+        self.allowed_sets = [set(slots) for slots in self.allowed]
+        self.neighbours = build_conflicts(events)
+        self._reset()
+
+    def _reset(self):
+        count = len(self.events)
+        self.slots = [None] * count
+        self.slot_events = [set() for _ in range(self.grid.size)]
+        self.clashes = [[0] * self.grid.size for _ in range(count)]  # placed neighbours per slot
+        self.section_days = defaultdict(int)
+
+    def place(self, index, slot):
+        self.slots[index] = slot
+        self.slot_events[slot].add(index)
+        for neighbour in self.neighbours[index]:
+            self.clashes[neighbour][slot] += 1
+        self.section_days[(self.events[index].section.key, self.grid.day_of(slot))] += 1
+
+    def unplace(self, index):
+        slot = self.slots[index]
+        self.slots[index] = None
+        self.slot_events[slot].discard(index)
+        for neighbour in self.neighbours[index]:
+            self.clashes[neighbour][slot] -= 1
+        self.section_days[(self.events[index].section.key, self.grid.day_of(slot))] -= 1
+
+    def feasible(self, index, slot):
+        return self.clashes[index][slot] == 0 and len(self.slot_events[slot]) < self.capacity[slot]
+
+    def solve(self, time_limit=10.0, max_iterations=200000, initial_slots=None):
+        started = time.perf_counter()
+        deadline = started + time_limit
+        self._reset()
+
+        if initial_slots:
+            for index, slot in enumerate(initial_slots):
+                if slot is not None and slot in self.allowed_sets[index] and self.feasible(index, slot):
+                    self.place(index, slot)
+
+        self._construct()
+        iterations = self._repair(deadline, max_iterations)
+        self._assign_rooms()
+
+        for event, slot in zip(self.events, self.slots):
+            event.slot = slot
+        unplaced = [event for event in self.events if event.slot is None]
+        return SolverResult(self.events, unplaced, iterations, time.perf_counter() - started)
+
+    def _construct(self):
+        # DSatur: repeatedly place the unplaced event with the fewest feasible slots
+        pending = {i for i, slot in enumerate(self.slots) if slot is None}
+        domain = {i: sum(1 for s in self.allowed[i] if self.feasible(i, s)) for i in pending}
+        degree = [len(group) for group in self.neighbours]
+
+        while pending:
+            index = min(pending, key=lambda i: (domain[i], -degree[i]))
+            pending.discard(index)
+            del domain[index]
+            choices = [s for s in self.allowed[index] if self.feasible(index, s)]
+            if not choices:
+                continue  # left for the repair phase
+
+            # Least constraining value: the slot that removes the fewest options from unplaced neighbours,
+            # then the day on which the section has the fewest lessons
+            key = self.events[index].section.key
+            waiting = [n for n in self.neighbours[index] if n in domain]
+            best_cost = None
+            for s in choices:
+                cost = (sum(1 for n in waiting if self.clashes[n][s] == 0), self.section_days[(key, self.grid.day_of(s))])
+                if best_cost is None or cost < best_cost:
+                    best_cost, best_slots = cost, [s]
+                elif cost == best_cost:
+                    best_slots.append(s)
+            slot = self.random.choice(best_slots)
+
+            # Forward checking: shrink the domains this placement affects
+            for neighbour in self.neighbours[index]:
+                if neighbour in domain and self.clashes[neighbour][slot] == 0 and slot in self.allowed_sets[neighbour] \
+                        and len(self.slot_events[slot]) < self.capacity[slot]:
+                    domain[neighbour] -= 1
+            self.place(index, slot)
+            if len(self.slot_events[slot]) == self.capacity[slot]:
+                for other in domain:
+                    if other not in self.neighbours[index] and self.clashes[other][slot] == 0 and slot in self.allowed_sets[other]:
+                        domain[other] -= 1
+
+    def _repair(self, deadline, max_iterations):
+        unplaced = [i for i, slot in enumerate(self.slots) if slot is None]
+        best_unplaced, best_slots = len(unplaced), list(self.slots)
+        tabu = {}
+        iteration = 0
+
+        while unplaced and iteration < max_iterations and time.perf_counter() < deadline:
+            iteration += 1
+            index = unplaced.pop(self.random.randrange(len(unplaced)))
+            key = self.events[index].section.key
+
+            best_cost, choices = None, []
+            for slot in self.allowed[index]:
+                if tabu.get((index, slot), 0) > iteration:
+                    continue
+                cost = self.clashes[index][slot] * 4
+                if len(self.slot_events[slot]) >= self.capacity[slot] and self.clashes[index][slot] == 0:
+                    cost += 4  # a room has to be freed
+                cost += self.section_days[(key, self.grid.day_of(slot))]
+                if best_cost is None or cost < best_cost:
+                    best_cost, choices = cost, [slot]
+                elif cost == best_cost:
+                    choices.append(slot)
+            if not choices:
+                unplaced.append(index)
+                continue
+
+            slot = self.random.choice(choices)
+            evicted = [other for other in self.slot_events[slot] if other in self.neighbours[index]]
+            for other in evicted:
+                self.unplace(other)
+            if len(self.slot_events[slot]) >= self.capacity[slot]:
+                victim = self.random.choice(list(self.slot_events[slot]))
+                self.unplace(victim)
+                evicted.append(victim)
+            self.place(index, slot)
+
+            for other in evicted:
+                tabu[(other, slot)] = iteration + 7 + self.random.randrange(10)
+                unplaced.append(other)
+
+            if len(unplaced) < best_unplaced:
+                best_unplaced, best_slots = len(unplaced), list(self.slots)
+
+        if len(unplaced) > best_unplaced:
+            self._reset()
+            for index, slot in enumerate(best_slots):
+                if slot is not None:
+                    self.place(index, slot)
+        return iteration
+
+    def _assign_rooms(self):
+        # Keep an event's previous room, then its section's usual room, when free
+        home_rooms = {}
+        for index, slot in enumerate(self.slots):
+            event = self.events[index]
+            if slot is None:
+                event.room_id = None
+            elif event.room_id is not None:
+                home_rooms.setdefault(event.section.key, event.room_id)
+
+        for slot, slot_events in enumerate(self.slot_events):
+            taken = {room_id for room_id in self.room_ids if slot in self.blocked_rooms.get(room_id, ())}
+            waiting = []
+            for index in sorted(slot_events):
+                event = self.events[index]
+                preferred = event.room_id if event.room_id is not None else home_rooms.get(event.section.key)
+                if preferred is not None and preferred not in taken and preferred in self.room_ids:
+                    event.room_id = preferred
+                    taken.add(preferred)
+                else:
+                    waiting.append(event)
+            free_rooms = (room_id for room_id in self.room_ids if room_id not in taken)
+            for event in waiting:
+                event.room_id = next(free_rooms)
+                home_rooms.setdefault(event.section.key, event.room_id)
+
+
+def solve_timetable(sections, grid, room_ids, blocked_slots=None, time_limit=10.0, seed=0, blocked_rooms=None):
+    allocate_teachers(sections, grid, blocked_slots)
+    events = build_events(sections)
+    solver = TimetableSolver(events, grid, room_ids, blocked_slots, seed=seed, blocked_rooms=blocked_rooms)
+    return solver.solve(time_limit=time_limit)
@@ -0,0 +1,25 @@
+from sqlalchemy import event
+
+# Opt-in SQLite settings for busy deployments, applied to every new connection.
+# WAL lets readers continue while an admin is writing; NORMAL sync is safe with WAL.
+PERFORMANCE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative = KiB, so 64 MiB
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+
+
+def enable_sqlite_profile(engine, pragmas=None):
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = dict(PERFORMANCE_PRAGMAS, **(pragmas or {}))
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
@@ -0,0 +1,414 @@
+import threading
+from collections import Counter, OrderedDict
+from datetime import timedelta
+from sqlalchemy import Date, Integer, String, and_, cast, exists, literal, null, or_, select, union_all
+from models import db, User, Timetable, RecurringLesson, AssignedSubject, Period, TeacherUnavailability, user_timetable, user_recurring_lesson
+from feeds import timetable_version
+from recurring import lesson_dates, occurrence_key, is_occurrence_key, materialize_occurrence
+from school_calendar import school_calendar
+
+# Substitute recommendations from a free/busy bitmap per member of staff and
+# day. A day is cut into 5 minute slots and each member of staff gets one int
+# with a bit set for every slot they teach, attend, are unavailable or have a
+# free day, so checking a candidate for a lesson is a single AND. The bitmaps
+# for a date (and the cover counts for its week) are built with a handful of
+# queries and kept until any user's timetable change stamp moves, so covering
+# a whole day's absences reuses one build for every lesson. Covering a range
+# first finds the days the absent staff teach on with one query, and builds
+# bitmaps for those days only.
+
+SLOT_MINUTES = 5
+DAY_MASK = (1 << (24 * 60 // SLOT_MINUTES)) - 1
+
+
+def slot_mask(start_time, end_time):
+    """Bits for the slots a lesson touches. Times off the 5 minute grid round outwards."""
+    first = (start_time.hour * 60 + start_time.minute) // SLOT_MINUTES
+    last = -(-(end_time.hour * 60 + end_time.minute + (end_time.second > 0)) // SLOT_MINUTES)
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+class Booking:
+    """A lesson on the day, with the staff it keeps busy."""
+
+    def __init__(self, key, date, row, teacher_id, staff_ids):
+        self.key = key
+        self.date = date
+        self.subject = row.subject
+        self.subject_id = row.subject_id
+        self.teacher = row.teacher
+        self.teacher_id = teacher_id
+        self.room = row.room
+        self.start_time = row.start_time
+        self.end_time = row.end_time
+        self.is_substitute = bool(row.is_substitute)
+        self.staff_ids = staff_ids
+        self.mask = slot_mask(row.start_time, row.end_time)
+
+    def to_dict(self):
+        return {
+            'id': self.key,
+            'date': self.date.strftime('%Y-%m-%d'),
+            'subject': self.subject,
+            'subject_id': self.subject_id,
+            'teacher': self.teacher,
+            'teacher_id': self.teacher_id,
+            'room': self.room,
+            'start_time': self.start_time.strftime('%H:%M'),
+            'end_time': self.end_time.strftime('%H:%M'),
+            'is_substitute': self.is_substitute
+        }
+
+
+class StaffDay:
+    """Free/busy bitmaps of every member of staff for one date."""
+
+    def __init__(self, date, staff, bookings, blocked):
+        self.date = date
+        self.staff = staff  # {user_id: username}
+        self.bookings = bookings
+        self.blocked = blocked  # {user_id: mask} from unavailability and free days
+        self.busy = dict(blocked)
+        self._by_key = {}
+        for booking in bookings:
+            self._by_key[booking.key] = booking
+            for staff_id in booking.staff_ids:
+                self.busy[staff_id] = self.busy.get(staff_id, 0) | booking.mask
+
+    def booking(self, key):
+        return self._by_key.get(key)
+
+    def busy_without(self, booking):
+        """Busy bitmaps as if booking was not on the timetable."""
+        busy = dict(self.busy)
+        for staff_id in booking.staff_ids:
+            mask = self.blocked.get(staff_id, 0)
+            for other in self.bookings:
+                if other is not booking and staff_id in other.staff_ids:
+                    mask |= other.mask
+            busy[staff_id] = mask
+        return busy
+
+
+class _VersionedCache:
+    """Small per-process LRU of values tagged with the version they were built for."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, build):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[0] == version:
+                self._entries.move_to_end(key)
+                return item[1]
+        value = build()
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_staff_days = _VersionedCache(max_entries=62)
+_cover_weeks = _VersionedCache(max_entries=12)
+
+
+def _staff_by_name(staff):
+    return {username: user_id for user_id, username in staff.items()}
+
+
+def load_staff_day(day):
+    """Build the StaffDay for a date straight from the database."""
+    staff = dict(db.session.query(User.id, User.username).filter(User.role == 'staff'))
+    staff_ids = _staff_by_name(staff)
+    weekday = day.weekday()
+
+    blocked = {}
+    periods = {number: (start_time, end_time) for number, start_time, end_time in
+               db.session.query(Period.number, Period.start_time, Period.end_time)}
+    for user_id, period in db.session.query(TeacherUnavailability.user_id, TeacherUnavailability.period).filter(
+        TeacherUnavailability.weekday == weekday
+    ):
+        if period is None:
+            mask = DAY_MASK
+        elif period in periods:
+            mask = slot_mask(*periods[period])
+        else:
+            continue
+        blocked[user_id] = blocked.get(user_id, 0) | mask
+
+    # Staff on an entry besides its teacher, and staff given a free day
+    entry_staff = {}
+    rows = db.session.query(user_timetable.c.timetable_id, user_timetable.c.user_id, Timetable.is_free_day).join(
+        Timetable, Timetable.id == user_timetable.c.timetable_id
+    ).join(User, User.id == user_timetable.c.user_id).filter(Timetable.date == day, User.role == 'staff')
+    for timetable_id, user_id, is_free_day in rows:
+        if is_free_day:
+            blocked[user_id] = DAY_MASK
+        else:
+            entry_staff.setdefault(timetable_id, set()).add(user_id)
+
+    bookings = []
+    # Cancelled recurring occurrences are rows without users, so they book nobody
+    booked = exists().where(user_timetable.c.timetable_id == Timetable.id)
+    entries = db.session.query(
+        Timetable.id, Timetable.subject, Timetable.subject_id, Timetable.teacher, Timetable.teacher_id,
+        Timetable.room, Timetable.start_time, Timetable.end_time, Timetable.is_substitute,
+        booked.label('booked')
+    ).filter(Timetable.date == day, Timetable.is_free_day == False)
+    for row in entries:
+        if not row.booked:
+            continue
+        teacher_id = row.teacher_id or staff_ids.get(row.teacher)
+        members = entry_staff.get(row.id, set()) | ({teacher_id} if teacher_id else set())
+        bookings.append(Booking(row.id, day, row, teacher_id, members))
+
+    lessons = db.session.query(RecurringLesson).filter(
+        RecurringLesson.weekday == weekday,
+        RecurringLesson.term_start <= day,
+        RecurringLesson.term_end >= day
+    ).all()
+    if lessons:
+        # Occurrences replaced by a concrete row, which may have been moved to another date
+        overridden = {lesson_id for lesson_id, in db.session.query(Timetable.recurring_lesson_id).filter(
+            Timetable.recurring_lesson_id.in_([lesson.id for lesson in lessons]),
+            Timetable.occurrence_date == day
+        )}
+        lessons = [lesson for lesson in lessons if lesson.id not in overridden]
+    if lessons:
+        calendar = school_calendar()
+        lessons = [lesson for lesson in lessons if any(lesson_dates(lesson, day, day, calendar))]
+        lesson_staff = {}
+        rows = db.session.query(user_recurring_lesson.c.recurring_lesson_id, user_recurring_lesson.c.user_id).join(
+            User, User.id == user_recurring_lesson.c.user_id
+        ).filter(user_recurring_lesson.c.recurring_lesson_id.in_([lesson.id for lesson in lessons]), User.role == 'staff')
+        for lesson_id, user_id in rows:
+            lesson_staff.setdefault(lesson_id, set()).add(user_id)
+        for lesson in lessons:
+            teacher_id = lesson.teacher_id or staff_ids.get(lesson.teacher)
+            members = lesson_staff.get(lesson.id, set()) | ({teacher_id} if teacher_id else set())
+            bookings.append(Booking(occurrence_key(lesson.id, day), day, lesson, teacher_id, members))
+
+    bookings.sort(key=lambda booking: (booking.start_time, booking.end_time, str(booking.key)))
+    return StaffDay(day, staff, bookings, blocked)
+
+
+def load_cover_counts(week_start):
+    """Count the substitute lessons each member of staff teaches in the week starting week_start."""
+    week_end = week_start + timedelta(days=6)
+    staff_ids = _staff_by_name(dict(db.session.query(User.id, User.username).filter(User.role == 'staff')))
+    counts = Counter()
+
+    booked = exists().where(user_timetable.c.timetable_id == Timetable.id)
+    for teacher_id, teacher in db.session.query(Timetable.teacher_id, Timetable.teacher).filter(
+        Timetable.date.between(week_start, week_end),
+        Timetable.is_substitute == True,
+        Timetable.is_free_day == False,
+        booked
+    ):
+        teacher_id = teacher_id or staff_ids.get(teacher)
+        if teacher_id:
+            counts[teacher_id] += 1
+
+    lessons = RecurringLesson.query.filter(
+        RecurringLesson.is_substitute == True,
+        RecurringLesson.term_start <= week_end,
+        RecurringLesson.term_end >= week_start
+    ).all()
+    if lessons:
+        calendar = school_calendar()
+        overridden = set(db.session.query(Timetable.recurring_lesson_id, Timetable.occurrence_date).filter(
+            Timetable.recurring_lesson_id.in_([lesson.id for lesson in lessons]),
+            Timetable.occurrence_date.between(week_start, week_end)
+        ))
+        for lesson in lessons:
+            teacher_id = lesson.teacher_id or staff_ids.get(lesson.teacher)
+            if not teacher_id:
+                continue
+            for day in lesson_dates(lesson, week_start, week_end, calendar):
+                if (lesson.id, day) not in overridden:
+                    counts[teacher_id] += 1
+    return counts
+
+
+def teaching_days(teacher_ids, start_date, end_date):
+    """The dates between start_date and end_date on which any of teacher_ids teaches a lesson."""
+    teacher_ids = list(teacher_ids)
+    names = select(User.username).where(User.id.in_(teacher_ids))
+
+    def taught(model):
+        # Matched like load_staff_day: by teacher_id, or by name for rows without one
+        return or_(model.teacher_id.in_(teacher_ids), and_(model.teacher_id.is_(None), model.teacher.in_(names)))
+
+    no_date, no_number, no_text = cast(null(), Date), cast(null(), Integer), cast(null(), String)
+    booked = exists().where(user_timetable.c.timetable_id == Timetable.id)
+    rows = db.session.execute(union_all(
+        # Named like RecurringLesson attributes so lesson rows can be passed to lesson_dates
+        select(literal('lesson').label('kind'), RecurringLesson.id, no_date.label('date'), RecurringLesson.weekday,
+               RecurringLesson.week_parity, RecurringLesson.term_start, RecurringLesson.term_end).where(
+            taught(RecurringLesson), RecurringLesson.term_start <= end_date, RecurringLesson.term_end >= start_date),
+        # Dated entries, less cancelled occurrences (rows without users)
+        select(literal('entry').label('kind'), Timetable.id, Timetable.date, no_number, no_text, no_date, no_date).where(
+            taught(Timetable), Timetable.date.between(start_date, end_date), Timetable.is_free_day == False, booked),
+        # Occurrences of those lessons replaced by a concrete row, which may be on another date or teacher
+        select(literal('override').label('kind'), Timetable.recurring_lesson_id, Timetable.occurrence_date,
+               no_number, no_text, no_date, no_date).where(
+            Timetable.recurring_lesson_id.in_(select(RecurringLesson.id).where(taught(RecurringLesson))),
+            Timetable.occurrence_date.between(start_date, end_date))
+    )).all()
+
+    days = {row.date for row in rows if row.kind == 'entry'}
+    overridden = {(row.id, row.date) for row in rows if row.kind == 'override'}
+    lessons = [row for row in rows if row.kind == 'lesson']
+    if lessons:
+        calendar = school_calendar()
+        for lesson in lessons:
+            days.update(day for day in lesson_dates(lesson, start_date, end_date, calendar)
+                        if (lesson.id, day) not in overridden)
+    return sorted(days)
+
+
+def staff_day(day, version=None):
+    version = version if version is not None else timetable_version()
+    return _staff_days.get(day, version, lambda: load_staff_day(day))
+
+
+def cover_counts(day, version=None):
+    week_start = day - timedelta(days=day.weekday())
+    version = version if version is not None else timetable_version()
+    return _cover_weeks.get(week_start, version, lambda: load_cover_counts(week_start))
+
+
+def qualified_staff(subject_ids):
+    """Return {subject_id: set of staff ids} assigned to each subject."""
+    subject_ids = {subject_id for subject_id in subject_ids if subject_id}
+    qualified = {subject_id: set() for subject_id in subject_ids}
+    if subject_ids:
+        rows = db.session.query(AssignedSubject.subject_id, AssignedSubject.user_id).join(
+            User, User.id == AssignedSubject.user_id
+        ).filter(AssignedSubject.subject_id.in_(subject_ids), User.role == 'staff')
+        for subject_id, user_id in rows:
+            qualified[subject_id].add(user_id)
+    return qualified
+
+
+def rank_candidates(day_bitmaps, busy, mask, qualified, counts, absent_ids=(), limit=None):
+    """Free staff for the slots in mask: qualified first, then by fewest covers this week, then by name."""
+    candidates = [
+        (user_id not in qualified, counts.get(user_id, 0), username, user_id)
+        for user_id, username in day_bitmaps.staff.items()
+        if user_id not in absent_ids and not busy.get(user_id, 0) & mask
+    ]
+    candidates.sort()
+    if limit is not None:
+        candidates = candidates[:limit]
+    return [{'id': user_id, 'username': username, 'qualified': not unqualified, 'cover_load': load}
+            for unqualified, load, username, user_id in candidates]
+
+
+def find_substitutes(day, start_time, end_time, subject_id=None, absent_ids=(), exclude_key=None, limit=None):
+    """Rank the staff free between start_time and end_time on day.
+
+    exclude_key names a booking on that day (an entry id or occurrence key) to
+    ignore, so an existing lesson does not keep its own teacher busy.
+    """
+    version = timetable_version()
+    day_bitmaps = staff_day(day, version)
+    busy = day_bitmaps.busy
+    if exclude_key is not None:
+        booking = day_bitmaps.booking(exclude_key)
+        if booking is not None:
+            busy = day_bitmaps.busy_without(booking)
+    qualified = qualified_staff([subject_id]).get(subject_id, set())
+    return rank_candidates(day_bitmaps, busy, slot_mask(start_time, end_time), qualified,
+                           cover_counts(day, version), set(absent_ids), limit)
+
+
+def plan_cover(absent_ids, start_date, end_date, chosen=None, limit=5):
+    """Pick a substitute for every lesson the absent staff teach between two dates.
+
+    chosen maps lesson ids (entry ids or occurrence keys) to the member of
+    staff who should take them, or None to leave a lesson uncovered; every
+    other lesson gets the best free candidate. Chosen lessons are booked first
+    and each pick goes into a working copy of the bitmaps and cover counts, so
+    no one is suggested for two overlapping lessons. A chosen substitute who
+    is not free is reported in the lesson's 'error'. Only the days the absent
+    staff teach on are loaded.
+    """
+    absent_ids = set(absent_ids)
+    chosen = chosen or {}
+    version = timetable_version()
+    week_counts = {}
+    plan = []
+    for day in teaching_days(absent_ids, start_date, end_date):
+        day_bitmaps = staff_day(day, version)
+        week_start = day - timedelta(days=day.weekday())
+        if week_start not in week_counts:
+            week_counts[week_start] = Counter(cover_counts(day, version))
+        counts = week_counts[week_start]
+        busy = dict(day_bitmaps.busy)
+        lessons = [booking for booking in day_bitmaps.bookings if booking.teacher_id in absent_ids]
+        qualified = qualified_staff(booking.subject_id for booking in lessons)
+
+        items = {}
+        for booking in sorted(lessons, key=lambda booking: booking.key not in chosen):
+            subject_staff = qualified.get(booking.subject_id, set())
+            candidates = rank_candidates(day_bitmaps, busy, booking.mask, subject_staff, counts, absent_ids, limit)
+            item = {'lesson': booking.to_dict(), 'suggested': None, 'chosen': booking.key in chosen, 'candidates': candidates}
+            if booking.key in chosen:
+                substitute_id = chosen[booking.key]
+                if substitute_id is None:
+                    pass
+                elif substitute_id not in day_bitmaps.staff or substitute_id in absent_ids:
+                    item['error'] = f"User {substitute_id} cannot cover this lesson"
+                elif busy.get(substitute_id, 0) & booking.mask:
+                    item['error'] = f"{day_bitmaps.staff[substitute_id]} is not free then"
+                else:
+                    item['suggested'] = {'id': substitute_id, 'username': day_bitmaps.staff[substitute_id],
+                                         'qualified': substitute_id in subject_staff, 'cover_load': counts.get(substitute_id, 0)}
+            elif candidates:
+                item['suggested'] = candidates[0]
+            if item['suggested']:
+                busy[item['suggested']['id']] = busy.get(item['suggested']['id'], 0) | booking.mask
+                counts[item['suggested']['id']] += 1
+            items[booking.key] = item
+        plan.extend(items[booking.key] for booking in lessons)
+    return plan
+
+
+def apply_cover(plan):
+    """Hand each planned lesson to its suggested substitute, without committing.
+
+    Recurring occurrences are materialized first. Returns the ids of the users
+    and the dates whose timetables changed, and the changed entry keys.
+    """
+    picks = [item for item in plan if item['suggested']]
+    if not picks:
+        return set(), set(), []
+    substitutes = {user.id: user for user in User.query.filter(User.id.in_({item['suggested']['id'] for item in picks}))}
+    affected_user_ids, dates, changed = set(), set(), []
+    for item in picks:
+        key = item['lesson']['id']
+        entry = materialize_occurrence(key) if is_occurrence_key(key) else Timetable.query.get(key)
+        substitute = substitutes[item['suggested']['id']]
+        absent_id = item['lesson']['teacher_id']
+        affected_user_ids.update(user.id for user in entry.users)
+        entry.teacher, entry.teacher_id = substitute.username, substitute.id
+        entry.is_substitute = True
+        entry.users = [user for user in entry.users if user.id != absent_id]
+        if substitute not in entry.users:
+            entry.users.append(substitute)
+        affected_user_ids.add(substitute.id)
+        dates.add(entry.date)
+        changed += [str(key), str(entry.id)]
+    return affected_user_ids, dates, changed
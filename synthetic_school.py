@@ -0,0 +1,191 @@
+import math
+import random
+from datetime import date, timedelta
+from werkzeug.security import generate_password_hash
+from models import db, User, Subject, Room, AssignedSubject, Timetable, Note, user_timetable
+from generator import DAYS_PER_WEEK, DEFAULT_PERIODS
+
+# Builds a synthetic school of a chosen size for load and benchmark runs: year
+# groups of students split into classes, subject teachers, rooms, subject
+# assignments, a school year of dated lessons with their attendees, some notes
+# and whole-school free days. The week is a rotation, so class c has subject
+# (c + slot) mod subjects in each slot; each subject gets enough teachers to
+# teach every class that has it in the same slot, and each class keeps its own
+# room, so the generated timetable has no clashes. The same seed always
+# builds the same school.
+
+SIZES = {
+    'small': {'year_groups': 3, 'students_per_year': 60, 'subjects': 8, 'weeks': 12},
+    'medium': {'year_groups': 7, 'students_per_year': 120, 'subjects': 12, 'weeks': 39},
+    'large': {'year_groups': 7, 'students_per_year': 240, 'subjects': 14, 'weeks': 39},
+}
+SUBJECT_NAMES = ['Maths', 'English', 'Science', 'History', 'Geography', 'French', 'Spanish', 'Art',
+                 'Music', 'Drama', 'Computing', 'PE', 'Religious Studies', 'Design Technology',
+                 'Biology', 'Chemistry', 'Physics', 'Economics', 'Latin', 'German']
+NOTES = ["Bring calculators.", "Homework due today.", "Cover work set in the shared drive.",
+         "Test on the last topic.", "Meet in the library instead.", "Practical lesson: lab coats needed."]
+PASSWORD = 'password'
+
+
+class SchoolSize:
+    def __init__(self, year_groups, students_per_year, subjects, weeks, class_size=30, first_year=7,
+                 free_days=3, note_rate=0.02):
+        if subjects > len(SUBJECT_NAMES):
+            raise ValueError(f"At most {len(SUBJECT_NAMES)} subjects.")
+        self.year_groups = year_groups
+        self.students_per_year = students_per_year
+        self.subjects = subjects
+        self.weeks = weeks
+        self.class_size = class_size
+        self.first_year = first_year
+        self.free_days = free_days
+        self.note_rate = note_rate
+
+    @classmethod
+    def named(cls, name, **overrides):
+        return cls(**{**SIZES[name], **{key: value for key, value in overrides.items() if value is not None}})
+
+
+class SyntheticSchool:
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.password = PASSWORD
+        self.year_groups = []
+        self.students = 0
+        self.staff = 0
+        self.classes = 0
+        self.subjects = 0
+        self.rooms = 0
+        self.assignments = 0
+        self.entries = 0
+        self.links = 0
+        self.notes = 0
+        self.free_days = []
+
+    def summary(self):
+        return (f"{self.students} students in {self.classes} classes ({', '.join(self.year_groups)}), {self.staff} staff, "
+                f"{self.subjects} subjects, {self.rooms} rooms, {self.assignments} subject assignments; "
+                f"{self.entries} lessons from {self.start} to {self.end} with {self.links} attendee links, "
+                f"{self.notes} notes and {len(self.free_days)} free days. Every password is '{self.password}'.")
+
+
+def school_year_start(today=None):
+    # The Monday of the week containing 1 September of the current school year
+    today = today or date.today()
+    first = date(today.year if today.month >= 9 else today.year - 1, 9, 1)
+    return first - timedelta(days=first.weekday())
+
+
+def add_users(rows):
+    db.session.execute(User.__table__.insert(), rows)
+    names = [row['username'] for row in rows]
+    return [user_id for user_id, in db.session.query(User.id).filter(User.username.in_(names)).order_by(User.id)]
+
+
+def generate_school(size, start=None, seed=0):
+    """Add a synthetic school to an empty database and commit it; returns a SyntheticSchool with the counts."""
+    rng = random.Random(seed)
+    start = start or school_year_start()
+    start -= timedelta(days=start.weekday())
+    school = SyntheticSchool(start)
+    password = generate_password_hash(PASSWORD, method='pbkdf2:sha256')
+
+    # Students, split into classes within their year group
+    classes = []  # (year group, [student ids])
+    for year in range(size.first_year, size.first_year + size.year_groups):
+        year_group = str(year)
+        student_ids = add_users([
+            {'username': f'y{year_group}_student{i + 1}', 'password': password, 'role': 'student', 'year_group': year_group}
+            for i in range(size.students_per_year)
+        ])
+        class_count = math.ceil(len(student_ids) / size.class_size)
+        for index in range(class_count):
+            classes.append((year_group, student_ids[index::class_count]))
+        school.year_groups.append(year_group)
+        school.students += len(student_ids)
+    school.classes = len(classes)
+
+    subjects = [Subject(name=name) for name in SUBJECT_NAMES[:size.subjects]]
+    db.session.add_all(subjects)
+    rooms = [Room(f'Room {index + 1}') for index in range(len(classes))]
+    db.session.add_all(rooms)
+    db.session.flush()
+    school.subjects, school.rooms = len(subjects), len(rooms)
+
+    # Enough teachers per subject for every class that has the subject in the same slot
+    teachers_per_subject = math.ceil(len(classes) / len(subjects))
+    teachers = {}  # subject index -> [(id, username)]
+    for subject_index, subject in enumerate(subjects):
+        names = [f"{subject.name.lower().replace(' ', '_')}_teacher{i + 1}" for i in range(teachers_per_subject)]
+        ids = add_users([{'username': name, 'password': password, 'role': 'staff', 'year_group': None} for name in names])
+        teachers[subject_index] = list(zip(ids, names))
+        school.staff += len(ids)
+
+    # A weekly template: slot -> [(class index, subject index, teacher)]
+    slots = [(day, period) for day in range(DAYS_PER_WEEK) for period in range(len(DEFAULT_PERIODS))]
+    template = []
+    class_subjects = [set() for _ in classes]
+    for slot in range(len(slots)):
+        taught = {}
+        lessons = []
+        for class_index in range(len(classes)):
+            subject_index = (class_index + slot) % len(subjects)
+            teacher = teachers[subject_index][taught.get(subject_index, 0)]
+            taught[subject_index] = taught.get(subject_index, 0) + 1
+            lessons.append((class_index, subject_index, teacher))
+            class_subjects[class_index].add(subject_index)
+        template.append(lessons)
+
+    assignments = [{'user_id': student_id, 'subject_id': subjects[subject_index].id}
+                   for class_index, (_, student_ids) in enumerate(classes)
+                   for subject_index in sorted(class_subjects[class_index]) for student_id in student_ids]
+    assignments += [{'user_id': teacher_id, 'subject_id': subjects[subject_index].id}
+                    for subject_index, staff in teachers.items() for teacher_id, _ in staff]
+    db.session.execute(AssignedSubject.__table__.insert(), assignments)
+    school.assignments = len(assignments)
+
+    school_days = [start + timedelta(weeks=week, days=day) for week in range(size.weeks) for day in range(DAYS_PER_WEEK)]
+    school.free_days = sorted(rng.sample(school_days, min(size.free_days, len(school_days))))
+    everyone = [user_id for user_id, in db.session.query(User.id).filter(User.role != 'admin')]
+    for day in school.free_days:
+        entry = Timetable(date=day, subject='School closed', teacher='N/A', start_time=DEFAULT_PERIODS[0][0],
+                          end_time=DEFAULT_PERIODS[-1][1], room='N/A')
+        entry.is_free_day = True
+        db.session.add(entry)
+        db.session.flush()
+        db.session.execute(user_timetable.insert(), [{'user_id': user_id, 'timetable_id': entry.id} for user_id in everyone])
+        school.links += len(everyone)
+
+    # Lessons, a week at a time so the session never holds more than a week of rows
+    free_days = set(school.free_days)
+    for week in range(size.weeks):
+        week_start = start + timedelta(weeks=week)
+        entries, attendees = [], []
+        for slot, (day, period) in enumerate(slots):
+            day = week_start + timedelta(days=day)
+            if day in free_days:
+                continue
+            start_time, end_time = DEFAULT_PERIODS[period]
+            for class_index, subject_index, (teacher_id, teacher_name) in template[slot]:
+                room = rooms[class_index]
+                entries.append(Timetable(date=day, subject=subjects[subject_index].name, teacher=teacher_name,
+                                         start_time=start_time, end_time=end_time, room=room.name,
+                                         subject_id=subjects[subject_index].id, teacher_id=teacher_id, room_id=room.id))
+                attendees.append([teacher_id] + classes[class_index][1])
+        db.session.add_all(entries)
+        db.session.flush()
+        links = [{'user_id': user_id, 'timetable_id': entry.id}
+                 for entry, user_ids in zip(entries, attendees) for user_id in user_ids]
+        db.session.execute(user_timetable.insert(), links)
+        notes = [Note(timetable_id=entry.id, content=rng.choice(NOTES)) for entry in entries if rng.random() < size.note_rate]
+        db.session.add_all(notes)
+        db.session.flush()
+        db.session.expunge_all()
+        school.entries += len(entries)
+        school.links += len(links)
+        school.notes += len(notes)
+
+    school.end = start + timedelta(weeks=size.weeks, days=-1)
+    db.session.commit()
+    return school
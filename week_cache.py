@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Cache of rendered timetable weeks keyed on (user_id, week_start, permission_level).
+# Writes invalidate the weeks of the users they touch; the TTL bounds staleness for
+# anything that is not invalidated explicitly. The memory backend is per process,
+# so multi-process deployments should use the sqlite backend, which is shared.
+
+
+def week_key(user_id, week_start, permission_level):
+    return (int(user_id), week_start.isoformat(), permission_level or '')
+
+
+class NullWeekCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def invalidate(self, user_ids=None, week_start=None):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryWeekCache:
+    def __init__(self, max_entries=5000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_ids=None, week_start=None):
+        user_ids = None if user_ids is None else {int(user_id) for user_id in user_ids}
+        week = week_start.isoformat() if week_start else None
+        with self._lock:
+            for key in list(self._entries):
+                if (user_ids is None or key[0] in user_ids) and (week is None or key[1] == week):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteWeekCache:
+    def __init__(self, path, max_entries=50000, ttl=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS week_cache ("
+                "user_id INTEGER NOT NULL, week_start TEXT NOT NULL, permission_level TEXT NOT NULL, "
+                "value TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL, "
+                "PRIMARY KEY (user_id, week_start, permission_level))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_week_cache_last_used ON week_cache (last_used)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM week_cache WHERE user_id = ? AND week_start = ? AND permission_level = ?",
+                key
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM week_cache WHERE user_id = ? AND week_start = ? AND permission_level = ?", key)
+                return None
+            conn.execute(
+                "UPDATE week_cache SET last_used = ? WHERE user_id = ? AND week_start = ? AND permission_level = ?",
+                (now,) + key
+            )
+            return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO week_cache VALUES (?, ?, ?, ?, ?, ?)",
+                key + (value, now + self.ttl, now)
+            )
+            conn.execute(
+                "DELETE FROM week_cache WHERE rowid IN ("
+                "SELECT rowid FROM week_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def invalidate(self, user_ids=None, week_start=None):
+        clauses, params = [], []
+        if user_ids is not None:
+            user_ids = [int(user_id) for user_id in user_ids]
+            if not user_ids:
+                return
+            clauses.append(f"user_id IN ({', '.join('?' * len(user_ids))})")
+            params.extend(user_ids)
+        if week_start is not None:
+            clauses.append("week_start = ?")
+            params.append(week_start.isoformat())
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM week_cache{where}", params)
+
+    def clear(self):
+        self.invalidate()
+
+
+def create_week_cache(app):
+    backend = app.config.get('WEEK_CACHE_BACKEND', 'memory')
+    ttl = app.config.get('WEEK_CACHE_TTL', 300)
+    max_entries = app.config.get('WEEK_CACHE_MAX_ENTRIES', 5000)
+    if backend == 'memory':
+        return MemoryWeekCache(max_entries=max_entries, ttl=ttl)
+    if backend == 'sqlite':
+        path = app.config.get('WEEK_CACHE_PATH') or os.path.join(app.instance_path, 'week_cache.db')
+        return SQLiteWeekCache(path, max_entries=max_entries, ttl=ttl)
+    return NullWeekCache()
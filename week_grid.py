@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+# Week pages get their entries already split into the seven day columns, built
+# in one pass over the (date, start time) ordered entries, so the templates do
+# not filter the whole list again for every day. Given the school calendar,
+# each day also carries its CalendarDay (term, week of the rotation, holiday).
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def week_number(day):
+    # ISO week, which starts on Monday; teaching weeks and Week A/B come from the school calendar
+    return day.isocalendar()[1]
+
+
+class WeekDay:
+    def __init__(self, date, calendar_day=None):
+        self.date = date
+        self.name = DAY_NAMES[date.weekday()]
+        self.calendar_day = calendar_day
+        self.entries = []
+
+
+def week_days(entries, week_start, calendar=None):
+    """Return the seven WeekDays starting at week_start, each with its entries in the order given."""
+    if isinstance(week_start, datetime):
+        week_start = week_start.date()
+    dates = [week_start + timedelta(days=offset) for offset in range(7)]
+    days = [WeekDay(day, calendar.day(day) if calendar else None) for day in dates]
+    for entry in entries:
+        offset = (entry.date - week_start).days
+        if 0 <= offset < 7:
+            days[offset].entries.append(entry)
+    return days
+
+
+def weeks_in_range(entries, start_date, end_date, calendar=None):
+    """Yield (week_start, days) for each week from start_date to end_date, reading the date-ordered entries lazily."""
+    pending = iter(entries)
+    entry = next(pending, None)
+    week_start = start_date - timedelta(days=start_date.weekday())
+    while week_start <= end_date:
+        week_end = week_start + timedelta(days=7)
+        batch = []
+        while entry is not None and entry.date < week_end:
+            if entry.date >= week_start:
+                batch.append(entry)
+            entry = next(pending, None)
+        yield week_start, week_days(batch, week_start, calendar)
+        week_start = week_end
@@ -0,0 +1,34 @@
+"""Production entry point.
+
+Any WSGI server can serve `wsgi:application`, for example:
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+    waitress-serve --threads=16 --port=8000 wsgi:application
+
+or run `python wsgi.py`, which serves it with waitress (pip install waitress)
+on SERVER_HOST:SERVER_PORT with SERVER_THREADS threads. `python app.py` is the
+single-threaded debug server, for development only.
+
+Several worker processes each keep their own memory week cache; set
+WEEK_CACHE_BACKEND=sqlite so they share one.
+"""
+import os
+from app import app, init_database
+
+with app.app_context():
+    init_database()
+
+application = app
+
+if __name__ == '__main__':
+    host = os.environ.get('SERVER_HOST', '0.0.0.0')
+    port = int(os.environ.get('SERVER_PORT', 8000))
+    threads = int(os.environ.get('SERVER_THREADS', 16))
+    try:
+        from waitress import serve
+    except ImportError:
+        from werkzeug.serving import run_simple
+        print("waitress is not installed (pip install waitress); falling back to the threaded Werkzeug server.")
+        run_simple(host, port, application, threaded=True)
+    else:
+        serve(application, host=host, port=port, threads=threads)